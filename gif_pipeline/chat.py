@@ -4,7 +4,7 @@ import asyncio
 import logging
 import os
 from abc import ABC
-from typing import TYPE_CHECKING, Awaitable
+from typing import TYPE_CHECKING
 from typing import TypeVar, List, Optional
 
 from prometheus_client.metrics import Gauge, Counter
@@ -16,6 +16,7 @@ from gif_pipeline.message import Message
 if TYPE_CHECKING:
     from gif_pipeline.telegram_client import TelegramClient
     from gif_pipeline.database import Database
+    from gif_pipeline.media_downloader import MediaDownloader, DownloadPriority
     from gif_pipeline.message import MessageData
 T = TypeVar('T', bound='Group')
 
@@ -88,20 +89,45 @@ class Chat(ABC):
             chat_title=self.chat_data.title
         ).set_function(lambda: self.sum_file_size())
 
+    def remove_metrics(self) -> None:
+        video_count.remove(self.__class__.__name__, self.chat_data.title)
+        file_size_total.remove(self.__class__.__name__, self.chat_data.title)
+
+    def update_config(self, config: ChatConfig) -> None:
+        # Swap in reloaded config, and reset any metrics which depend on it
+        self.remove_metrics()
+        self.config = config
+        self.init_metrics()
+
+    def close(self) -> None:
+        # Called when the chat is removed from the config of a running pipeline
+        self.remove_metrics()
+
     @staticmethod
-    async def list_message_initialisers(
+    async def list_message_data(
             chat_data: 'ChatData',
             config: 'ChatConfig',
             client: TelegramClient,
             database: 'Database',
-    ) -> List[Awaitable[Message]]:
+            snapshot_messages: Optional[List[MessageData]] = None,
+    ) -> List[MessageData]:
         logger.info(f"Initialising chat: {config}")
         # Ensure bot is in chat
         if not config.read_only:
             await client.invite_pipeline_bot_to_chat(chat_data)
         # Get messages from database and channel, ensure they match
-        database_messages = database.list_messages_for_chat(chat_data)
-        channel_messages = [m async for m in client.iter_channel_messages(chat_data, not config.read_only)]
+        if snapshot_messages is None:
+            database_messages = database.list_messages_for_chat(chat_data)
+            channel_messages = [m async for m in client.iter_channel_messages(chat_data, not config.read_only)]
+        else:
+            # Warm start, trust the snapshot for older messages and only list newer ones and scheduled ones.
+            # Anything deleted while the pipeline was offline is found by the reconcile after startup
+            database_messages = snapshot_messages
+            channel_messages = [m for m in snapshot_messages if not m.is_scheduled]
+            newest_id = max((m.message_id for m in channel_messages), default=0)
+            channel_messages += [m async for m in client.list_messages_since(chat_data.chat_id, newest_id)]
+            if not config.read_only:
+                channel_messages += [m async for m in client.iter_scheduled_channel_messages(chat_data)]
         new_messages = set(channel_messages) - set(database_messages)
         removed_messages = set(database_messages) - set(channel_messages)
         for message_data in new_messages:
@@ -109,15 +135,22 @@ class Chat(ABC):
         for message_data in removed_messages:
             database.remove_message(message_data)
 
-        # Check files, turn message data into message objects
-        async def save_message(message):
-            old_file_path = message.file_path
-            new_message = await Message.from_message_data(message, chat_data, client)
-            if old_file_path != new_message.message_data.file_path:
-                database.save_message(new_message.message_data)
-            return new_message
+        return channel_messages
 
-        return [save_message(message) for message in channel_messages]
+    @staticmethod
+    async def create_message(
+            message_data: MessageData,
+            chat_data: 'ChatData',
+            database: 'Database',
+            media_downloader: 'MediaDownloader',
+            download_priority: 'DownloadPriority',
+    ) -> Message:
+        # Check files, turn message data into message objects. Missing media is queued for download, not waited for
+        old_file_path = message_data.file_path
+        new_message = Message.from_message_data_lazy(message_data, chat_data, media_downloader, download_priority)
+        if old_file_path != new_message.message_data.file_path:
+            database.save_message(new_message.message_data)
+        return new_message
 
     def cleanup_excess_files(self):
         # Check for extra files which need removing
@@ -174,9 +207,14 @@ class Channel(Chat):
             client: TelegramClient,
             queue: Optional[WorkshopGroup] = None
     ):
+        self.queue = queue
         super().__init__(chat_data, config, messages, client)
         self.config = config
-        self.queue = queue
+        # Start task to update subscriber counts
+        self.sub_count_task = asyncio.ensure_future(self.periodically_update_sub_count())
+
+    def init_metrics(self) -> None:
+        super().init_metrics()
         self.sub_count = subscriber_count.labels(
             chat_title=self.chat_data.title
         )
@@ -200,8 +238,20 @@ class Channel(Chat):
             chat_title=self.chat_data.title,
             read_only=self.config.read_only,
         ).set_function(lambda: self.latest_message().message_data.datetime.timestamp() if self.latest_message() else 0)
-        # Start task to update subscriber counts
-        asyncio.ensure_future(self.periodically_update_sub_count())
+
+    def remove_metrics(self) -> None:
+        super().remove_metrics()
+        for metric in [queue_duration, queue_length, queue_target]:
+            try:
+                metric.remove(self.chat_data.title)
+            except KeyError:
+                pass
+        channel_latest_post.remove(self.chat_data.title, self.config.read_only)
+
+    def close(self) -> None:
+        super().close()
+        subscriber_count.remove(self.chat_data.title)
+        self.sub_count_task.cancel()
 
     async def periodically_update_sub_count(self) -> None:
         logger.info("Starting subscription metric updater")
@@ -261,6 +311,10 @@ class WorkshopGroup(Chat):
             chat_title=self.chat_data.title
         )
 
+    def close(self) -> None:
+        super().close()
+        workshop_new_message_count.remove(self.chat_data.title)
+
     def add_message(self, message: Message) -> None:
         self.new_message_count.inc()
         super().add_message(message)
@@ -2,17 +2,20 @@ import logging
 import os
 import shutil
 from abc import abstractmethod, ABC
-from typing import List, Awaitable, TypeVar, Generic
+from typing import List, TypeVar, Generic, AsyncIterator, Optional
 
 from tqdm import tqdm
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
 from gif_pipeline.chat_data import ChatData, ChannelData, WorkshopData
-from gif_pipeline.chat_config import ChatConfig, ChannelConfig, WorkshopConfig
-from gif_pipeline.message import Message
-from gif_pipeline.tasks.task_worker import Bottleneck
+from gif_pipeline.chat_config import ChatConfig, ChannelConfig, WorkshopConfig, QueueConfig
+from gif_pipeline.media_downloader import MediaDownloader, DownloadPriority
+from gif_pipeline.message import Message, MessageData
+from gif_pipeline.snapshot import PipelineSnapshot
+from gif_pipeline.startup_tracer import startup_tracer
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.utils import StreamGroup
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +26,17 @@ Data = TypeVar("Data", bound=ChatData)
 class ChatBuilder(ABC, Generic[Conf, Data]):
     chat_type = "chat"
 
-    def __init__(self, database: Database, client: TelegramClient, download_bottleneck: Bottleneck):
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            media_downloader: MediaDownloader,
+            snapshot: Optional[PipelineSnapshot] = None,
+    ):
         self.database = database
         self.client = client
-        self.download_bottleneck = download_bottleneck
+        self.media_downloader = media_downloader
+        self.snapshot = snapshot
 
     @abstractmethod
     def list_chats(self) -> List[Data]:
@@ -41,11 +51,14 @@ class ChatBuilder(ABC, Generic[Conf, Data]):
             # Clear files
             shutil.rmtree(chat.directory, ignore_errors=True)
 
+    def download_priority(self, chat_config: Conf) -> DownloadPriority:
+        return DownloadPriority.BACKGROUND
+
     @abstractmethod
     async def create_chat_data(self, chat_config: Conf) -> ChatData:
         pass
 
-    async def get_chat_data(self, chat_confs: List[Conf]) -> List[Data]:
+    async def get_chat_data(self, chat_confs: List[Conf], delete_excess: bool = True) -> List[Data]:
         db_data = self.list_chats()
         chat_data_list = []
         logger.info(f"Creating {self.chat_type} data")
@@ -59,36 +72,71 @@ class ChatBuilder(ABC, Generic[Conf, Data]):
                 if matching_chat_data.is_complete():
                     chat_data_list.append(matching_chat_data)
                     continue
-            chat_data = await self.create_chat_data(conf)
+            with startup_tracer.span(f"Fetch {conf.handle}", "chat_entity", args={"handle": str(conf.handle)}):
+                chat_data = await self.create_chat_data(conf)
             chat_data_list.append(chat_data)
             self.database.save_chat(chat_data)
             os.makedirs(chat_data.directory, exist_ok=True)
-        logger.info(f"Deleting {self.chat_type}s")
-        self.delete_chats(db_data)
+        if delete_excess:
+            logger.info(f"Deleting {self.chat_type}s")
+            self.delete_chats(db_data)
         return chat_data_list
 
-    async def get_message_inits(
+    async def iter_message_inits(
             self,
             chat_confs: List[Conf],
             chat_data_list: List[Data]
-    ) -> List[List[Awaitable[Message]]]:
-        message_inits = []
-        total = len(chat_confs)
-        title = f"Listing {self.chat_type} messages"
-        for chat_conf, chat_data in tqdm(zip(chat_confs, chat_data_list), title, total=total):
-            new_inits = [
-                self.download_bottleneck.await_run(message_init)
-                for message_init
-                in await Chat.list_message_initialisers(chat_data, chat_conf, self.client, self.database)
-            ]
-            message_inits.append(new_inits)
-        return message_inits
+    ) -> AsyncIterator[StreamGroup[int, Message]]:
+        """
+        Lists the messages of each chat in turn, yielding a lazy group of message initialisers for each chat, keyed by
+        chat ID. The next chat is listed while messages of earlier chats are being created.
+        """
+        for chat_conf, chat_data in zip(chat_confs, chat_data_list):
+            snapshot_messages = None
+            if self.snapshot is not None:
+                snapshot_messages = self.snapshot.messages_for_chat(chat_data.chat_id)
+            with startup_tracer.span(f"List {chat_data.title}", "chat_listing", args={"chat_id": chat_data.chat_id}):
+                message_data_list = await Chat.list_message_data(
+                    chat_data,
+                    chat_conf,
+                    self.client,
+                    self.database,
+                    snapshot_messages,
+                )
+            download_priority = self.download_priority(chat_conf)
+            message_inits = (
+                self._create_message(chat_data, message_data, download_priority)
+                for message_data in message_data_list
+            )
+            yield StreamGroup(chat_data.chat_id, len(message_data_list), message_inits)
+
+    async def _create_message(
+            self,
+            chat_data: Data,
+            message_data: MessageData,
+            download_priority: DownloadPriority,
+    ) -> Message:
+        with startup_tracer.group_span(
+                f"create_messages_{chat_data.chat_id}",
+                f"Create messages {chat_data.title}",
+                "message_creation",
+                args={"chat_id": chat_data.chat_id},
+        ):
+            return await Chat.create_message(
+                message_data,
+                chat_data,
+                self.database,
+                self.media_downloader,
+                download_priority,
+            )
 
 
 class ChannelBuilder(ChatBuilder[ChannelConfig, ChannelData]):
     chat_type = "channel"
 
     def list_chats(self) -> List[ChannelData]:
+        if self.snapshot is not None:
+            return self.snapshot.list_chats(ChannelData)
         return self.database.list_channels()
 
     async def create_chat_data(self, chat_config: ChannelConfig) -> ChannelData:
@@ -99,7 +147,15 @@ class WorkshopBuilder(ChatBuilder[WorkshopConfig, WorkshopData]):
     chat_type = "workshop"
 
     def list_chats(self) -> List[WorkshopData]:
+        if self.snapshot is not None:
+            return self.snapshot.list_chats(WorkshopData)
         return self.database.list_workshops()
 
+    def download_priority(self, chat_config: WorkshopConfig) -> DownloadPriority:
+        # Videos in channel queues may be posted by the scheduler, so fetch them before other chats
+        if isinstance(chat_config, QueueConfig):
+            return DownloadPriority.SCHEDULE
+        return DownloadPriority.BACKGROUND
+
     async def create_chat_data(self, chat_config: WorkshopConfig) -> WorkshopData:
         return await self.client.get_workshop_data(chat_config.handle)
@@ -172,9 +172,14 @@ class ChatConfig(ABC):
             *,
             duplicate_detection: bool = True,
             default_destination: Optional[Union[str, int]] = None,
+            task_weight: float = 1,
     ):
+        if task_weight <= 0:
+            raise ValueError(f"Task weight must be positive, not {task_weight}")
         self.handle = handle
         self.duplicate_detection = duplicate_detection
+        # Share of task worker slots this chat gets, relative to other chats, when they are competing for them
+        self.task_weight = task_weight
         self.read_only = False
         self.twitter_config: Optional[TwitterConfig] = None
         self.caption_format = TextFormatter("")
@@ -250,6 +255,7 @@ class WorkshopConfig(ChatConfig):
             json_dict["handle"],
             duplicate_detection=json_dict.get("duplicate_detection", True),
             default_destination=json_dict.get("default_destination"),
+            task_weight=json_dict.get("task_weight", 1),
         )
 
 
@@ -260,12 +266,14 @@ class QueueConfig(WorkshopConfig):
             channel_handle: Union[str, int],
             *,
             duplicate_detection: bool = True,
-            schedule: ScheduleConfig = None
+            schedule: ScheduleConfig = None,
+            task_weight: float = 1,
     ):
         super().__init__(
             handle,
             duplicate_detection=duplicate_detection,
-            default_destination=channel_handle
+            default_destination=channel_handle,
+            task_weight=task_weight,
         )
         self.channel_handle = channel_handle
         self.schedule = schedule
@@ -280,5 +288,6 @@ class QueueConfig(WorkshopConfig):
             json_dict["handle"],
             channel_handle,
             duplicate_detection=json_dict.get("duplicate_detection", True),
-            schedule=schedule
+            schedule=schedule,
+            task_weight=json_dict.get("task_weight", 1),
         )
@@ -1,4 +1,5 @@
 import datetime
+import enum
 import logging
 import sqlite3
 from collections import defaultdict
@@ -13,6 +14,7 @@ import dateutil.parser
 
 from gif_pipeline.chat_data import ChatData, ChannelData, WorkshopData
 from gif_pipeline.message import MessageData
+from gif_pipeline.video_info import VideoInfo
 from gif_pipeline.video_tags import TagEntry, VideoTags
 
 chat_types = {
@@ -39,7 +41,8 @@ def message_data_from_row(row: sqlite3.Row) -> MessageData:
         row["reply_to"],
         row["sender_id"],
         bool(row["is_scheduled"]),
-        row["forwarded_channel_link"]
+        row["forwarded_channel_link"],
+        dateutil.parser.parse(row["edit_datetime"]) if row["edit_datetime"] else None,
     )
 
 
@@ -49,6 +52,11 @@ def parse_bool(db_bool: Optional[int]) -> Optional[int]:
     return bool(db_bool)
 
 
+class HashBacklogStatus(enum.Enum):
+    SKIPPED = "skipped"  # Not hashed on purpose, e.g. video is too long. Never retried
+    FAILED = "failed"  # Hashing failed, retried on later runs up to a maximum number of attempts
+
+
 @dataclass
 class MenuData:
     chat_id: int
@@ -70,6 +78,39 @@ class SubscriptionData:
     failures: int
 
 
+@dataclass
+class JobData:
+    job_id: int
+    job_type: str
+    job_key: str
+    payload: str
+    state: str
+    attempts: int
+    run_after: str
+    lease_expires: Optional[str]
+    result: str
+    error: Optional[str]
+    created_at: str
+    updated_at: str
+
+
+def job_data_from_row(row: sqlite3.Row) -> JobData:
+    return JobData(
+        row["job_id"],
+        row["job_type"],
+        row["job_key"],
+        row["payload"],
+        row["state"],
+        row["attempts"],
+        row["run_after"],
+        row["lease_expires"],
+        row["result"],
+        row["error"],
+        row["created_at"],
+        row["updated_at"],
+    )
+
+
 class Database:
     DB_FILE = "pipeline.sqlite"
 
@@ -84,6 +125,16 @@ class Database:
         directory = Path(__file__).parent
         with open(directory / "database_schema.sql", "r") as f:
             cur.executescript(f.read())
+        # Columns added since a table was first created are not added by the schema script
+        message_columns = {row["name"] for row in cur.execute("PRAGMA table_info(messages)")}
+        if "edit_datetime" not in message_columns:
+            cur.execute("ALTER TABLE messages ADD COLUMN edit_datetime text")
+        # Messages in workshops with duplicate detection disabled used to be skipped for good, so put them back in the
+        # hash backlog
+        cur.execute(
+            "DELETE FROM hash_backlog WHERE status = ? AND reason = ?",
+            (HashBacklogStatus.SKIPPED.value, "detection disabled")
+        )
         self.conn.commit()
 
     @contextmanager
@@ -169,11 +220,27 @@ class Database:
                 parse_bool(chat_row["megagroup"])
             )
 
+    def list_messages_by_entry_id(self, entry_id: Optional[int] = None) -> Dict[int, MessageData]:
+        messages = {}
+        query = (
+            "SELECT entry_id, chat_id, message_id, datetime, text, is_forward, "
+            "file_path, file_mime_type, file_size, reply_to, sender_id, is_scheduled, forwarded_channel_link, edit_datetime "
+            "FROM messages"
+        )
+        args = None
+        if entry_id is not None:
+            query += " WHERE entry_id = ?"
+            args = (entry_id,)
+        with self._execute(query, args) as result:
+            for row in result:
+                messages[row["entry_id"]] = message_data_from_row(row)
+        return messages
+
     def list_messages_for_chat(self, chat_data: ChatData) -> List[MessageData]:
         messages = []
         with self._execute(
                 "SELECT chat_id, message_id, datetime, text, is_forward, "
-                "file_path, file_mime_type, file_size, reply_to, sender_id, is_scheduled, forwarded_channel_link "
+                "file_path, file_mime_type, file_size, reply_to, sender_id, is_scheduled, forwarded_channel_link, edit_datetime "
                 "FROM messages WHERE chat_id = ?",
                 (chat_data.chat_id,)
         ) as result:
@@ -184,17 +251,17 @@ class Database:
     def save_message(self, message: MessageData) -> None:
         self._just_execute(
             "INSERT INTO messages (chat_id, message_id, datetime, text, is_forward, "
-            "file_path, file_mime_type, reply_to, sender_id, is_scheduled, forwarded_channel_link) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "file_path, file_mime_type, reply_to, sender_id, is_scheduled, forwarded_channel_link, edit_datetime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
             "ON CONFLICT(chat_id, message_id, is_scheduled) "
             "DO UPDATE SET datetime=excluded.datetime, text=excluded.text, is_forward=excluded.is_forward, "
             "file_path=excluded.file_path, file_mime_type=excluded.file_mime_type, "
             "reply_to=excluded.reply_to, sender_id=excluded.sender_id, "
-            "forwarded_channel_link=excluded.forwarded_channel_link",
+            "forwarded_channel_link=excluded.forwarded_channel_link, edit_datetime=excluded.edit_datetime",
             (
                 message.chat_id, message.message_id, message.datetime, message.text, message.is_forward,
                 message.file_path, message.file_mime_type, message.reply_to, message.sender_id, message.is_scheduled,
-                message.forwarded_channel_link
+                message.forwarded_channel_link, message.edit_datetime
             )
         )
 
@@ -291,8 +358,11 @@ class Database:
     def remove_message(self, message: MessageData) -> None:
         entry_id = self.get_entry_id_for_message(message)
         self._remove_message_hashes_by_entry_id(entry_id)
+        self._remove_hash_backlog_by_entry_id(entry_id)
         self._remove_tags_by_entry_id(entry_id)
         self._remove_menu_by_entry_id(entry_id)
+        if message.file_path is not None:
+            self.remove_video_info(message.file_path)
         self._just_execute(
             "DELETE FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ?",
             (message.chat_id, message.message_id, message.is_scheduled)
@@ -311,21 +381,42 @@ class Database:
                     hashes.append(row["hash"])
         return hashes
 
-    def get_messages_needing_hashing(self) -> List[MessageData]:
+    def get_messages_needing_hashing(self, max_attempts: int = 3) -> List[MessageData]:
         messages = []
         with self._execute(
                 "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
                 "m.file_path, m.file_mime_type, m.file_size, m.reply_to, m.sender_id, m.is_scheduled, "
-                "m.forwarded_channel_link "
+                "m.forwarded_channel_link, m.edit_datetime "
                 "FROM messages m "
                 "LEFT JOIN video_hashes vh ON m.entry_id = vh.entry_id "
+                "LEFT JOIN hash_backlog hb ON m.entry_id = hb.entry_id "
                 "WHERE vh.hash IS NULL AND m.file_path IS NOT NULL " # Messages with files, and without hashes
                 " AND m.file_mime_type <> 'image/jpeg'" # Skip photos
+                " AND (hb.status IS NULL OR (hb.status = ? AND hb.attempts < ?)) " # Skip given up backlog entries
+                "ORDER BY m.entry_id",
+                (HashBacklogStatus.FAILED.value, max_attempts)
         ) as result:
             for row in result:
                 messages.append(message_data_from_row(row))
         return messages
 
+    def save_hash_backlog_result(
+            self,
+            message: MessageData,
+            status: HashBacklogStatus,
+            reason: Optional[str] = None,
+    ) -> None:
+        entry_id = self.get_entry_id_for_message(message)
+        self._just_execute(
+            "INSERT INTO hash_backlog (entry_id, status, reason, attempts, last_attempt) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (entry_id) DO UPDATE SET status=excluded.status, reason=excluded.reason, "
+            "attempts=hash_backlog.attempts + 1, last_attempt=excluded.last_attempt",
+            (entry_id, status.value, reason, datetime.datetime.now(datetime.timezone.utc))
+        )
+
+    def _remove_hash_backlog_by_entry_id(self, entry_id: int) -> None:
+        self._just_execute("DELETE FROM hash_backlog WHERE entry_id = ?", (entry_id,))
+
     def get_messages_for_hashes(self, image_hashes: Set[str]) -> List[MessageData]:
         messages = defaultdict(lambda: {})
         # Chunk this up, as it will otherwise fail if there are too many hashes
@@ -334,7 +425,7 @@ class Database:
             with self._execute(
                     "SELECT DISTINCT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
                     "m.file_path, m.file_mime_type, m.file_size, m.reply_to, m.sender_id, m.is_scheduled, "
-                    "m.forwarded_channel_link "
+                    "m.forwarded_channel_link, m.edit_datetime "
                     "FROM video_hashes v "
                     "LEFT JOIN messages m on v.entry_id = m.entry_id "
                     f"WHERE v.hash IN ({','.join('?' * len(image_hash_list))}) AND m.datetime IS NOT NULL",
@@ -390,7 +481,7 @@ class Database:
                 ") "
                 "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
                 "  m.file_path, m.file_mime_type, m.file_size, m.reply_to, m.sender_id, m.is_scheduled, "
-                "  m.forwarded_channel_link "
+                "  m.forwarded_channel_link, m.edit_datetime "
                 "FROM parent p "
                 "LEFT JOIN messages m ON m.message_id = p.x "
                 "WHERE m.chat_id = :chat_id AND m.is_scheduled = :scheduled "
@@ -423,7 +514,7 @@ class Database:
                 ") "
                 "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward,"
                 "  m.file_path, m.file_mime_type, m.file_size, m.reply_to, m.sender_id, m.is_scheduled, "
-                "  m.forwarded_channel_link "
+                "  m.forwarded_channel_link, m.edit_datetime "
                 "FROM children c "
                 "LEFT JOIN messages m ON m.message_id = c.x "
                 "WHERE m.chat_id = :chat_id AND m.is_scheduled = :scheduled "
@@ -451,24 +542,30 @@ class Database:
         )
 
     def list_menus(self) -> List[MenuData]:
-        menu_data_entries = []
-        with self._execute(
-            "SELECT mm.chat_id, mm.message_id as menu_msg_id, vm.message_id as video_msg_id, "
+        return list(self.list_menus_by_entry_id().values())
+
+    def list_menus_by_entry_id(self, menu_entry_id: Optional[int] = None) -> Dict[int, MenuData]:
+        menu_data_entries = {}
+        query = (
+            "SELECT mc.menu_entry_id, mm.chat_id, mm.message_id as menu_msg_id, vm.message_id as video_msg_id, "
             "mc.menu_type, mc.menu_json_str, mc.clicked "
             "FROM menu_cache mc "
             "LEFT JOIN messages mm ON mm.entry_id = mc.menu_entry_id "
             "LEFT JOIN messages vm ON vm.entry_id = mc.video_entry_id"
-        ) as result:
+        )
+        args = None
+        if menu_entry_id is not None:
+            query += " WHERE mc.menu_entry_id = ?"
+            args = (menu_entry_id,)
+        with self._execute(query, args) as result:
             for row in result:
-                menu_data_entries.append(
-                    MenuData(
-                        row["chat_id"],
-                        row["video_msg_id"],
-                        row["menu_msg_id"],
-                        row["menu_type"],
-                        row["menu_json_str"],
-                        bool(row["clicked"])
-                    )
+                menu_data_entries[row["menu_entry_id"]] = MenuData(
+                    row["chat_id"],
+                    row["video_msg_id"],
+                    row["menu_msg_id"],
+                    row["menu_type"],
+                    row["menu_json_str"],
+                    bool(row["clicked"])
                 )
         return menu_data_entries
 
@@ -479,12 +576,17 @@ class Database:
     def _remove_menu_by_entry_id(self, menu_entry_id: int) -> None:
         self._just_execute("DELETE FROM menu_cache WHERE menu_entry_id = ?", (menu_entry_id,))
 
-    def list_subscriptions(self) -> List[SubscriptionData]:
+    def list_subscriptions(self, subscription_id: Optional[int] = None) -> List[SubscriptionData]:
         sub_entries = []
-        with self._execute(
+        query = (
             "SELECT subscription_id, feed_link, chat_id, last_check_time, check_rate, enabled, failures "
             "FROM subscriptions"
-        ) as result:
+        )
+        args = None
+        if subscription_id is not None:
+            query += " WHERE subscription_id = ?"
+            args = (subscription_id,)
+        with self._execute(query, args) as result:
             for row in result:
                 sub_entries.append(
                     SubscriptionData(
@@ -500,10 +602,13 @@ class Database:
         return sub_entries
 
     def list_item_ids_for_subscription(self, subscription: SubscriptionData) -> List[str]:
+        return self.list_item_ids_for_subscription_id(subscription.subscription_id)
+
+    def list_item_ids_for_subscription_id(self, subscription_id: int) -> List[str]:
         items = []
         with self._execute(
             "SELECT item_id FROM subscription_items WHERE subscription_id = ?",
-                (subscription.subscription_id, )
+                (subscription_id, )
         ) as result:
             for row in result:
                 items.append(row["item_id"])
@@ -573,6 +678,128 @@ class Database:
                 return
             return row["thumbnail"]
 
+    def get_video_info(self, file_path: str, file_size: int, mtime_ns: int) -> Optional[VideoInfo]:
+        with self._execute(
+            "SELECT duration, width, height, video_codec, audio_codec, bit_rate, fps, has_audio "
+            "FROM video_metadata WHERE file_path = ? AND file_size = ? AND mtime_ns = ?",
+            (file_path, file_size, mtime_ns)
+        ) as result:
+            row = next(result, None)
+            if row is None:
+                return None
+            return VideoInfo(
+                row["duration"],
+                row["width"],
+                row["height"],
+                row["video_codec"],
+                row["audio_codec"],
+                row["bit_rate"],
+                row["fps"],
+                bool(row["has_audio"]),
+            )
+
+    def save_video_info(self, file_path: str, file_size: int, mtime_ns: int, info: VideoInfo) -> None:
+        self._just_execute(
+            "INSERT INTO video_metadata "
+            "(file_path, file_size, mtime_ns, duration, width, height, video_codec, audio_codec, bit_rate, fps, "
+            "has_audio) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (file_path) DO UPDATE SET file_size=excluded.file_size, mtime_ns=excluded.mtime_ns, "
+            "duration=excluded.duration, width=excluded.width, height=excluded.height, "
+            "video_codec=excluded.video_codec, audio_codec=excluded.audio_codec, bit_rate=excluded.bit_rate, "
+            "fps=excluded.fps, has_audio=excluded.has_audio",
+            (
+                file_path, file_size, mtime_ns, info.duration, info.width, info.height, info.video_codec,
+                info.audio_codec, info.bit_rate, info.fps, info.has_audio
+            )
+        )
+
+    def remove_video_info(self, file_path: str) -> None:
+        self._just_execute("DELETE FROM video_metadata WHERE file_path = ?", (file_path,))
+
+    def add_job(self, job_type: str, job_key: str, payload: str, now: str) -> bool:
+        # A job which has already finished can be queued again with the same key, but a queued or running one is kept
+        with self._execute(
+            "INSERT INTO jobs (job_type, job_key, payload, state, attempts, run_after, result, created_at, updated_at)"
+            " VALUES (?, ?, ?, 'queued', 0, ?, '{}', ?, ?) ON CONFLICT (job_type, job_key)"
+            " DO UPDATE SET payload=excluded.payload, state='queued', attempts=0, run_after=excluded.run_after,"
+            " lease_expires=NULL, result='{}', error=NULL, created_at=excluded.created_at,"
+            " updated_at=excluded.updated_at"
+            " WHERE jobs.state IN ('done', 'failed')",
+            (job_type, job_key, payload, now, now, now)
+        ) as result:
+            return result.rowcount > 0
+
+    def list_runnable_jobs(self, job_type: str, now: str, limit: int) -> List[JobData]:
+        with self._execute(
+            "SELECT * FROM jobs WHERE job_type = ? AND state = 'queued' AND run_after <= ? ORDER BY job_id LIMIT ?",
+            (job_type, now, limit)
+        ) as result:
+            return [job_data_from_row(row) for row in result]
+
+    def list_expired_job_leases(self, now: str) -> List[JobData]:
+        with self._execute(
+            "SELECT * FROM jobs WHERE state = 'running' AND lease_expires < ?",
+            (now,)
+        ) as result:
+            return [job_data_from_row(row) for row in result]
+
+    def save_job(self, job: JobData) -> None:
+        self._just_execute(
+            "UPDATE jobs SET payload = ?, state = ?, attempts = ?, run_after = ?, lease_expires = ?, result = ?,"
+            " error = ?, updated_at = ? WHERE job_id = ?",
+            (
+                job.payload, job.state, job.attempts, job.run_after, job.lease_expires, job.result, job.error,
+                job.updated_at, job.job_id
+            )
+        )
+
+    def requeue_running_jobs(self) -> int:
+        with self._execute("UPDATE jobs SET state = 'queued', lease_expires = NULL WHERE state = 'running'") as result:
+            return result.rowcount
+
+    def count_jobs(self) -> Dict[Tuple[str, str], Tuple[int, Optional[str]]]:
+        """
+        Returns the number of jobs, and the creation time of the oldest, for each job type and state
+        """
+        with self._execute(
+            "SELECT job_type, state, COUNT(*) AS job_count, MIN(created_at) AS oldest FROM jobs GROUP BY job_type, state"
+        ) as result:
+            return {(row["job_type"], row["state"]): (row["job_count"], row["oldest"]) for row in result}
+
+    def prune_jobs(self, finished_before: str) -> None:
+        self._just_execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+            (finished_before,)
+        )
+
+    def get_latest_change_id(self) -> int:
+        # Read from the autoincrement sequence, so that the counter stays monotonic after changes are pruned
+        with self._execute("SELECT seq FROM sqlite_sequence WHERE name = 'db_changes'") as result:
+            row = next(result, None)
+            if row is None:
+                return 0
+            return row["seq"]
+
+    def get_oldest_change_id(self) -> int:
+        with self._execute("SELECT MIN(change_id) AS change_id FROM db_changes") as result:
+            row = next(result, None)
+            if row is None or row["change_id"] is None:
+                return self.get_latest_change_id() + 1
+            return row["change_id"]
+
+    def list_changes_since(self, change_id: int) -> List[Tuple[str, int]]:
+        changes = []
+        with self._execute(
+            "SELECT table_name, row_key FROM db_changes WHERE change_id > ? ORDER BY change_id",
+            (change_id,)
+        ) as result:
+            for row in result:
+                changes.append((row["table_name"], row["row_key"]))
+        return changes
+
+    def prune_changes(self, up_to_change_id: int) -> None:
+        self._just_execute("DELETE FROM db_changes WHERE change_id <= ?", (up_to_change_id,))
+
 
 S = TypeVar('S')
 
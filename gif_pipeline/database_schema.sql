@@ -36,7 +36,8 @@ create table if not exists messages
             on update restrict on delete restrict,
     sender_id      integer,
     is_scheduled   boolean not null,
-    forwarded_channel_link  text
+    forwarded_channel_link  text,
+    edit_datetime  text
 );
 
 create unique index if not exists messages_chat_id_message_id_is_scheduled_uindex
@@ -126,3 +127,138 @@ create table if not exists video_thumbnails
     thumbnail_timestamp real    not null,
     creation_time       text    not null
 );
+
+create table if not exists hash_backlog
+(
+    entry_id     integer not null
+        constraint hash_backlog_pk
+            primary key
+        constraint hash_backlog_messages_entry_id_fk
+            references messages,
+    status       text    not null,
+    reason       text,
+    attempts     integer not null default 0,
+    last_attempt text    not null
+);
+
+create table if not exists video_metadata
+(
+    file_path   text    not null
+        constraint video_metadata_pk
+            primary key,
+    file_size   integer not null,
+    mtime_ns    integer not null,
+    duration    real,
+    width       integer not null,
+    height      integer not null,
+    video_codec text,
+    audio_codec text,
+    bit_rate    integer,
+    fps         real,
+    has_audio   boolean not null
+);
+
+create table if not exists jobs
+(
+    job_id        integer not null
+        constraint jobs_pk
+            primary key autoincrement,
+    job_type      text    not null,
+    job_key       text    not null,
+    payload       text    not null,
+    state         text    not null,
+    attempts      integer not null default 0,
+    run_after     text    not null,
+    lease_expires text,
+    result        text    not null default '{}',
+    error         text,
+    created_at    text    not null,
+    updated_at    text    not null
+);
+
+create unique index if not exists jobs_type_key_uindex
+    on jobs (job_type, job_key);
+
+create table if not exists db_changes
+(
+    change_id  integer not null
+        constraint db_changes_pk
+            primary key autoincrement,
+    table_name text    not null,
+    row_key    integer not null
+);
+
+create trigger if not exists chats_insert_change after insert on chats
+begin
+    insert into db_changes (table_name, row_key) values ('chats', NEW.chat_id);
+end;
+
+create trigger if not exists chats_update_change after update on chats
+begin
+    insert into db_changes (table_name, row_key) values ('chats', NEW.chat_id);
+end;
+
+create trigger if not exists chats_delete_change after delete on chats
+begin
+    insert into db_changes (table_name, row_key) values ('chats', OLD.chat_id);
+end;
+
+create trigger if not exists messages_insert_change after insert on messages
+begin
+    insert into db_changes (table_name, row_key) values ('messages', NEW.entry_id);
+end;
+
+create trigger if not exists messages_update_change after update on messages
+begin
+    insert into db_changes (table_name, row_key) values ('messages', NEW.entry_id);
+end;
+
+create trigger if not exists messages_delete_change after delete on messages
+begin
+    insert into db_changes (table_name, row_key) values ('messages', OLD.entry_id);
+end;
+
+create trigger if not exists menu_cache_insert_change after insert on menu_cache
+begin
+    insert into db_changes (table_name, row_key) values ('menu_cache', NEW.menu_entry_id);
+end;
+
+create trigger if not exists menu_cache_update_change after update on menu_cache
+begin
+    insert into db_changes (table_name, row_key) values ('menu_cache', NEW.menu_entry_id);
+end;
+
+create trigger if not exists menu_cache_delete_change after delete on menu_cache
+begin
+    insert into db_changes (table_name, row_key) values ('menu_cache', OLD.menu_entry_id);
+end;
+
+create trigger if not exists subscriptions_insert_change after insert on subscriptions
+begin
+    insert into db_changes (table_name, row_key) values ('subscriptions', NEW.subscription_id);
+end;
+
+create trigger if not exists subscriptions_update_change after update on subscriptions
+begin
+    insert into db_changes (table_name, row_key) values ('subscriptions', NEW.subscription_id);
+end;
+
+create trigger if not exists subscriptions_delete_change after delete on subscriptions
+begin
+    insert into db_changes (table_name, row_key) values ('subscriptions', OLD.subscription_id);
+end;
+
+create trigger if not exists subscription_items_insert_change after insert on subscription_items
+begin
+    insert into db_changes (table_name, row_key) values ('subscription_items', NEW.subscription_id);
+end;
+
+create trigger if not exists subscription_items_update_change after update on subscription_items
+begin
+    insert into db_changes (table_name, row_key) values ('subscription_items', NEW.subscription_id);
+end;
+
+create trigger if not exists subscription_items_delete_change after delete on subscription_items
+begin
+    insert into db_changes (table_name, row_key) values ('subscription_items', OLD.subscription_id);
+end;
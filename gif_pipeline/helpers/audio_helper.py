@@ -1,12 +1,13 @@
 from typing import Optional, List
 
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import ChainOutputHelper, FilterGraph, ChainOutput
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 
 
-class AudioHelper(Helper):
+class AudioHelper(Helper, ChainOutputHelper):
     CMD_AUDIO = ["audio", "mp3"]
     CMD_VOICE = ["voice", "voice note"]
 
@@ -37,16 +38,39 @@ class AudioHelper(Helper):
                 voice_note=voice_note,
             )]
 
+    def is_chain_output(self, step: str) -> bool:
+        return step in self.CMD_VOICE + self.CMD_AUDIO
 
-def video_to_mp3(input_path: str, output_path: str) -> List[FfmpegTask]:
+    async def encode_chain(self, step: str, video_path: str, graph: FilterGraph) -> ChainOutput:
+        voice_note = step in self.CMD_VOICE
+        if voice_note:
+            output_path = random_sandbox_video_path("ogg")
+            tasks = video_to_voice_note(video_path, output_path, graph)
+        else:
+            output_path = random_sandbox_video_path("mp3")
+            tasks = video_to_mp3(video_path, output_path, graph)
+        for task in tasks:
+            await self.worker.await_task(task)
+        return ChainOutput(output_path, voice_note=voice_note)
+
+
+def _audio_filter_option(graph: Optional[FilterGraph]) -> str:
+    if graph is None or graph.audio_filter() is None:
+        return ""
+    return f"-filter:a \"{graph.audio_filter()}\" "
+
+
+def video_to_mp3(input_path: str, output_path: str, graph: Optional[FilterGraph] = None) -> List[FfmpegTask]:
     return [FfmpegTask(
-        inputs={input_path: None},
-        outputs={output_path: "-q:a 0 -map a"}
+        purpose="audio",
+        inputs={input_path: graph.input_options if graph else None},
+        outputs={output_path: _audio_filter_option(graph) + "-q:a 0 -map a"}
     )]
 
 
-def video_to_voice_note(input_path: str, output_path: str) -> List[FfmpegTask]:
+def video_to_voice_note(input_path: str, output_path: str, graph: Optional[FilterGraph] = None) -> List[FfmpegTask]:
     return [FfmpegTask(
-        inputs={input_path: None},
-        outputs={output_path: "-q:a 0 -map a -c:a libopus"}
+        purpose="audio",
+        inputs={input_path: graph.input_options if graph else None},
+        outputs={output_path: _audio_filter_option(graph) + "-q:a 0 -map a -c:a libopus"}
     )]
@@ -0,0 +1,41 @@
+from typing import Optional, List
+
+from gif_pipeline.chat import Chat, WorkshopGroup
+from gif_pipeline.helpers.helpers import Helper
+from gif_pipeline.message import Message
+from gif_pipeline.running_operations import operation_registry
+
+
+class CancelHelper(Helper):
+
+    async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
+        if not isinstance(chat, WorkshopGroup):
+            return None
+        text_clean = message.text.lower().strip()
+        if text_clean not in ["cancel", "stop"]:
+            return None
+        self.usage_counter.inc()
+        if message.message_data.reply_to is None:
+            error_text = "Reply to a command, or its progress message, to cancel it."
+            return [await self.send_text_reply(chat, message, error_text)]
+        operation = operation_registry.find(chat.chat_data.chat_id, message.message_data.reply_to)
+        if operation is None:
+            return [await self.send_text_reply(chat, message, "There is nothing running for that message to cancel.")]
+        operation.cancel()
+        return []
+
+    async def on_stateless_callback(
+            self,
+            callback_query: bytes,
+            chat: Chat,
+            message: Message,
+            sender_id: int,
+    ) -> Optional[List[Message]]:
+        if callback_query.decode() != self.CANCEL_CALLBACK:
+            return None
+        if message is None:
+            return []
+        operation = operation_registry.find(chat.chat_data.chat_id, message.message_data.message_id)
+        if operation is not None:
+            operation.cancel()
+        return []
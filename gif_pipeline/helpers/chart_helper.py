@@ -12,6 +12,7 @@ if TYPE_CHECKING:
     from gif_pipeline.tag_manager import TagManager
     from gif_pipeline.tasks.task_worker import TaskWorker
     from gif_pipeline.telegram_client import TelegramClient
+    from gif_pipeline.video_info import VideoInfoStore
 
 
 class ChartHelper(Helper):
@@ -21,10 +22,11 @@ class ChartHelper(Helper):
             database: "Database",
             client: "TelegramClient",
             worker: "TaskWorker",
+            video_info_store: "VideoInfoStore",
             pipeline: "Pipeline",
             tag_manager: "TagManager"
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.pipeline = pipeline
         self.tag_manager = tag_manager
 
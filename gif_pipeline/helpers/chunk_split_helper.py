@@ -1,28 +1,50 @@
 from __future__ import annotations
-from typing import Optional, List
+
+import asyncio
+import bisect
+import logging
+import os
+import shutil
+from typing import Optional, List, Tuple
 
 import isodate
+from prometheus_client import Counter
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
 from gif_pipeline.helpers.ffprobe_helper import FFProbeHelper
-from gif_pipeline.helpers.helpers import find_video_for_message, ordered_post_task
-from gif_pipeline.helpers.video_cut_helper import VideoCutHelper
+from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
+from gif_pipeline.helpers.smart_cut import VIDEO_ENCODERS, AUDIO_ENCODERS
+from gif_pipeline.media_backend import media_backend
 from gif_pipeline.message import Message
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
+from gif_pipeline.video_tags import VideoTags
+
+logger = logging.getLogger(__name__)
+
+chunk_split_runs = Counter(
+    "gif_pipeline_chunk_split_runs_total",
+    "Number of videos split into chunks, by whether they were stream copied, or encoded with forced keyframes",
+    labelnames=["mode"]
+)
 
 
-class ChunkSplitHelper(VideoCutHelper):
+class ChunkSplitHelper(Helper):
+    # How often to check for newly finished chunks to send, while the video is being split
+    CHUNK_POLL_SECONDS = 1
 
     def __init__(
             self,
             database: Database,
             client: TelegramClient,
             worker: TaskWorker,
+            video_info_store: VideoInfoStore,
             ffprobe_helper: FFProbeHelper,
     ) -> None:
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.ffprobe_helper = ffprobe_helper
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
@@ -67,14 +89,95 @@ class ChunkSplitHelper(VideoCutHelper):
             chunk_count = int(video_length // chunk_length) + 1
             if chunk_count == 1:
                 return [await self.send_text_reply(chat, message, "This video is shorter than that chunk length.")]
-            timestamps = [
-                (
-                    i*chunk_length if i != 0 else None,
-                    (i+1)*chunk_length if (i+1)*chunk_length <= video_length else None
+            stream_copy, split_options = await self.split_options(video_path, video_length, chunk_length)
+            chunk_split_runs.labels(mode="copy" if stream_copy else "encode").inc()
+            # Chunks are written to their own directory, which is removed once the split is done or cancelled, as sent
+            # videos are copied into the chat
+            chunk_dir = random_sandbox_video_path("").rstrip(".")
+            os.makedirs(chunk_dir)
+            try:
+                pattern = os.path.join(chunk_dir, "chunk_%04d.mp4")
+                list_path = os.path.join(chunk_dir, "chunks.txt")
+                task = FfmpegTask(
+                    purpose="chunk_split",
+                    inputs={video_path: None},
+                    outputs={pattern: f"{split_options} -segment_list {list_path} -segment_list_type flat"},
+                    duration=video_length,
                 )
-                for i in range(chunk_count)
-            ]
-            return await ordered_post_task(
-                [self.cut_video(video, start, end) for start, end in timestamps],
-                lambda path: self.send_video_reply(chat, message, path, video.tags(self.database))
-            )
+                tags = video.tags(self.database)
+                return await self.send_chunks_while_splitting(chat, message, task, list_path, tags)
+            finally:
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    async def split_options(self, video_path: str, video_length: float, chunk_length: float) -> Tuple[bool, str]:
+        """
+        Returns whether the video can be split without encoding, and the ffmpeg output options to split it. It can be
+        stream copied if there is already a keyframe at each chunk boundary, otherwise keyframes are forced there.
+        """
+        segment_options = f"-map 0:v:0 -map 0:a:0? -f segment -segment_time {chunk_length} -reset_timestamps 1 " \
+            "-segment_format_options movflags=+faststart"
+        video_info = await self.video_info_store.get(video_path)
+        # A keyframe within half a frame of a boundary is close enough to start the chunk
+        tolerance = 0.5 / (video_info.fps or 30)
+        copyable = video_info.video_codec in VIDEO_ENCODERS and (
+            not video_info.has_audio or video_info.audio_codec in AUDIO_ENCODERS
+        )
+        if copyable:
+            boundaries = [i * chunk_length for i in range(1, int(video_length // chunk_length) + 1)]
+            boundaries = [boundary for boundary in boundaries if boundary < video_length]
+            # Only the packets around each boundary are read, rather than the whole video
+            intervals = [(boundary - tolerance, boundary + tolerance) for boundary in boundaries]
+            try:
+                keyframes = await media_backend.keyframes(self.worker, video_path, intervals)
+            except Exception as e:
+                logger.warning("Failed to read keyframes of %s for chunk split", video_path, exc_info=e)
+                keyframes = []
+            if keyframes and all(self.has_keyframe_near(keyframes, b, tolerance) for b in boundaries):
+                return True, f"-c copy {segment_options} -segment_time_delta {tolerance}"
+        force_key_frames = f"-force_key_frames \"expr:gte(t,n_forced*{chunk_length})\""
+        return False, f"{force_key_frames} {segment_options}"
+
+    @staticmethod
+    def has_keyframe_near(keyframes: List[float], timestamp: float, tolerance: float) -> bool:
+        index = bisect.bisect_left(keyframes, timestamp - tolerance)
+        return index < len(keyframes) and keyframes[index] <= timestamp + tolerance
+
+    async def send_chunks_while_splitting(
+            self,
+            chat: Chat,
+            message: Message,
+            task: FfmpegTask,
+            list_path: str,
+            tags: VideoTags,
+    ) -> List[Message]:
+        """
+        Runs the split, and sends each chunk as soon as the segment muxer has finished writing it, rather than waiting
+        for the whole video to be split
+        """
+        split = asyncio.get_event_loop().create_task(self.worker.await_task(task))
+        chunk_dir = os.path.dirname(list_path)
+        replies = []
+        try:
+            while True:
+                # Check before reading the list, so that chunks written just before the split finished are not missed
+                split_done = split.done()
+                for chunk_name in self.finished_chunks(list_path)[len(replies):]:
+                    chunk_path = os.path.join(chunk_dir, chunk_name)
+                    replies.append(await self.send_video_reply(chat, message, chunk_path, tags))
+                if split_done:
+                    break
+                await asyncio.wait([split], timeout=self.CHUNK_POLL_SECONDS)
+            await split
+        finally:
+            if not split.done():
+                split.cancel()
+        return replies
+
+    @staticmethod
+    def finished_chunks(list_path: str) -> List[str]:
+        # The segment muxer adds each chunk to the list once it is complete, the last line may be partly written
+        if not os.path.exists(list_path):
+            return []
+        with open(list_path) as f:
+            lines = f.read().split("\n")
+        return [line for line in lines[:-1] if line]
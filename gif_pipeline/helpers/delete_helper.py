@@ -7,12 +7,20 @@ from gif_pipeline.menu_cache import SentMenu, MenuCache
 from gif_pipeline.message import Message, MessageData
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
 class DeleteHelper(Helper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker, menu_cache: 'MenuCache'):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            menu_cache: 'MenuCache',
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.menu_cache = menu_cache
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
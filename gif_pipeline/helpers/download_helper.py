@@ -10,6 +10,7 @@ from gif_pipeline.tasks.task import TaskException
 from gif_pipeline.tasks.update_youtube_dl_task import UpdateYoutubeDLTask
 from gif_pipeline.video_tags import VideoTags
 from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.video_info import VideoInfoStore
 from gif_pipeline.tasks.youtube_dl_task import YoutubeDLTask
 from gif_pipeline.telegram_client import TelegramClient
 
@@ -36,8 +37,14 @@ class DownloadHelper(Helper):
     # Query path:
     LINK_REGEX += r'(?:[^()\s[\]]*)'
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.yt_dl_checked = False
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
@@ -1,78 +1,170 @@
+import asyncio
 import logging
 import os
 import shutil
 from concurrent.futures.process import ProcessPoolExecutor
 from multiprocessing.pool import ThreadPool
-from typing import Optional, List, Set, Dict
+from typing import Optional, List, Set, Dict, AsyncIterator, TYPE_CHECKING
 
-from gif_pipeline.database import Database
+from prometheus_client import Gauge, Counter
+
+from gif_pipeline.database import Database, HashBacklogStatus
 from gif_pipeline.chat import WorkshopGroup, Chat
 from gif_pipeline.helpers.helpers import Helper
+from gif_pipeline.media_downloader import DownloadPriority
 from gif_pipeline.message import Message, MessageData
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
-from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
 from gif_pipeline.tasks.hash_dir_task import HashDirectoryTask
-from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import TaskWorker, task_priority, TaskPriority
 from gif_pipeline.telegram_client import TelegramClient
-from gif_pipeline.utils import tqdm_gather
+from gif_pipeline.utils import stream_gather, StreamGroup
+from gif_pipeline.video_info import VideoInfoStore
+
+if TYPE_CHECKING:
+    from gif_pipeline.pipeline import Pipeline
 
 
 logger = logging.getLogger(__name__)
 
+hash_backlog_total = Gauge(
+    "gif_pipeline_duplicate_hash_backlog_total",
+    "Number of messages which needed hashing when the hash backlog was started"
+)
+hash_backlog_remaining = Gauge(
+    "gif_pipeline_duplicate_hash_backlog_remaining",
+    "Number of messages left to process in the duplicate helper hash backlog"
+)
+hash_backlog_processed = Counter(
+    "gif_pipeline_duplicate_hash_backlog_processed_total",
+    "Number of messages processed by the duplicate helper hash backlog, by result",
+    labelnames=["result"]
+)
+for _result in ["hashed", *[status.value for status in HashBacklogStatus]]:
+    hash_backlog_processed.labels(result=_result)
+
 
 class DuplicateHelper(Helper):
     blank_frame_hash = "0000000000000000"
     MAX_AUTO_HASH_LENGTH_SECONDS = 60 * 10
+    MAX_BACKLOG_ATTEMPTS = 3
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            pipeline: "Pipeline",
+    ):
+        super().__init__(database, client, worker, video_info_store)
+        self.pipeline = pipeline
         self.hash_pool = ThreadPool(os.cpu_count())
         self.hash_pool_executor = ProcessPoolExecutor(os.cpu_count())
+        self.backlog_remaining: Optional[int] = None
+        hash_backlog_remaining.set_function(lambda: self.backlog_remaining or 0)
 
-    async def initialise_hashes(self, workshops: List[WorkshopGroup]):
-        # Initialise, get all channels, get all videos, decompose all, add to the master hash
-        workshop_ids = {workshop.chat_data.chat_id: workshop for workshop in workshops}
-        messages_needing_hashes = self.database.get_messages_needing_hashing()
-        await tqdm_gather(
-            [self.initialise_message(message_data, workshop_ids) for message_data in messages_needing_hashes],
-            desc="Hashing messages"
-        )
+    def backlog_note(self) -> Optional[str]:
+        if self.backlog_remaining is None:
+            return "The duplicate detector has not started hashing older videos yet, so this check may be incomplete."
+        if self.backlog_remaining > 0:
+            return (
+                f"The duplicate detector is still hashing {self.backlog_remaining} older videos, "
+                f"so this check may be incomplete."
+            )
+        return None
+
+    async def init_post_startup(self) -> None:
+        # The hash backlog runs in the background, so that it does not hold up startup
+        asyncio.get_event_loop().create_task(self.run_hash_backlog())
+        await super().init_post_startup()
+
+    async def run_hash_backlog(self) -> None:
+        # Get all videos without hashes, decompose them, and add them to the master hash. Progress is stored in the
+        # database as it goes, so an interrupted backlog continues from where it stopped on the next run.
+        with task_priority(TaskPriority.BACKGROUND):
+            messages_needing_hashes = self.database.get_messages_needing_hashing(self.MAX_BACKLOG_ATTEMPTS)
+            self.backlog_remaining = len(messages_needing_hashes)
+            hash_backlog_total.set(len(messages_needing_hashes))
+            logger.info("Duplicate helper hash backlog has %s messages", len(messages_needing_hashes))
+            chat_dict = {chat.chat_data.chat_id: chat for chat in self.pipeline.all_chats}
+
+            async def backlog_groups() -> AsyncIterator[StreamGroup[None, None]]:
+                yield StreamGroup(
+                    None,
+                    len(messages_needing_hashes),
+                    (self.process_backlog_message(message_data, chat_dict) for message_data in messages_needing_hashes),
+                )
+
+            # Enough messages are processed at once to fill the hash pool, and background priority keeps them behind
+            # user work
+            hash_concurrency = self.worker.pools[ResourceClass.HASH].size
+            async for _ in stream_gather(backlog_groups(), hash_concurrency, "Hash backlog"):
+                pass
+            logger.info("Duplicate helper hash backlog complete")
+
+    async def process_backlog_message(self, message_data: MessageData, chat_dict: Dict[int, Chat]) -> None:
+        try:
+            result = await self.initialise_message(message_data, chat_dict)
+        except Exception as e:
+            logger.error("Hash backlog failed to process message: %s", message_data, exc_info=e)
+            result = HashBacklogStatus.FAILED
+        hash_backlog_processed.labels(result=result.value if result else "hashed").inc()
+        self.backlog_remaining -= 1
+        if self.backlog_remaining % 100 == 0:
+            logger.info("Duplicate helper hash backlog has %s messages remaining", self.backlog_remaining)
 
-    async def initialise_message(self, message_data: MessageData, workshop_dict: Dict[int, WorkshopGroup]) -> None:
-        # Skip any messages in workshops which are disabled
-        workshop = workshop_dict.get(message_data.chat_id)
+    async def initialise_message(
+            self,
+            message_data: MessageData,
+            chat_dict: Dict[int, Chat],
+    ) -> Optional[HashBacklogStatus]:
+        chat = chat_dict.get(message_data.chat_id)
+        workshop = chat if isinstance(chat, WorkshopGroup) else None
+        # Skip any messages in workshops which are disabled, without recording it, so they are hashed if it is enabled
         if workshop is not None and not workshop.config.duplicate_detection:
-            return
+            return HashBacklogStatus.SKIPPED
+        # Wait for the video to be downloaded, if it has not been yet
+        message = chat.message_by_id(message_data.message_id) if chat is not None else None
+        if message is not None:
+            try:
+                await message.ensure_media(DownloadPriority.BACKGROUND)
+            except Exception:
+                self.database.save_hash_backlog_result(message_data, HashBacklogStatus.FAILED, "download failed")
+                raise
+            message_data = message.message_data
+        if not os.path.exists(message_data.file_path):
+            logger.warning("Could not find video file for hash backlog: %s", message_data)
+            self.database.save_hash_backlog_result(message_data, HashBacklogStatus.FAILED, "file missing")
+            return HashBacklogStatus.FAILED
         # Skip if the video is over the max length
-        length_task = FFprobeTask(
-            global_options=["-v error"],
-            inputs={message_data.file_path: "-show_entries format=duration -of default=noprint_wrappers=1:nokey=1"}
-        )
         try:
-            video_length = float(await self.worker.await_task(length_task))
+            video_length = float((await self.video_info_store.get(message_data.file_path)).duration)
         except:
             logger.warning("Could not get video length for hash check: %s", message_data)
-            return
+            self.database.save_hash_backlog_result(message_data, HashBacklogStatus.FAILED, "could not get length")
+            return HashBacklogStatus.FAILED
         if video_length > self.MAX_AUTO_HASH_LENGTH_SECONDS:
             logger.info("Skipping initialising video due to length: %s", message_data)
-            return
+            self.database.save_hash_backlog_result(message_data, HashBacklogStatus.SKIPPED, "too long")
+            return HashBacklogStatus.SKIPPED
         # Create hashes for message
         try:
             new_hashes = await self.create_message_hashes(message_data)
         except:
-            logger.error(f"Duplicate helper failed to check video during startup: {message_data}")
-            if workshop is not None:
-                message = workshop.message_by_id(message_data.message_id)
+            logger.error(f"Duplicate helper failed to check video in hash backlog: {message_data}")
+            self.database.save_hash_backlog_result(message_data, HashBacklogStatus.FAILED, "hashing failed")
+            if message is not None and workshop is not None:
                 await self.send_text_reply(
                     workshop,
                     message,
-                    "During startup, duplicate helper failed to check this video"
+                    "While hashing older videos, duplicate helper failed to check this video"
                 )
-            return
+            return HashBacklogStatus.FAILED
         # Send alerts for workshop messages
-        if workshop is not None:
-            message = workshop.message_by_id(message_data.message_id)
+        if message is not None and workshop is not None:
             await self.check_hash_in_store(workshop, new_hashes, message)
+        return None
 
     async def get_or_create_message_hashes(self, message_data: MessageData) -> Set[str]:
         existing_hashes = self.get_message_hashes(message_data)
@@ -154,6 +246,9 @@ class DuplicateHelper(Helper):
                 chat_data = self.database.get_chat_by_id(message.chat_id)
                 message_links.append(chat_data.telegram_link_for_message(message))
             warning_messages.append("This video might be a duplicate of:\n" + "\n".join(message_links))
+        backlog_note = self.backlog_note()
+        if backlog_note is not None:
+            warning_messages.append(backlog_note)
         return warning_messages
 
     async def post_duplicate_warning(
@@ -168,9 +263,11 @@ class DuplicateHelper(Helper):
 
     async def decompose_video(self, video_path: str, decompose_dir_path: str):
         task = FfmpegTask(
+            purpose="decompose",
             inputs={video_path: None},
             outputs={f"{decompose_dir_path}/out%d.png": "-vf fps=5 -vsync 0"},
-            global_options="-y"
+            global_options="-y",
+            resource_class=ResourceClass.HASH,
         )
         await self.worker.await_task(task)
 
@@ -193,9 +290,11 @@ class DuplicateHelper(Helper):
                     hashes = await self.get_or_create_message_hashes(reply_to.message_data)
                     warning_msg = await self.check_hash_in_store(chat, hashes, reply_to)
                     if warning_msg is None:
-                        return [
-                            await self.send_text_reply(chat, message, "That video does not match any other videos.")
-                        ]
+                        reply_text = "That video does not match any other videos."
+                        backlog_note = self.backlog_note()
+                        if backlog_note is not None:
+                            reply_text += "\n" + backlog_note
+                        return [await self.send_text_reply(chat, message, reply_text)]
                     return [warning_msg]
             return
         # If message has a video, decompose it if necessary, then check images against master hash
@@ -0,0 +1,107 @@
+from typing import Optional, List
+
+from gif_pipeline.chat import Chat
+from gif_pipeline.database import Database
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, ChainOutputHelper, FilterGraph, FilterNode, \
+    EditStepException, ChainOutput
+from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
+from gif_pipeline.message import Message
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
+
+
+class EditChainHelper(Helper):
+    """
+    Runs a chain of edits, such as `edit crop auto | cut 3 10 | speed 2 | gif`, as a single ffmpeg run. Each step is
+    compiled into a filter node by the helper which handles that command, and the nodes are joined into one
+    filtergraph, so the video is only decoded and encoded once.
+    """
+
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            filter_helpers: List[FilterNodeHelper],
+            output_helpers: List[ChainOutputHelper],
+    ):
+        super().__init__(database, client, worker, video_info_store)
+        self.filter_helpers = filter_helpers
+        self.output_helpers = output_helpers
+
+    async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
+        text_clean = message.text.strip().lower()
+        if text_clean.split(maxsplit=1)[:1] != ["edit"]:
+            return None
+        self.usage_counter.inc()
+        steps = [step.strip() for step in text_clean[len("edit"):].split("|")]
+        if any(not step for step in steps):
+            return [await self.send_text_reply(
+                chat,
+                message,
+                "Please give the edits to make, separated by `|`, in the format `edit crop auto | cut 3 10 | gif`"
+            )]
+        video = find_video_for_message(chat, message)
+        if video is None:
+            return [await self.send_text_reply(chat, message, "I'm not sure which video you would like to edit.")]
+        output_helper = self.output_helper(steps[-1])
+        output_step = None
+        if output_helper is not None:
+            output_step = steps.pop()
+        for step in steps:
+            if self.output_helper(step) is not None:
+                return [await self.send_text_reply(
+                    chat, message, f"`{step}` can only be the last step of an edit chain."
+                )]
+        video_path = video.message_data.file_path
+        async with self.progress_message(chat, message, "Applying edits in one encode"):
+            graph = FilterGraph()
+            try:
+                for step in steps:
+                    node = await self.filter_node(step, video_path, graph)
+                    if node is None:
+                        return [await self.send_text_reply(
+                            chat, message, f"I don't know how to do `{step}` as part of an edit chain."
+                        )]
+                    graph.append(node)
+            except EditStepException as e:
+                return [await self.send_text_reply(chat, message, f"Could not apply `{step}`: {e}")]
+            if output_helper is not None:
+                output = await output_helper.encode_chain(output_step, video_path, graph)
+            else:
+                output = ChainOutput(await self.encode_chain(video_path, graph))
+            return [await self.send_message(
+                chat,
+                reply_to_msg=message,
+                video_path=output.path,
+                tags=video.tags(self.database),
+                voice_note=output.voice_note,
+            )]
+
+    def output_helper(self, step: str) -> Optional[ChainOutputHelper]:
+        for helper in self.output_helpers:
+            if helper.is_chain_output(step):
+                return helper
+        return None
+
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        for helper in self.filter_helpers:
+            node = await helper.filter_node(step, video_path, graph)
+            if node is not None:
+                return node
+        return None
+
+    async def encode_chain(self, video_path: str, graph: FilterGraph) -> str:
+        output_path = random_sandbox_video_path()
+        input_duration = (await self.video_info_store.get(video_path)).duration
+        task = FfmpegTask(
+            purpose="edit_chain",
+            inputs={video_path: graph.input_options},
+            outputs={output_path: graph.output_options()},
+            duration=graph.output_duration(input_duration),
+        )
+        await self.worker.await_task(task)
+        return output_path
@@ -12,12 +12,19 @@ from gif_pipeline.message import Message
 from gif_pipeline.video_tags import VideoTags
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
 class FAHelper(TelegramGifHelper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         # Ignore messages the bot has sent.
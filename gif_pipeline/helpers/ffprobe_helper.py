@@ -4,6 +4,7 @@ from gif_pipeline.chat import Chat
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
+from gif_pipeline.tasks.task import TaskException
 
 
 class FFProbeHelper(Helper):
@@ -58,17 +59,10 @@ class FFProbeHelper(Helper):
         return await self.worker.await_task(probe_task)
 
     async def duration_video(self, video_path: str) -> float:
-        probe_task = FFprobeTask(
-            global_options=["-v error"],
-            inputs={video_path: "-show_entries format=duration -of default=noprint_wrappers=1:nokey=1"}
-        )
-        return float(await self.worker.await_task(probe_task))
-    
+        duration = (await self.video_info_store.get(video_path)).duration
+        if duration is None:
+            raise TaskException(f"Could not get duration of video: {video_path}")
+        return duration
+
     async def video_resolution(self, video_path: str) -> Tuple[int, int]:
-        probe_task = FFprobeTask(
-            global_options=["-v error"],
-            inputs={video_path: "-show_entries stream=width,height -of csv=p=0:s=x"}
-        )
-        resolution_str = await self.worker.await_task(probe_task)
-        resolution_split = resolution_str.split("x")
-        return int(resolution_split[0]), int(resolution_split[1])
+        return (await self.video_info_store.get(video_path)).resolution
@@ -0,0 +1,122 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+
+class EditStepException(Exception):
+    """
+    Raised when a step of an edit chain is meant for a helper, but its arguments cannot be understood. The message is
+    sent back to the user.
+    """
+    pass
+
+
+@dataclass
+class FilterNode:
+    """
+    One helper's transformation of a video, as ffmpeg filters which can be chained with other helpers' nodes
+    """
+    video_filters: List[str] = field(default_factory=list)
+    audio_filters: List[str] = field(default_factory=list)
+    # Start and end, in seconds, if the node only keeps a section of the video. When the node is first in a chain,
+    # this is done by seeking the input, instead of decoding and discarding everything before the start.
+    seek: Optional[Tuple[Optional[float], Optional[float]]] = None
+    # Length of the node's output, in seconds, given the length of its input, if the node changes it
+    duration: Optional[Callable[[float], float]] = None
+
+
+@dataclass
+class FilterGraph:
+    """
+    A chain of filter nodes, compiled into the options for a single ffmpeg run
+    """
+    input_options: Optional[str] = None
+    video_filters: List[str] = field(default_factory=list)
+    audio_filters: List[str] = field(default_factory=list)
+    duration_changes: List[Callable[[float], float]] = field(default_factory=list)
+
+    def append(self, node: FilterNode) -> None:
+        if node.duration is not None:
+            self.duration_changes.append(node.duration)
+        if node.seek is not None and self.is_empty():
+            start, end = node.seek
+            self.input_options = " ".join(
+                ([f"-ss {start}"] if start is not None else []) + ([f"-to {end}"] if end is not None else [])
+            )
+            return
+        self.video_filters += node.video_filters
+        self.audio_filters += node.audio_filters
+
+    def is_empty(self) -> bool:
+        return self.input_options is None and not self.video_filters and not self.audio_filters
+
+    def output_duration(self, input_duration: Optional[float]) -> Optional[float]:
+        """
+        Expected length of the chain's output, in seconds, from the length of the input video, if it is known
+        """
+        if input_duration is None:
+            return None
+        duration = input_duration
+        for duration_change in self.duration_changes:
+            duration = duration_change(duration)
+        return max(0.0, duration)
+
+    def video_filter(self, extra_filters: Optional[List[str]] = None) -> Optional[str]:
+        filters = self.video_filters + (extra_filters or [])
+        if not filters:
+            return None
+        return ",".join(filters)
+
+    def audio_filter(self) -> Optional[str]:
+        if not self.audio_filters:
+            return None
+        return ",".join(self.audio_filters)
+
+    def output_options(self, extra_video_filters: Optional[List[str]] = None, audio: bool = True) -> str:
+        options = []
+        video_filter = self.video_filter(extra_video_filters)
+        if video_filter is not None:
+            options.append(f"-filter:v \"{video_filter}\"")
+        if not audio:
+            options.append("-an")
+        elif self.audio_filters:
+            options.append(f"-filter:a \"{self.audio_filter()}\"")
+        else:
+            # Nothing in the chain changes the audio, so it does not need encoding again
+            options.append("-c:a copy")
+        return " ".join(options)
+
+
+@dataclass
+class ChainOutput:
+    path: str
+    voice_note: bool = False
+
+
+class FilterNodeHelper(ABC):
+    """
+    A helper whose transformation can be used as a step in an edit chain
+    """
+
+    @abstractmethod
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        """
+        Returns the filter node for a step of an edit chain, or None if the step is not for this helper. The graph of
+        the steps before it is given, for steps which need to inspect the video at that point.
+        Raises EditStepException if the step is for this helper, but its arguments are not valid.
+        """
+        pass
+
+
+class ChainOutputHelper(ABC):
+    """
+    A helper which can be the final step of an edit chain, deciding how the whole chain is encoded
+    """
+
+    @abstractmethod
+    def is_chain_output(self, step: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def encode_chain(self, step: str, video_path: str, graph: FilterGraph) -> ChainOutput:
+        pass
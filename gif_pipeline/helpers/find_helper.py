@@ -20,6 +20,7 @@ if TYPE_CHECKING:
     from gif_pipeline.message import Message
     from gif_pipeline.tasks.task_worker import TaskWorker
     from gif_pipeline.telegram_client import TelegramClient
+    from gif_pipeline.video_info import VideoInfoStore
 
 HASH_OPTIONS = vidhash.HashOptions(fps=5, settings=vidhash.hash_options.DHash(8))
 
@@ -54,10 +55,11 @@ class FindHelper(Helper):
             database: "Database",
             client: "TelegramClient",
             worker: "TaskWorker",
+            video_info_store: "VideoInfoStore",
             duplicate_helper: "DuplicateHelper",
             download_helper: "DownloadHelper"
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.duplicate_helper = duplicate_helper
         self.download_helper = download_helper
 
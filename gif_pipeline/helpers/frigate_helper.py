@@ -14,6 +14,7 @@ from gif_pipeline.helpers.helpers import Helper, random_video_path_with_cleanup
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 from gif_pipeline.video_tags import VideoTags
 
 logger = logging.getLogger(__name__)
@@ -27,10 +28,11 @@ class FrigateHelper(Helper):
             database: Database,
             client: TelegramClient,
             worker: TaskWorker,
+            video_info_store: VideoInfoStore,
             dl_helper: DownloadHelper,
             frigate_url: str,
     ) -> None:
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.dl_helper = dl_helper
         self.frigate_url = frigate_url
 
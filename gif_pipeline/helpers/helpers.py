@@ -1,12 +1,11 @@
 import asyncio
-import json
 import logging
 import os
 import shutil
 import uuid
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import Optional, List, Set, Callable, TypeVar, Awaitable, Generator
+from typing import Optional, List, Set, Callable, TypeVar, Awaitable, Generator, Dict
 
 from async_generator import asynccontextmanager
 from prometheus_client import Counter
@@ -17,11 +16,14 @@ from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat, WorkshopGroup
 from gif_pipeline.menu_cache import SentMenu
 from gif_pipeline.message import Message
-from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
-from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
+from gif_pipeline.tasks.ffmpeg_task import ProgressTracker, current_progress_tracker
+from gif_pipeline.media_backend import media_backend
+from gif_pipeline.running_operations import RunningOperation, operation_registry, current_operation, \
+    register_sandbox_path
 from gif_pipeline.video_tags import VideoTags
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient, message_data_from_telegram
+from gif_pipeline.video_info import VideoInfoStore
 
 usage_counter = Counter(
     "gif_pipeline_helper_usage_total",
@@ -45,7 +47,9 @@ def find_video_for_message(chat: Chat, message: Message) -> Optional[Message]:
 
 def random_sandbox_video_path(file_ext: str = "mp4") -> str:
     os.makedirs("sandbox", exist_ok=True)
-    return f"sandbox/{uuid.uuid4()}.{file_ext}"
+    file_path = f"sandbox/{uuid.uuid4()}.{file_ext}"
+    register_sandbox_path(file_path)
+    return file_path
 
 
 @contextmanager
@@ -101,11 +105,21 @@ def cleanup_file(file_path: str) -> None:
 class Helper(ABC):
     VIDEO_EXTENSIONS = ["mp4", "mov", "mkv", "webm", "avi", "wmv", "vob", "flv", "gifv", "mpeg"]
     AUDIO_EXTENSIONS = ["mp3", "wav", "ogg", "flac"]
+    # How often progress messages are edited to show encoding progress
+    PROGRESS_UPDATE_SECONDS = 10
+    CANCEL_CALLBACK = "cancel_task"
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
         self.database = database
         self.client = client
         self.worker = worker
+        self.video_info_store = video_info_store
         self.usage_counter = usage_counter.labels(class_name=self.__class__.__name__)
         self.post_startup_init_complete = False
 
@@ -115,6 +129,10 @@ class Helper(ABC):
     async def init_post_startup(self) -> None:
         self.post_startup_init_complete = True
 
+    def update_api_keys(self, api_keys: Dict[str, Dict[str, str]]) -> None:
+        # Called when config is reloaded, for helpers which use API keys
+        pass
+
     async def await_post_startup_complete(self, chat: Chat, message: Message) -> None:
         if not self.post_startup_init_complete:
             return
@@ -247,9 +265,28 @@ class Helper(ABC):
         if text is None:
             text = f"In progress. {self.name} is working on this."
         text = f"⏳ {text}"
-        msg = await self.send_text_reply(chat, message, text)
+        buttons = [[Button.inline("Cancel", self.CANCEL_CALLBACK)]]
+        msg = await self.send_text_reply(chat, message, text, buttons=buttons)
+        tracker = ProgressTracker()
+        tracker_token = current_progress_tracker.set(tracker)
+        operation = RunningOperation(
+            self.name,
+            chat.chat_data.chat_id,
+            [message.message_data.message_id, msg.message_data.message_id],
+            asyncio.current_task(),
+        )
+        operation_registry.add(operation)
+        operation_token = current_operation.set(operation)
+        updater = asyncio.get_event_loop().create_task(
+            self._update_progress_message(chat, msg, text, buttons, tracker)
+        )
         try:
             yield
+        except asyncio.CancelledError:
+            if operation.cancelled:
+                operation.cleanup()
+                await self.send_text_reply(chat, message, f"Cancelled. {self.name} has stopped working on this.")
+            raise
         except Exception as e:
             logger.error(
                 "Helper %s failed to process message %s in chat %s",
@@ -261,10 +298,35 @@ class Helper(ABC):
             await self.send_text_reply(chat, message, f"Command failed. {self.name} tried but failed to process this.")
             raise e
         finally:
+            updater.cancel()
+            operation_registry.remove(operation)
+            current_operation.reset(operation_token)
+            current_progress_tracker.reset(tracker_token)
             await self.client.delete_message(msg.message_data)
             chat.remove_message(msg.message_data)
             msg.delete(self.database)
 
+    async def _update_progress_message(
+            self,
+            chat: Chat,
+            msg: Message,
+            text: str,
+            buttons: List[List[Button]],
+            tracker: ProgressTracker,
+    ) -> None:
+        # Edits the progress message with the progress of any ffmpeg tasks, rate limited to avoid telegram flood waits
+        last_description = None
+        while True:
+            await asyncio.sleep(self.PROGRESS_UPDATE_SECONDS)
+            description = tracker.describe()
+            if description is None or description == last_description:
+                continue
+            last_description = description
+            try:
+                await self.client.edit_message(chat.chat_data, msg.message_data, f"{text}\n{description}", buttons)
+            except Exception as e:
+                logger.debug("Failed to update progress message", exc_info=e)
+
     @abstractmethod
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         pass
@@ -301,47 +363,21 @@ class Helper(ABC):
 
     async def _gather_video_metadata_attribute(self, video_path: str) -> Optional[DocumentAttributeVideo]:
         try:
-            metadata_task = FFprobeTask(
-                global_options=["-of json -v error"],
-                inputs={video_path: "-show_entries format=duration:stream=width,height,bit_rate,codec_type"}
-            )
-            metadata_str = await self.worker.await_task(metadata_task)
-            metadata_json = json.loads(metadata_str)
-            duration = float(metadata_json.get("format", {}).get("duration", "0"))
-            video_streams = [
-                stream for stream in metadata_json.get("streams", []) if stream.get("codec_type") == "video"
-            ]
-            width = 0
-            height = 0
-            if video_streams:
-                width = video_streams[0].get("width", 0)
-                height = video_streams[0].get("height", 0)
-            return DocumentAttributeVideo(int(duration), width, height)
+            video_info = await self.video_info_store.get(video_path)
+            return DocumentAttributeVideo(int(video_info.duration or 0), video_info.width, video_info.height)
         except Exception:
             return None
     
     async def _get_duration(self, video_path: str) -> Optional[float]:
         try:
-            probe_task = FFprobeTask(
-                global_options=["-v error"],
-                inputs={video_path: "-show_entries format=duration -of default=noprint_wrappers=1:nokey=1"}
-            )
-            return float(await self.worker.await_task(probe_task))
+            return (await self.video_info_store.get(video_path)).duration
         except Exception:
             return None
 
     async def _create_video_thumbnail(self, video_path: str) -> Optional[str]:
         try:
             thumb_path = random_sandbox_video_path("png")
-            thumb_task = FfmpegTask(
-                inputs={
-                    video_path: None,
-                },
-                outputs={
-                    thumb_path: "-ss 00:00:01.000 -vframes 1"
-                }
-            )
-            await self.worker.await_task(thumb_task)
+            await media_backend.grab_frame(self.worker, video_path, thumb_path, 1)
             if os.path.isfile(thumb_path):
                 return thumb_path
             return None
@@ -351,8 +387,14 @@ class Helper(ABC):
 
 class ArchiveHelper(Helper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         # If a message says to archive, move to archive channel
@@ -11,12 +11,20 @@ from gif_pipeline.message import Message
 from gif_pipeline.video_tags import VideoTags
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
 class ImgurGalleryHelper(Helper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker, imgur_client_id: str):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            imgur_client_id: str,
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.imgur_client_id = imgur_client_id
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional, Type, TYPE_CHECKING
+
+from prometheus_client import Gauge
+
+if TYPE_CHECKING:
+    from gif_pipeline.chat import Chat
+    from gif_pipeline.helpers.helpers import Helper
+    from gif_pipeline.menu_cache import SentMenu
+    from gif_pipeline.message import Message
+
+
+logger = logging.getLogger(__name__)
+
+helper_load_time = Gauge(
+    "gif_pipeline_lazy_helper_load_time_seconds",
+    "Time taken to import and construct a lazily loaded helper",
+    labelnames=["class_name"]
+)
+helper_loaded = Gauge(
+    "gif_pipeline_lazy_helper_loaded",
+    "Whether a lazily loaded helper has been imported and constructed yet",
+    labelnames=["class_name"]
+)
+
+
+class Trigger(ABC):
+    """
+    Decides, without importing the helper, whether a message could be one the helper wants to handle.
+    """
+
+    @abstractmethod
+    def matches(self, chat: Chat, message: Message) -> bool:
+        pass
+
+
+class CommandTrigger(Trigger):
+
+    def __init__(self, prefixes: List[str], *, ignore_spaces: bool = False) -> None:
+        self.prefixes = [prefix.lower() for prefix in prefixes]
+        self.ignore_spaces = ignore_spaces
+
+    def matches(self, chat: Chat, message: Message) -> bool:
+        text_clean = (message.text or "").strip().lower()
+        if self.ignore_spaces:
+            text_clean = text_clean.replace(" ", "")
+        return any(text_clean.startswith(prefix) for prefix in self.prefixes)
+
+
+class FirstWordTrigger(Trigger):
+    """
+    Matches messages whose first word is exactly one of the given words, as stricter helper checks, such as priority
+    checks, do.
+    """
+
+    def __init__(self, words: List[str]) -> None:
+        self.words = [word.lower() for word in words]
+
+    def matches(self, chat: Chat, message: Message) -> bool:
+        words = (message.text or "").strip().split(maxsplit=1)
+        return bool(words) and words[0].lower() in self.words
+
+
+class LazyHelper:
+    """
+    Stands in for a helper whose module is expensive to import, or which is expensive to construct. The helper module
+    is imported and the helper created the first time a message matches its trigger, or in the background once the
+    pipeline is running, whichever comes first. Until then, messages matching the priority trigger, if one is given,
+    are treated as priority messages for the helper, so it should be as strict as the helper's own priority check.
+    """
+
+    def __init__(
+            self,
+            module_name: str,
+            class_name: str,
+            trigger: Trigger,
+            factory: Callable[[Type[Helper]], Helper],
+            *,
+            priority_trigger: Optional[Trigger] = None,
+    ) -> None:
+        self.module_name = module_name
+        self.class_name = class_name
+        self.trigger = trigger
+        self.factory = factory
+        self.priority_trigger = priority_trigger
+        self.helper: Optional[Helper] = None
+        self._load_lock = asyncio.Lock()
+        helper_loaded.labels(class_name=class_name).set(0)
+
+    @property
+    def name(self) -> str:
+        return self.class_name
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.helper is not None
+
+    def _load_sync(self) -> Helper:
+        start_time = time.monotonic()
+        module = importlib.import_module(self.module_name)
+        helper_class = getattr(module, self.class_name)
+        helper = self.factory(helper_class)
+        duration = time.monotonic() - start_time
+        logger.info("Loaded lazy helper %s in %.2f seconds", self.class_name, duration)
+        helper_load_time.labels(class_name=self.class_name).set(duration)
+        helper_loaded.labels(class_name=self.class_name).set(1)
+        return helper
+
+    def load(self) -> Helper:
+        """
+        Loads the helper synchronously, for callers which need the helper object itself, such as menus.
+        """
+        if self.helper is None:
+            self.helper = self._load_sync()
+        return self.helper
+
+    async def load_async(self) -> Helper:
+        async with self._load_lock:
+            if self.helper is None:
+                # Imports are run in an executor, so that they do not block the event loop
+                loop = asyncio.get_event_loop()
+                self.helper = await loop.run_in_executor(None, self._load_sync)
+        return self.helper
+
+    async def init_pre_startup(self) -> None:
+        pass
+
+    async def init_post_startup(self) -> None:
+        helper = await self.load_async()
+        await helper.init_post_startup()
+
+    def is_priority(self, chat: Chat, message: Message) -> bool:
+        if self.helper is not None:
+            return self.helper.is_priority(chat, message)
+        return self.priority_trigger is not None and self.priority_trigger.matches(chat, message)
+
+    def can_handle(self, chat: Chat, message: Message) -> bool:
+        if self.helper is not None:
+            return self.helper.can_handle(chat, message)
+        return self.trigger.matches(chat, message)
+
+    async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
+        was_loaded = self.helper is not None
+        helper = await self.load_async()
+        # If the trigger was checked in place of the helper, check the helper agrees now that it is loaded
+        if not was_loaded and not (helper.is_priority(chat, message) or helper.can_handle(chat, message)):
+            return None
+        return await helper.on_new_message(chat, message)
+
+    async def on_deleted_message(self, chat: Chat, message: Message) -> None:
+        if self.helper is None:
+            return None
+        return await self.helper.on_deleted_message(chat, message)
+
+    async def on_callback_query(
+            self,
+            callback_query: bytes,
+            menu: SentMenu,
+            sender_id: int,
+    ) -> Optional[List[Message]]:
+        if self.helper is None:
+            return None
+        return await self.helper.on_callback_query(callback_query, menu, sender_id)
+
+    async def on_stateless_callback(
+            self,
+            callback_query: bytes,
+            chat: Chat,
+            message: Message,
+            sender_id: int,
+    ) -> Optional[List[Message]]:
+        if self.helper is None:
+            return None
+        return await self.helper.on_stateless_callback(callback_query, chat, message, sender_id)
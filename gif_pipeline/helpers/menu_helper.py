@@ -1,9 +1,12 @@
+from __future__ import annotations
+
+import asyncio
 import json
+from collections import defaultdict
 from datetime import datetime
 import logging
-from typing import Optional, List, Tuple, Set, TYPE_CHECKING
+from typing import Optional, List, Tuple, Set, Dict, TYPE_CHECKING
 
-from scenedetect import FrameTimecode
 from tqdm import tqdm
 
 from gif_pipeline.chat_config import TagType
@@ -22,16 +25,18 @@ from gif_pipeline.helpers.menus.tag_select_menu import TagSelectMenu
 from gif_pipeline.helpers.menus.check_tags_menu import CheckTagsMenu
 from gif_pipeline.helpers.menus.destination_menu import DestinationMenu
 from gif_pipeline.helpers.menus.not_gif_confirmation_menu import NotGifConfirmationMenu
-from gif_pipeline.helpers.scene_split_helper import SceneSplitHelper
 from gif_pipeline.helpers.send_helper import GifSendHelper
 from gif_pipeline.menu_cache import SentMenu
 from gif_pipeline.message import Message
 from gif_pipeline.tag_manager import TagManager
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 if TYPE_CHECKING:
+    from scenedetect import FrameTimecode
     from gif_pipeline.helpers.delete_helper import DeleteHelper
+    from gif_pipeline.helpers.scene_split_helper import SceneSplitHelper
     from gif_pipeline.pipeline import Pipeline
 
 
@@ -45,11 +50,12 @@ class MenuHelper(Helper):
             database: Database,
             client: TelegramClient,
             worker: TaskWorker,
+            video_info_store: VideoInfoStore,
             pipeline: 'Pipeline',
             delete_helper: 'DeleteHelper',
             tag_manager: TagManager,
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         # Cache of message ID the menu is replying to, to the menu
         self.pipeline = pipeline
         self.menu_cache = pipeline.menu_cache
@@ -89,9 +95,45 @@ class MenuHelper(Helper):
         return resp
 
     async def refresh_from_database(self) -> None:
-        list_menus = self.database.list_menus()
-        for menu_data in tqdm(list_menus, desc="Loading menus"):
-            sent_menu = await self.create_menu(menu_data)
+        if self.pipeline.snapshot is not None:
+            list_menus = self.pipeline.snapshot.list_menus()
+        else:
+            list_menus = self.database.list_menus()
+        menus_by_chat: Dict[int, List[MenuData]] = defaultdict(list)
+        for menu_data in list_menus:
+            menus_by_chat[menu_data.chat_id].append(menu_data)
+        with tqdm(total=len(list_menus), desc="Loading menus") as progress:
+            await asyncio.gather(*(
+                self.restore_chat_menus(chat_id, chat_menus, progress)
+                for chat_id, chat_menus in menus_by_chat.items()
+            ))
+
+    async def restore_chat_menus(self, chat_id: int, list_menus: List[MenuData], progress: tqdm) -> None:
+        chat = self.pipeline.chat_by_id(chat_id)
+        messages_by_id = {}
+        existing_ids = None
+        if chat is not None:
+            # Built in reverse, so that the first message with an ID wins, as with chat.message_by_id()
+            messages_by_id = {msg.message_data.message_id: msg for msg in reversed(chat.messages)}
+            # Check which menu messages still exist, with one request for the whole chat
+            try:
+                existing_ids = await self.client.list_existing_message_ids(
+                    chat_id,
+                    [menu_data.menu_msg_id for menu_data in list_menus]
+                )
+            except Exception as e:
+                logger.warning("Could not check menu messages still exist in chat %s", chat_id, exc_info=e)
+        # Menus whose message no longer exists in telegram resolve to None, and are removed
+        results = await asyncio.gather(*(
+            self.create_menu(menu_data, chat, messages_by_id)
+            if existing_ids is None or menu_data.menu_msg_id in existing_ids else asyncio.sleep(0)
+            for menu_data in list_menus
+        ), return_exceptions=True)
+        for menu_data, sent_menu in zip(list_menus, results):
+            progress.update(1)
+            if isinstance(sent_menu, Exception):
+                logger.error("Failed to restore menu: %s", menu_data, exc_info=sent_menu)
+                continue
             if sent_menu:
                 logger.info(f"Loaded menu: {sent_menu.menu.json_name()}")
                 self.menu_cache.add_menu(sent_menu)
@@ -101,14 +143,23 @@ class MenuHelper(Helper):
 
     async def create_menu(
             self,
-            menu_data: MenuData
+            menu_data: MenuData,
+            chat: Optional[Chat] = None,
+            messages_by_id: Optional[Dict[int, Message]] = None,
     ) -> Optional[SentMenu]:
         menu_json = json.loads(menu_data.menu_json_str)
-        chat = self.pipeline.chat_by_id(menu_data.chat_id)
-        menu_msg = chat.message_by_id(menu_data.menu_msg_id)
+        if chat is None:
+            chat = self.pipeline.chat_by_id(menu_data.chat_id)
+        if chat is None:
+            return None
+        if messages_by_id is None:
+            menu_msg = chat.message_by_id(menu_data.menu_msg_id)
+            video_msg = chat.message_by_id(menu_data.video_msg_id)
+        else:
+            menu_msg = messages_by_id.get(menu_data.menu_msg_id)
+            video_msg = messages_by_id.get(menu_data.video_msg_id)
         if menu_msg is None:
             return None
-        video_msg = chat.message_by_id(menu_data.video_msg_id)
         if video_msg is None:
             logger.info("Deleting menu referring to missing video")
             await self.delete_helper.delete_msg(chat, menu_msg.message_data)
@@ -153,7 +204,7 @@ class MenuHelper(Helper):
             menu = SendConfirmationMenu.from_json(menu_json, self, chat, video_msg, send_helper, channels)
             return SentMenu(menu, menu_msg, clicked)
         if menu_data.menu_type == SplitScenesConfirmationMenu.json_name():
-            split_helper = self.pipeline.helpers[SceneSplitHelper.__name__]
+            split_helper = self.pipeline.get_helper("SceneSplitHelper")
             menu = SplitScenesConfirmationMenu.from_json(menu_json, self, chat, video_msg, split_helper)
             return SentMenu(menu, menu_msg, clicked)
         if menu_data.menu_type == TagSelectMenu.json_name():
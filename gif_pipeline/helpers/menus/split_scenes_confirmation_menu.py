@@ -1,6 +1,7 @@
+from __future__ import annotations
+
 from typing import List, Tuple, Optional, TYPE_CHECKING, Dict
 
-from scenedetect import FrameTimecode
 from telethon import Button
 
 from gif_pipeline.chat import Chat
@@ -8,6 +9,7 @@ from gif_pipeline.helpers.menus.menu import Menu
 from gif_pipeline.message import Message
 
 if TYPE_CHECKING:
+    from scenedetect import FrameTimecode
     from gif_pipeline.helpers.scene_split_helper import SceneSplitHelper
     from gif_pipeline.helpers.menu_helper import MenuHelper
 
@@ -20,6 +22,8 @@ def timecode_to_json(timecode: FrameTimecode) -> Dict:
 
 
 def json_to_timecode(json_data: Dict) -> FrameTimecode:
+    # Imported here, as scenedetect is slow to import and only needed once a split menu is used
+    from scenedetect import FrameTimecode
     return FrameTimecode(
         json_data["frame_num"], json_data["framerate"]
     )
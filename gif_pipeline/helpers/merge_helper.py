@@ -4,10 +4,9 @@ from typing import Optional, List, Tuple
 
 from gif_pipeline.chat import Chat
 from gif_pipeline.helpers.helpers import Helper, random_sandbox_video_path
-from gif_pipeline.helpers.video_helper import video_has_audio_track_task, add_audio_track_task
+from gif_pipeline.helpers.video_helper import add_audio_track_task
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
-from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
 
 
 class MergeHelper(Helper):
@@ -106,9 +105,11 @@ class MergeHelper(Helper):
         filter_args = "".join([f"[{x}:v][{x}:a]" for x in range(num_files)]) + f" concat=n={num_files}:v=1:a=1 [v] [a]"
         output_args = f"-filter_complex \"{filter_args}\" -map \"[v]\" -map \"[a]\" -vsync 2"
         async with self.progress_message(chat, cmd_message, "Merging videos"):
+            await asyncio.gather(*[msg.ensure_media() for msg in messages_to_merge])
             file_paths = await self.align_video_dimensions([m.message_data.file_path for m in messages_to_merge])
             output_path = random_sandbox_video_path()
             task = FfmpegTask(
+                purpose="merge",
                 inputs={file_path: None for file_path in file_paths},
                 outputs={output_path: output_args}
             )
@@ -138,10 +139,7 @@ class MergeHelper(Helper):
         return output_paths
 
     async def get_video_dimensions(self, file_path: str) -> Tuple[int, int]:
-        task = FFprobeTask(
-            inputs={file_path: "-v error -show_entries stream=width,height -of csv=p=0:s=x"}
-        )
-        return tuple((await self.worker.await_task(task)).split("x"))
+        return (await self.video_info_store.get(file_path)).resolution
 
     async def scale_and_pad_to_dimensions(self, file_path: str, dimensions: Tuple[int, int]) -> str:
         orig_dimensions = await self.get_video_dimensions(file_path)
@@ -151,6 +149,7 @@ class MergeHelper(Helper):
         x, y = dimensions
         args = f"-vf \"scale={x}:{y}:force_original_aspect_ratio=decrease,pad={x}:{y}:(ow-iw)/2:(oh-ih)/2,setsar=1\""
         task = FfmpegTask(
+            purpose="merge_scale",
             inputs={file_path: None},
             outputs={output_path: args}
         )
@@ -158,8 +157,7 @@ class MergeHelper(Helper):
         return output_path
 
     async def with_audio_track(self, file_path: str) -> str:
-        audio_check_task = video_has_audio_track_task(file_path)
-        if not await self.worker.await_task(audio_check_task):
+        if not (await self.video_info_store.get(file_path)).has_audio:
             output_path = random_sandbox_video_path()
             await self.worker.await_task(add_audio_track_task(file_path, output_path))
             return output_path
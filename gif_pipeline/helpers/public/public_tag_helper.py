@@ -7,6 +7,7 @@ from gif_pipeline.database import Database
 from gif_pipeline.helpers.public.public_helpers import PublicHelper
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 if TYPE_CHECKING:
     from gif_pipeline.pipeline import Pipeline
@@ -14,8 +15,15 @@ if TYPE_CHECKING:
 
 class PublicTagHelper(PublicHelper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker, pipeline: "Pipeline"):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            pipeline: "Pipeline",
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.pipeline = pipeline
 
     async def on_new_message(self, message: Message):
@@ -10,14 +10,21 @@ from gif_pipeline.helpers.helpers import Helper, find_video_for_message
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 logger = logging.getLogger(__name__)
 
 
 class QRCodeReaderHelper(Helper):
 
-    def __init__(self, database: "Database", client: "TelegramClient", worker: TaskWorker) -> None:
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: "Database",
+            client: "TelegramClient",
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ) -> None:
+        super().__init__(database, client, worker, video_info_store)
         self.qreader = QReader()
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
@@ -0,0 +1,45 @@
+import logging
+from typing import Optional, List, TYPE_CHECKING
+
+from gif_pipeline.database import Database
+from gif_pipeline.chat import Chat, WorkshopGroup
+from gif_pipeline.helpers.helpers import Helper
+from gif_pipeline.message import Message
+from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
+
+if TYPE_CHECKING:
+    from gif_pipeline.pipeline import Pipeline
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReloadHelper(Helper):
+
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            pipeline: "Pipeline",
+    ):
+        super().__init__(database, client, worker, video_info_store)
+        self.pipeline = pipeline
+
+    async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
+        if not isinstance(chat, WorkshopGroup):
+            return None
+        text_clean = message.text.lower().strip()
+        if text_clean not in ["reload", "reload config"]:
+            return None
+        self.usage_counter.inc()
+        async with self.progress_message(chat, message, "Reloading config"):
+            try:
+                summary = await self.pipeline.reload_config()
+            except Exception as e:
+                logger.error("Failed to reload config", exc_info=e)
+                return [await self.send_text_reply(chat, message, f"Failed to reload config: {e}")]
+            return [await self.send_text_reply(chat, message, f"Config reloaded.\n{summary}")]
@@ -1,12 +1,13 @@
 from typing import Optional, List
 
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, FilterGraph, FilterNode
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 
 
-class ReverseHelper(Helper):
+class ReverseHelper(Helper, FilterNodeHelper):
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         clean_text = message.text.strip().lower()
         if clean_text != "reverse":
@@ -17,9 +18,15 @@ class ReverseHelper(Helper):
             return [await self.send_text_reply(chat, message, "Please reply to the video you want to reverse")]
         output_path = random_sandbox_video_path()
         reverse_task = FfmpegTask(
+            purpose="reverse",
             inputs={video.message_data.file_path: None},
             outputs={output_path: "-vf reverse -af areverse"}
         )
         async with self.progress_message(chat, message, "Reversing video"):
             await self.worker.await_task(reverse_task)
             return [await self.send_video_reply(chat, message, output_path, video.tags(self.database))]
+
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        if step != "reverse":
+            return None
+        return FilterNode(video_filters=["reverse"], audio_filters=["areverse"])
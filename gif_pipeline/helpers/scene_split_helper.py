@@ -11,6 +11,7 @@ from gif_pipeline.helpers.video_cut_helper import VideoCutHelper
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 if TYPE_CHECKING:
     from gif_pipeline.helpers.menu_helper import MenuHelper
@@ -18,8 +19,15 @@ if TYPE_CHECKING:
 
 class SceneSplitHelper(VideoCutHelper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker, menu_helper: MenuHelper):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+            menu_helper: MenuHelper,
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.menu_helper = menu_helper
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
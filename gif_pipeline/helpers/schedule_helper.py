@@ -9,6 +9,8 @@ from gif_pipeline.chat import Chat, Channel
 from gif_pipeline.chat_config import ScheduleOrder
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message
 from gif_pipeline.helpers.menus.schedule_reminder_menu import ScheduleReminderMenu, next_video_from_list
+from gif_pipeline.media_downloader import DownloadPriority
+from gif_pipeline.tasks.task_worker import task_priority, TaskPriority
 
 if TYPE_CHECKING:
     from gif_pipeline.database import Database
@@ -19,6 +21,7 @@ if TYPE_CHECKING:
     from gif_pipeline.tag_manager import TagManager
     from gif_pipeline.tasks.task_worker import TaskWorker
     from gif_pipeline.telegram_client import TelegramClient
+    from gif_pipeline.video_info import VideoInfoStore
 
 
 logger = logging.getLogger(__name__)
@@ -117,13 +120,14 @@ class ScheduleHelper(Helper):
             database: 'Database',
             client: 'TelegramClient',
             worker: 'TaskWorker',
+            video_info_store: 'VideoInfoStore',
             channels: List['Channel'],
             menu_helper: 'MenuHelper',
             send_helper: 'GifSendHelper',
             delete_helper: 'DeleteHelper',
             tag_manager: 'TagManager'
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.channels = channels
         self.menu_helper = menu_helper
         self.menu_cache = menu_helper.menu_cache
@@ -219,12 +223,13 @@ class ScheduleHelper(Helper):
         )
 
     async def scheduler(self):
-        while True:
-            try:
-                await self.check_channels()
-            except Exception as e:
-                logger.error("Failed to check channels, due to exception: ", exc_info=e)
-            await asyncio.sleep(self.CHECK_DELAY)
+        with task_priority(TaskPriority.SCHEDULED_POST):
+            while True:
+                try:
+                    await self.check_channels()
+                except Exception as e:
+                    logger.error("Failed to check channels, due to exception: ", exc_info=e)
+                await asyncio.sleep(self.CHECK_DELAY)
 
     async def check_channels(self) -> Optional[List['Message']]:
         logger.info("Checking channel queues")
@@ -240,6 +245,7 @@ class ScheduleHelper(Helper):
                 menu = sent_menu.menu
                 if datetime.now(timezone.utc) > menu.post_time:
                     if menu.auto_post:
+                        await menu.video.ensure_media(DownloadPriority.SCHEDULE)
                         tags = menu.video.tags(self.database)
                         hashes = set(self.database.get_hashes_for_message(menu.video.message_data))
                         chan_msg = [await self.send_message(
@@ -4,17 +4,17 @@ import logging
 import shutil
 from typing import Optional, List, Union, TYPE_CHECKING, Set, Dict
 
-import tweepy
-
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat, Channel
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient, message_data_from_telegram
+from gif_pipeline.video_info import VideoInfoStore
 from gif_pipeline.video_tags import VideoTags
 
 if TYPE_CHECKING:
+    import tweepy
     from gif_pipeline.helpers.menu_helper import MenuHelper
     from gif_pipeline.chat_config import TwitterAccountConfig
 
@@ -32,15 +32,19 @@ class GifSendHelper(Helper):
             database: Database,
             client: TelegramClient,
             worker: TaskWorker,
+            video_info_store: VideoInfoStore,
             channels: List[Channel],
             menu_helper: MenuHelper,
             twitter_keys: Optional[Dict[str, str]] = None
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.channels = channels
         self.menu_helper = menu_helper
         self.twitter_keys = twitter_keys or {}
 
+    def update_api_keys(self, api_keys: Dict[str, Dict[str, str]]) -> None:
+        self.twitter_keys = api_keys.get("twitter", {})
+
     @property
     def writable_channels(self) -> List[Channel]:
         return [channel for channel in self.channels if not channel.config.read_only]
@@ -147,6 +151,7 @@ class GifSendHelper(Helper):
             error_text = "You need to be an admin of both channels to send a forwarded video."
             return [await self.send_text_reply(chat, cmd_msg, error_text)]
         # Send initial message
+        await video.ensure_media()
         tags = video.tags(self.database)
         hashes = set(self.database.get_hashes_for_message(video.message_data))
         initial_message = await self.send_message(
@@ -177,6 +182,7 @@ class GifSendHelper(Helper):
         if not await self.client.user_can_post_in_chat(sender_id, destination.chat_data):
             await self.menu_helper.delete_menu_for_video(chat, video)
             return [await self.send_text_reply(chat, cmd, "You do not have permission to post in that channel.")]
+        await video.ensure_media()
         tags = video.tags(self.database)
         hashes = set(self.database.get_hashes_for_message(video.message_data))
         caption = destination.config.caption_format.format(tags)
@@ -284,6 +290,8 @@ class GifSendHelper(Helper):
         return twitter_link
 
     def get_twitter_api(self, account_config: TwitterAccountConfig) -> tweepy.API:
+        # Imported here, as tweepy is only needed by channels which post to twitter
+        import tweepy
         auth = tweepy.OAuthHandler(self.twitter_keys["consumer_key"], self.twitter_keys["consumer_secret"])
         auth.set_access_token(account_config.access_token, account_config.access_secret)
         api = tweepy.API(auth)
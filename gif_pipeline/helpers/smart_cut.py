@@ -0,0 +1,218 @@
+import logging
+import os
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import Optional, List, Tuple, Dict
+
+import ffmpy3
+from prometheus_client import Counter
+
+from gif_pipeline.helpers.helpers import random_video_path_with_cleanup
+from gif_pipeline.media_backend import media_backend
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.task import TaskException
+from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.video_info import VideoInfoStore
+
+logger = logging.getLogger(__name__)
+
+smart_cuts = Counter(
+    "gif_pipeline_smart_cuts_total",
+    "Number of video cuts, by whether most of the video was stream copied, or the reason it had to be fully encoded",
+    labelnames=["result"]
+)
+
+# Encoders which give output that can be joined to a stream copy of each codec
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+# Encoder profile names, by ffprobe's profile names for each codec, so that the encoded parts match the copied parts
+VIDEO_PROFILES = {
+    "h264": {
+        "Constrained Baseline": "baseline",
+        "Baseline": "baseline",
+        "Main": "main",
+        "High": "high",
+        "High 10": "high10",
+        "High 4:2:2": "high422",
+        "High 4:4:4 Predictive": "high444",
+    },
+    "hevc": {"Main": "main", "Main 10": "main10", "Main Still Picture": "mainstillpicture"},
+}
+AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame"}
+# How far from each cut point, into the cut, to look for a keyframe
+KEYFRAME_SEARCH_SECONDS = 30
+# If less than this much video can be stream copied, a full encode is simpler and barely slower
+MIN_COPY_SECONDS = 2
+MAP_OPTIONS = "-map 0:v:0 -map 0:a:0?"
+
+
+@dataclass
+class SmartCutPlan:
+    """
+    A cut, split into partial GOPs at the start and end, which must be encoded, and whole GOPs between them, which
+    can be stream copied.
+    """
+    start: Optional[float]
+    copy_start: float
+    copy_end: Optional[float]
+    end: Optional[float]
+
+    @property
+    def has_head(self) -> bool:
+        return self.start is not None and self.start < self.copy_start
+
+    @property
+    def has_tail(self) -> bool:
+        return self.copy_end is not None and (self.end is None or self.copy_end < self.end)
+
+
+def plan_smart_cut(keyframes: List[float], start: Optional[float], end: Optional[float]) -> Optional[SmartCutPlan]:
+    """
+    Works out which section of the cut can be stream copied, from the keyframes around the cut points. Returns None if
+    too little of it can be copied.
+    """
+    if start is None:
+        copy_start = 0.0
+    else:
+        copy_start = next((k for k in keyframes if k >= start), None)
+        if copy_start is None:
+            return None
+    copy_end = None
+    if end is not None:
+        copy_end = next((k for k in reversed(keyframes) if k <= end), None)
+        if copy_end is None or copy_end - copy_start < MIN_COPY_SECONDS:
+            return None
+    return SmartCutPlan(start, copy_start, copy_end, end)
+
+
+def source_match_options(codec: str, video_stream: Dict) -> str:
+    """
+    Encoder options giving the source video stream's pixel format, profile and level, as far as they are known, so
+    that the encoded parts of a smart cut can be decoded with the same decoder setup as the copied parts.
+    """
+    options = []
+    pix_fmt = video_stream.get("pix_fmt")
+    if pix_fmt:
+        options.append(f"-pix_fmt {pix_fmt}")
+    profile = VIDEO_PROFILES[codec].get(video_stream.get("profile"))
+    if profile is not None:
+        options.append(f"-profile:v {profile}")
+    level = video_stream.get("level")
+    if isinstance(level, int) and level >= 10:
+        if codec == "h264":
+            # ffprobe gives h264 levels as ten times the level number
+            options.append(f"-level {level / 10:g}")
+        else:
+            # and HEVC levels as thirty times the level number
+            options.append(f"-x265-params level-idc={level / 30:g}")
+    return " ".join(options)
+
+
+def seek_options(start: Optional[float], end: Optional[float]) -> str:
+    return " ".join(([f"-ss {start}"] if start is not None else []) + ([f"-to {end}"] if end is not None else []))
+
+
+async def smart_cut(
+        worker: TaskWorker,
+        video_info_store: VideoInfoStore,
+        video_path: str,
+        output_path: str,
+        start: Optional[float],
+        end: Optional[float],
+) -> bool:
+    """
+    Cuts a video by stream copying the whole GOPs inside the cut, and only encoding the partial GOPs at either end,
+    then joining them. Returns False, without writing the output, if the video's codecs or keyframes do not allow it,
+    in which case the cut needs a full encode.
+    """
+    return await smart_cut_segments(worker, video_info_store, video_path, output_path, [(start, end)])
+
+
+async def smart_cut_segments(
+        worker: TaskWorker,
+        video_info_store: VideoInfoStore,
+        video_path: str,
+        output_path: str,
+        segments: List[Tuple[Optional[float], Optional[float]]],
+) -> bool:
+    """
+    Joins the given (start, end) segments of a video, cutting each as smart_cut does. Segments without whole GOPs to
+    copy are encoded in full. Returns False, without writing the output, if nothing can be stream copied, or the
+    video's codecs do not allow it.
+    """
+    video_info = await video_info_store.get(video_path)
+    video_encoder = VIDEO_ENCODERS.get(video_info.video_codec)
+    audio_encoder = AUDIO_ENCODERS.get(video_info.audio_codec) if video_info.has_audio else None
+    if video_encoder is None or (video_info.has_audio and audio_encoder is None):
+        smart_cuts.labels(result="unsupported_codec").inc()
+        return False
+    # The first keyframe after each start, and the last keyframe before each end, are needed
+    intervals = []
+    for start, end in segments:
+        if start is not None:
+            intervals.append((start, start + KEYFRAME_SEARCH_SECONDS))
+        if end is not None:
+            intervals.append((end - KEYFRAME_SEARCH_SECONDS, end))
+    try:
+        # Copies can only start and end cleanly at keyframes which start a closed GOP, such as IDR frames
+        keyframes = await media_backend.keyframes(worker, video_path, intervals, closed_gop=True)
+        probe = await media_backend.probe(worker, video_path)
+    except Exception as e:
+        logger.warning("Failed to read keyframes or streams of %s for smart cut", video_path, exc_info=e)
+        smart_cuts.labels(result="keyframe_error").inc()
+        return False
+    video_stream = next((s for s in probe.get("streams", []) if s.get("codec_type") == "video"), {})
+    plans = [plan_smart_cut(keyframes, start, end) for start, end in segments]
+    if all(plan is None for plan in plans):
+        smart_cuts.labels(result="too_few_keyframes").inc()
+        return False
+    copy_options = f"{MAP_OPTIONS} -c copy"
+    encode_options = f"{MAP_OPTIONS} -c:v {video_encoder} -crf 18 -preset veryfast"
+    match_options = source_match_options(video_info.video_codec, video_stream)
+    if match_options:
+        encode_options += f" {match_options}"
+    if audio_encoder is not None:
+        encode_options += f" -c:a {audio_encoder}"
+    with ExitStack() as stack:
+        # MPEG-TS parts carry codec parameters in band, so the encoded parts can differ from the copied parts. The parts
+        # are joined even if there is only a copied part, to remux it back to mp4.
+        parts = []
+        tasks = []
+
+        def add_part(part_start: Optional[float], part_end: Optional[float], options: str, purpose: str) -> None:
+            parts.append(stack.enter_context(random_video_path_with_cleanup("ts")))
+            tasks.append(FfmpegTask(
+                purpose=purpose,
+                inputs={video_path: seek_options(part_start, part_end)},
+                outputs={parts[-1]: options},
+            ))
+
+        for (start, end), plan in zip(segments, plans):
+            if plan is None:
+                add_part(start, end, encode_options, "smart_cut_edge")
+                continue
+            if plan.has_head:
+                add_part(plan.start, plan.copy_start, encode_options, "smart_cut_edge")
+            add_part(plan.copy_start if start is not None else None, plan.copy_end, copy_options, "smart_cut_copy")
+            if plan.has_tail:
+                add_part(plan.copy_end, plan.end, encode_options, "smart_cut_edge")
+        try:
+            await worker.await_tasks(tasks)
+            inputs_file = stack.enter_context(random_video_path_with_cleanup("txt"))
+            with open(inputs_file, "w") as f:
+                f.write("\n".join(f"file '{os.path.basename(part)}'" for part in parts))
+            audio_options = " -bsf:a aac_adtstoasc" if audio_encoder == "aac" else ""
+            # HEVC in mp4 needs the hvc1 tag, rather than ffmpeg's default of hev1, to play on Apple devices
+            video_options = " -tag:v hvc1" if video_info.video_codec == "hevc" else ""
+            await worker.await_task(FfmpegTask(
+                purpose="smart_cut_concat",
+                inputs={inputs_file: "-safe 0 -f concat"},
+                outputs={output_path: f"-map 0 -c copy{video_options}{audio_options} -movflags faststart"},
+            ))
+        except (TaskException, ffmpy3.FFRuntimeError) as e:
+            logger.warning("Smart cut of %s failed, falling back to a full encode", video_path, exc_info=e)
+            smart_cuts.labels(result="failed").inc()
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return False
+    smart_cuts.labels(result="smart").inc()
+    return True
@@ -19,6 +19,7 @@ class StabiliseHelper(Helper):
         output_path = random_sandbox_video_path()
         async with self.progress_message(chat, message, "Stabilising video"):
             task = FfmpegTask(
+                purpose="stabilise",
                 inputs={video.message_data.file_path: None},
                 outputs={output_path: "-vf deshake"}
             )
@@ -21,16 +21,21 @@ from gif_pipeline.helpers.subscriptions.twitter_subscription import TwitterSubsc
 from gif_pipeline.helpers.subscriptions.unitialised_subscription import UninitialisedSubscription
 from gif_pipeline.helpers.subscriptions.youtube_dl_subscription import YoutubeDLSubscription
 from gif_pipeline.helpers.video_helper import video_to_video
+from gif_pipeline.job_queue import JobFailedException
 from gif_pipeline.message import Message
+from gif_pipeline.tasks.task_worker import task_priority, TaskPriority, task_tenant
 from gif_pipeline.video_tags import VideoTags
 
 if TYPE_CHECKING:
     from gif_pipeline.database import Database
+    from gif_pipeline.job_queue import Job
     from gif_pipeline.helpers.duplicate_helper import DuplicateHelper
     from gif_pipeline.helpers.download_helper import DownloadHelper
     from gif_pipeline.tasks.task_worker import TaskWorker
     from gif_pipeline.telegram_client import TelegramClient
+    from gif_pipeline.video_info import VideoInfoStore
     from gif_pipeline.pipeline import Pipeline
+    from gif_pipeline.snapshot import PipelineSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -66,36 +71,35 @@ class SubscriptionHelper(Helper):
     CHECK_DELAY = 60
     NAMES = ["subscribe", "sub", "subs", "subscription", "subscriptions"]
     MAX_AUTO_MP4_LENGTH_SECONDS = 60 * 20
+    POST_JOB_TYPE = "subscription_post"
 
     def __init__(
             self,
             database: "Database",
             client: "TelegramClient",
             worker: "TaskWorker",
+            video_info_store: "VideoInfoStore",
             pipeline: "Pipeline",
             duplicate_helper: "DuplicateHelper",
             download_helper: "DownloadHelper",
             ffprobe_helper: "FFProbeHelper",
             api_keys: Dict[str, Dict[str, str]]
     ):
-        super().__init__(database, client, worker)
+        super().__init__(database, client, worker, video_info_store)
         self.pipeline = pipeline
         self.duplicate_helper = duplicate_helper
         self.download_helper = download_helper
         self.ffprobe_helper = ffprobe_helper
         self.api_keys = api_keys
         self.subscriptions: List[Subscription] = []
+        # New items are posted through the job queue, so that a restart does not lose posts part way through
+        self.pipeline.job_queue.register(
+            self.POST_JOB_TYPE,
+            self.run_post_item_job,
+            on_failure=self.on_post_item_job_failure,
+        )
         # Setup subscription classes list
-        self.sub_classes: List[Type[Subscription]] = []
-        if "reddit" in self.api_keys:
-            self.sub_classes.append(RedditSubscription)
-        if "twitter" in self.api_keys and "nitter_url" in self.api_keys["twitter"]:
-            self.sub_classes.append(TwitterSubscription)
-        if "instagram" in self.api_keys:
-            self.sub_classes.append(InstagramSubscription)
-        self.sub_classes.append(RSSSubscription)
-        self.sub_classes.append(TelegramSubscription)
-        self.sub_classes.append(YoutubeDLSubscription)  # This subscription type will try anything. Always put it last.
+        self.sub_classes: List[Type[Subscription]] = self.list_sub_classes()
         # Initialise counters
         all_classes = self.sub_classes + [UninitialisedSubscription]
         for sub_class in all_classes:
@@ -114,21 +118,41 @@ class SubscriptionHelper(Helper):
                     ])
                 )
 
+    def list_sub_classes(self) -> List[Type[Subscription]]:
+        sub_classes: List[Type[Subscription]] = []
+        if "reddit" in self.api_keys:
+            sub_classes.append(RedditSubscription)
+        if "twitter" in self.api_keys and "nitter_url" in self.api_keys["twitter"]:
+            sub_classes.append(TwitterSubscription)
+        if "instagram" in self.api_keys:
+            sub_classes.append(InstagramSubscription)
+        sub_classes.append(RSSSubscription)
+        sub_classes.append(TelegramSubscription)
+        sub_classes.append(YoutubeDLSubscription)  # This subscription type will try anything. Always put it last.
+        return sub_classes
+
+    def update_api_keys(self, api_keys: Dict[str, Dict[str, str]]) -> None:
+        # Existing subscriptions keep their class, new subscriptions are created using the new keys
+        self.api_keys = api_keys
+        self.sub_classes = self.list_sub_classes()
+
     async def init_post_startup(self) -> None:
         logger.debug("Loading subscriptions")
-        self.subscriptions = await load_subs_from_database(self.database, self)
+        self.subscriptions = await load_subs_from_database(self.database, self, self.pipeline.snapshot)
         logger.debug("Loaded all subscriptions")
         asyncio.get_event_loop().create_task(self.sub_checker())
         logger.debug("Started subscription checker task")
         await super().init_post_startup()
 
     async def sub_checker(self) -> None:
-        while True:
-            try:
-                await self.check_subscriptions()
-            except Exception as e:
-                logger.error("Failed to check subscriptions, due to exception: ", exc_info=e)
-            await asyncio.sleep(self.CHECK_DELAY)
+        # Subscription posts queue behind user commands and scheduled posts for task worker slots
+        with task_priority(TaskPriority.SUBSCRIPTION):
+            while True:
+                try:
+                    await self.check_subscriptions()
+                except Exception as e:
+                    logger.error("Failed to check subscriptions, due to exception: ", exc_info=e)
+                await asyncio.sleep(self.CHECK_DELAY)
 
     async def check_subscriptions(self) -> None:
         logger.info("Checking subscriptions")
@@ -137,35 +161,90 @@ class SubscriptionHelper(Helper):
             if not subscription.needs_check():
                 continue
             chat = self.pipeline.chat_by_id(subscription.chat_id)
-            try:
-                new_items = await subscription.check_for_new_items()
-            except Exception as e:
-                logger.warning("Subscription to %s failed due to:", subscription.feed_url, exc_info=e)
-                # Just increment a counter please
-                subscription.failures += 1
-                self.save_subscription(subscription)
-            else:
-                for item in new_items[::-1]:
-                    try:
-                        await self.post_item(item, subscription)
-                    except Exception as e:
-                        logger.error(
-                            "Failed to post item %s from %s feed due to:",
-                            item.source_link,
-                            subscription.feed_url,
-                            exc_info=e
-                        )
-                        feed_url = subscription.feed_url
-                        await self.send_message(
-                            chat,
-                            text=f"Failed to post item {item.source_link} from {feed_url} feed due to: {e}",
-                            buttons=[[Button.inline("Delete error", "delete_me")]]
-                        )
-                subscription.failures = 0
+            if chat is None:
+                logger.warning(
+                    "Removing subscription to %s, as its chat %s is no longer in the pipeline",
+                    subscription.feed_url, subscription.chat_id
+                )
+                self.remove_subscription(subscription)
+                continue
+            with task_tenant(str(chat.chat_data.chat_id), chat.config.task_weight):
+                try:
+                    new_items = await subscription.check_for_new_items()
+                except Exception as e:
+                    logger.warning("Subscription to %s failed due to:", subscription.feed_url, exc_info=e)
+                    # Just increment a counter please
+                    subscription.failures += 1
+                    self.save_subscription(subscription)
+                else:
+                    for item in new_items[::-1]:
+                        self.queue_post_item(item, subscription)
+                    subscription.failures = 0
             subscription.last_check_time = datetime.now()
             self.save_subscription(subscription)
 
-    async def post_item(self, item: "Item", subscription: "Subscription") -> None:
+    def queue_post_item(self, item: "Item", subscription: "Subscription") -> None:
+        self.pipeline.job_queue.enqueue(
+            self.POST_JOB_TYPE,
+            f"{subscription.subscription_id}:{item.item_id}",
+            {
+                "subscription_id": subscription.subscription_id,
+                "item_id": item.item_id,
+                "download_link": item.download_link,
+                "source_link": item.source_link,
+                "title": item.title,
+                "tag_source": item._tag_source,
+            }
+        )
+
+    def _subscription_for_job(self, job: "Job") -> Optional["Subscription"]:
+        subscription_id = job.payload["subscription_id"]
+        return next((s for s in self.subscriptions if s.subscription_id == subscription_id), None)
+
+    @staticmethod
+    def _item_for_job(job: "Job") -> Item:
+        return Item(
+            job.payload["item_id"],
+            job.payload["download_link"],
+            job.payload["source_link"],
+            job.payload["title"],
+            job.payload["tag_source"],
+        )
+
+    async def run_post_item_job(self, job: "Job") -> None:
+        # Subscriptions are loaded after startup
+        while not self.post_startup_init_complete:
+            await asyncio.sleep(1)
+        subscription = self._subscription_for_job(job)
+        if subscription is None:
+            logger.info("Subscription for queued item %s was removed, skipping", job.payload["source_link"])
+            return
+        chat = self.pipeline.chat_by_id(subscription.chat_id)
+        if chat is None:
+            raise JobFailedException(
+                f"Chat {subscription.chat_id} for subscription to {subscription.feed_url} is no longer in the pipeline"
+            )
+        with task_priority(TaskPriority.SUBSCRIPTION):
+            with task_tenant(str(chat.chat_data.chat_id), chat.config.task_weight):
+                await self.post_item(self._item_for_job(job), subscription, job)
+
+    async def on_post_item_job_failure(self, job: "Job", e: Exception) -> None:
+        subscription = self._subscription_for_job(job)
+        if subscription is None:
+            return
+        chat = self.pipeline.chat_by_id(subscription.chat_id)
+        if chat is None:
+            # There is nowhere to report the failure
+            return
+        source_link = job.payload["source_link"]
+        feed_url = subscription.feed_url
+        await self.send_message(
+            chat,
+            text=f"Failed to post item {source_link} from {feed_url} feed due to: {e}",
+            buttons=[[Button.inline("Delete error", "delete_me")]]
+        )
+
+    async def post_item(self, item: "Item", subscription: "Subscription", job: "Job") -> None:
         # Get chat
         chat = self.pipeline.chat_by_id(subscription.chat_id)
         # Metrics
@@ -181,9 +260,9 @@ class SubscriptionHelper(Helper):
             f"<a href=\"{item.source_link}\">{title}</a>\n\n"
             f"Feed: {html.escape(subscription.feed_url)}"
         )
-        # Download the item
+        # Download the item. Each step's output is saved in the job, so a resumed job skips steps already done
         hash_set = None
-        file_path = await subscription.download_item(item)
+        file_path = await job.run_step("download", lambda: subscription.download_item(item), output_file=True)
         # Only post videos
         if not file_path or is_static_image(file_path):
             return
@@ -191,19 +270,25 @@ class SubscriptionHelper(Helper):
         video_length = await self.ffprobe_helper.duration_video(file_path)
         # Convert to video
         if video_length < self.MAX_AUTO_MP4_LENGTH_SECONDS:
-            output_path = random_sandbox_video_path()
-            task_desc = f"Auto-converting subscription to mp4 for feed: {subscription.feed_url}"
-            tasks = video_to_video(file_path, output_path, task_description=task_desc)
-            for task in tasks:
-                await self.worker.await_task(task)
-            file_path = output_path
+            async def convert() -> str:
+                output_path = random_sandbox_video_path()
+                task_desc = f"Auto-converting subscription to mp4 for feed: {subscription.feed_url}"
+                tasks = video_to_video(file_path, output_path, task_description=task_desc)
+                for task in tasks:
+                    await self.worker.await_task(task)
+                return output_path
+            file_path = await job.run_step("convert", convert, output_file=True)
         # Check duplicate warnings
         if chat.config.duplicate_detection:
             # Check video length
             if video_length > self.duplicate_helper.MAX_AUTO_HASH_LENGTH_SECONDS:
                 caption += "\n\nThis video is too long to automatically check for duplicates"
             else:
-                hash_set = await self.get_item_hash_set(file_path, item.item_id, subscription)
+                hash_list = await job.run_step(
+                    "hash",
+                    lambda: self._hash_list(file_path, item.item_id, subscription)
+                )
+                hash_set = set(hash_list)
                 warnings = await self.check_item_duplicate(hash_set)
                 if warnings:
                     caption += "\n\n" + "\n".join(warnings)
@@ -213,6 +298,10 @@ class SubscriptionHelper(Helper):
         # Post item
         await self.send_message(chat, text=caption, video_path=file_path, video_hashes=hash_set, tags=tags)
 
+    async def _hash_list(self, file_path: str, item_id: str, subscription: "Subscription") -> List[str]:
+        # Job step results are stored as json, which has no sets
+        return list(await self.get_item_hash_set(file_path, item_id, subscription))
+
     async def get_item_hash_set(self, file_path: str, item_id: str, subscription: "Subscription") -> Set[str]:
         # Hash video
         message_decompose_path = f"sandbox/decompose/subs/{subscription.subscription_id}/{item_id}/"
@@ -260,9 +349,7 @@ class SubscriptionHelper(Helper):
                 return [await self.send_text_reply(
                     chat, message, f"Cannot remove subscription, as none match the feed link: {feed_link_out}"
                 )]
-            self.subscriptions.remove(matching_sub)
-            self.database.remove_subscription(matching_sub.to_data())
-            self.save_subscriptions()
+            self.remove_subscription(matching_sub)
             return [await self.send_text_reply(chat, message, f"Removed subscription to {feed_link_out}")]
         feed_link = split_text[1]
         feed_link_out = html.escape(feed_link)
@@ -291,6 +378,16 @@ class SubscriptionHelper(Helper):
             return False
         return True
 
+    def remove_subscription(self, subscription: Subscription) -> None:
+        self.subscriptions.remove(subscription)
+        self.database.remove_subscription(subscription.to_data())
+        self.save_subscriptions()
+
+    def remove_subscriptions_for_chat(self, chat_id: int) -> None:
+        for subscription in [sub for sub in self.subscriptions if sub.chat_id == chat_id]:
+            logger.info("Removing subscription to %s, as its chat is being removed", subscription.feed_url)
+            self.remove_subscription(subscription)
+
     def save_subscriptions(self) -> None:
         for subscription in self.subscriptions:
             self.save_subscription(subscription)
@@ -307,11 +404,17 @@ class SubscriptionHelper(Helper):
             subscription.subscription_id = saved_data.subscription_id
 
 
-async def load_subs_from_database(database: "Database", helper: SubscriptionHelper) -> List["Subscription"]:
-    sub_data = database.list_subscriptions()
+async def load_subs_from_database(
+        database: "Database",
+        helper: SubscriptionHelper,
+        snapshot: Optional["PipelineSnapshot"] = None,
+) -> List["Subscription"]:
+    # Read from the warm start snapshot if there is one, as it has already been brought up to date with the database
+    source = snapshot or database
+    sub_data = source.list_subscriptions()
     subscriptions = []
     for sub_entry in sub_data:
-        seen_items = database.list_item_ids_for_subscription(sub_entry)
+        seen_items = source.list_item_ids_for_subscription(sub_entry)
         logger.debug("Loading subscription %s with %s seen items", sub_entry.feed_link, len(seen_items))
         subscription = await create_sub_for_link(
             sub_entry.feed_link,
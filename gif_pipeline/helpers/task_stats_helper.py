@@ -0,0 +1,26 @@
+from typing import Optional, List
+
+from gif_pipeline.chat import Chat, WorkshopGroup
+from gif_pipeline.helpers.helpers import Helper
+from gif_pipeline.message import Message
+
+
+class TaskStatsHelper(Helper):
+
+    async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
+        if not isinstance(chat, WorkshopGroup):
+            return None
+        text_clean = message.text.lower().strip()
+        if text_clean not in ["task stats", "tasks stats", "task statistics"]:
+            return None
+        self.usage_counter.inc()
+        table = self.worker.stats.table()
+        if not table:
+            return [await self.send_text_reply(chat, message, "No tasks have run yet.")]
+        pool_lines = [
+            f"{pool.name}: {pool.size - pool.free_slots}/{pool.size} slots in use, "
+            f"{sum(len(waiters) for waiters in pool.waiters.values())} queued"
+            for pool in self.worker.pools.values()
+        ]
+        text = "Task pools:\n" + "\n".join(pool_lines) + "\n\nRecent tasks:\n" + table
+        return [await self.send_text_reply(chat, message, text)]
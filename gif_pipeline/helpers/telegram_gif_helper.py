@@ -9,12 +9,13 @@ import requests
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import ChainOutputHelper, FilterGraph, ChainOutput
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
-from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 from gif_pipeline.video_tags import VideoTags
 
 
@@ -25,6 +26,8 @@ class GifSettings:
     bitrate: float
     fps: float
     audio: bool = False
+    # Edits to apply to the video in the same encode, from an edit chain
+    filter_graph: Optional[FilterGraph] = None
     _pass_log_file: Optional[str] = None
     # Maximum gif dimension on android telegram is 1280px (width, or height, or both)
     # Maximum gif dimension on desktop telegram is 1440px (width, or height, or both)
@@ -67,16 +70,27 @@ class GifSettings:
             return f",fps=fps={self.fps}"
         return ""
 
+    @property
+    def input_options(self) -> Optional[str]:
+        if self.filter_graph is None:
+            return None
+        return self.filter_graph.input_options
+
+    @property
+    def video_filter(self) -> str:
+        scale_filter = "scale='min({0},iw)':'min({1},ih)':force_original_aspect_" \
+            "ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2{2}".format(self.width, self.height, self.fps_filter)
+        return (self.filter_graph or FilterGraph()).video_filter([scale_filter])
+
     @property
     def ffmpeg_options(self) -> str:
         ffmpeg_options = " -vcodec libx264 -tune animation -preset veryslow -movflags faststart -pix_fmt yuv420p " \
-            "-vf \"scale='min({0},iw)':'min({1},ih)':force_original_aspect_" \
-            "ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2{2}\" -profile:v baseline -level 3.0 -vsync vfr"
+            f"-vf \"{self.video_filter}\" -profile:v baseline -level 3.0 -vsync vfr"
         if not self.audio:
             ffmpeg_options = " -an" + ffmpeg_options
-        return ffmpeg_options.format(
-            self.width, self.height, self.fps_filter
-        )
+        elif self.filter_graph is not None and self.filter_graph.audio_filter() is not None:
+            ffmpeg_options += f" -filter:a \"{self.filter_graph.audio_filter()}\""
+        return ffmpeg_options
 
     @property
     def ffmpeg_options_one_pass(self) -> str:
@@ -101,13 +115,19 @@ class GifSettings:
         return self.ffmpeg_options + f" -b:v {self.bitrate} -pass 2 -passlogfile {self.pass_log_file}"
 
 
-class TelegramGifHelper(Helper):
+class TelegramGifHelper(Helper, ChainOutputHelper):
     # A handy read on Constant Rate Factor, and such https://trac.ffmpeg.org/wiki/Encode/H.264
     CRF_OPTION = " -crf 18"
     TARGET_SIZE_MB = 8
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         # If message has text which is a link to a gif, download it, then convert it
@@ -138,6 +158,14 @@ class TelegramGifHelper(Helper):
         # Otherwise, ignore
         return
 
+    def is_chain_output(self, step: str) -> bool:
+        return step.startswith("gif")
+
+    async def encode_chain(self, step: str, video_path: str, graph: FilterGraph) -> ChainOutput:
+        gif_settings = GifSettings.from_input(step[3:].strip().split())
+        gif_settings.filter_graph = graph
+        return ChainOutput(await self.convert_video_to_telegram_gif(video_path, gif_settings))
+
     async def convert_gif_link(self, chat: Chat, message: Message, gif_link: str) -> Message:
         resp = requests.get(gif_link)
         gif_path = random_sandbox_video_path("gif")
@@ -160,26 +188,33 @@ class TelegramGifHelper(Helper):
         if os.path.getsize(first_try_filename) < TelegramGifHelper.TARGET_SIZE_MB * 1000_000:
             return first_try_filename
         # If it's too big, do a 2 pass run
-        return await self.two_pass_convert_target_size(video_path, gif_settings, TelegramGifHelper.TARGET_SIZE_MB)
+        # Edits may change the video's duration, so the bitrate has to be worked out from the output
+        duration_path = first_try_filename if gif_settings.filter_graph is not None else video_path
+        return await self.two_pass_convert_target_size(
+            video_path, gif_settings, TelegramGifHelper.TARGET_SIZE_MB, duration_path
+        )
 
     async def single_pass_convert(self, video_path: str, gif_settings: GifSettings):
         first_pass_filename = random_sandbox_video_path()
         # first attempt
         ffmpeg_args = gif_settings.ffmpeg_options_one_pass
         task = FfmpegTask(
-            inputs={video_path: None},
+            purpose="gif",
+            inputs={video_path: gif_settings.input_options},
             outputs={first_pass_filename: ffmpeg_args}
         )
         await self.worker.await_task(task)
         return first_pass_filename
 
-    async def two_pass_convert_target_size(self, video_path: str, gif_settings: GifSettings, file_size_mb: float):
+    async def two_pass_convert_target_size(
+            self,
+            video_path: str,
+            gif_settings: GifSettings,
+            file_size_mb: float,
+            duration_path: Optional[str] = None,
+    ):
         # Get video duration from ffprobe
-        probe_task = FFprobeTask(
-            global_options=["-v error"],
-            inputs={video_path: "-show_entries format=duration -of default=noprint_wrappers=1:nokey=1"}
-        )
-        duration = float(await self.worker.await_task(probe_task))
+        duration = (await self.video_info_store.get(duration_path or video_path)).duration
         # Calculate new bitrate
         max_bitrate = file_size_mb / duration * 1000000 * 8
         if not gif_settings.bitrate:
@@ -196,14 +231,16 @@ class TelegramGifHelper(Helper):
         # First pass
         two_pass_args = gif_settings.ffmpeg_options_two_pass
         task1 = FfmpegTask(
+            purpose="gif_pass1",
             global_options=["-y"],
-            inputs={video_path: None},
+            inputs={video_path: gif_settings.input_options},
             outputs={os.devnull: two_pass_args[0]}
         )
         await self.worker.await_task(task1)
         task2 = FfmpegTask(
+            purpose="gif_pass2",
             global_options=["-y"],
-            inputs={video_path: None},
+            inputs={video_path: gif_settings.input_options},
             outputs={two_pass_filename: two_pass_args[1]}
         )
         await self.worker.await_task(task2)
@@ -1,4 +1,3 @@
-import asyncio
 import datetime
 import logging
 import os
@@ -6,14 +5,18 @@ from typing import Optional, List, TYPE_CHECKING
 
 from gif_pipeline.chat import Chat
 from gif_pipeline.helpers.helpers import Helper, random_sandbox_video_path
+from gif_pipeline.media_backend import media_backend
+from gif_pipeline.media_downloader import DownloadPriority
 from gif_pipeline.message import Message
-from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.task_worker import task_priority, TaskPriority
 
 if TYPE_CHECKING:
     from gif_pipeline.database import Database
+    from gif_pipeline.job_queue import Job
     from gif_pipeline.pipeline import Pipeline
     from gif_pipeline.tasks.task_worker import TaskWorker
     from gif_pipeline.telegram_client import TelegramClient
+    from gif_pipeline.video_info import VideoInfoStore
 
 
 logger = logging.getLogger(__name__)
@@ -23,10 +26,19 @@ class ThumbnailHelper(Helper):
     DEFAULT_TS = 1
     DEFAULT_WIDTH = 500
     DEFAULT_HEIGHT = 500
+    THUMBNAIL_JOB_TYPE = "website_thumbnail"
 
-    def __init__(self, database: "Database", client: "TelegramClient", worker: "TaskWorker", pipeline: "Pipeline"):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: "Database",
+            client: "TelegramClient",
+            worker: "TaskWorker",
+            video_info_store: "VideoInfoStore",
+            pipeline: "Pipeline",
+    ):
+        super().__init__(database, client, worker, video_info_store)
         self.pipeline = pipeline
+        self.pipeline.job_queue.register(self.THUMBNAIL_JOB_TYPE, self.run_thumbnail_job, concurrency=2)
 
     async def on_new_message(self, chat: Chat, message: Message) -> Optional[List[Message]]:
         # If a message has text saying ffprobe or stats, and is a reply to a video, get stats for that video
@@ -71,6 +83,7 @@ class ThumbnailHelper(Helper):
                 except ValueError:
                     pass
         # Create thumbnail
+        await video.ensure_media()
         thumb_path = await self.create_thumbnail(video.message_data.file_path, thumbnail_ts, width, height)
         # If thumb is not generated return error
         if not thumb_path:
@@ -94,18 +107,9 @@ class ThumbnailHelper(Helper):
         )]
 
     async def create_thumbnail(self, video_path: str, thumbnail_ts: float, width: int, height: int) -> Optional[str]:
-        resize_filter = f"-vf \"scale='min({width},iw)':'min({height},ih)':force_original_aspect_ratio=decrease\""
         try:
             thumb_path = random_sandbox_video_path("jpg")
-            thumb_task = FfmpegTask(
-                inputs={
-                    video_path: None,
-                },
-                outputs={
-                    thumb_path: f"-ss {thumbnail_ts} -vframes 1 {resize_filter}"
-                }
-            )
-            await self.worker.await_task(thumb_task)
+            await media_backend.grab_frame(self.worker, video_path, thumb_path, thumbnail_ts, width, height)
             if os.path.isfile(thumb_path):
                 return thumb_path
             return None
@@ -113,6 +117,7 @@ class ThumbnailHelper(Helper):
             return None
 
     async def create_and_save_thumbnail(self, msg: Message) -> None:
+        await msg.ensure_media(DownloadPriority.BACKGROUND)
         video_path = msg.message_data.file_path
         thumb_path = await self.create_thumbnail(video_path, self.DEFAULT_TS, self.DEFAULT_WIDTH, self.DEFAULT_HEIGHT)
         if not thumb_path:
@@ -123,13 +128,28 @@ class ThumbnailHelper(Helper):
                 thumb_data = f.read()
             self.database.save_thumbnail(msg.message_data, thumb_data, self.DEFAULT_TS, now)
 
+    async def run_thumbnail_job(self, job: "Job") -> None:
+        chat = self.pipeline.chat_by_id(job.payload["chat_id"])
+        if chat is None:
+            return
+        msg = chat.message_by_id(job.payload["message_id"])
+        if msg is None or self.database.get_thumbnail_data(msg.message_data):
+            return
+        with task_priority(TaskPriority.BACKGROUND):
+            await self.create_and_save_thumbnail(msg)
+
     async def init_post_startup(self) -> None:
+        # Missing thumbnails are queued as jobs, so they are generated in the background, and survive restarts
         for channel in self.pipeline.channels:
             if channel.config.website_config.enabled:
                 logger.info("Checking %s for video thumbnails", channel.chat_data.title)
                 for msg in channel.video_messages():
                     thumb = self.database.get_thumbnail_data(msg.message_data)
                     if not thumb:
-                        asyncio.get_event_loop().create_task(self.create_and_save_thumbnail(msg))
+                        self.pipeline.job_queue.enqueue(
+                            self.THUMBNAIL_JOB_TYPE,
+                            f"{msg.message_data.chat_id}:{msg.message_data.message_id}",
+                            {"chat_id": msg.message_data.chat_id, "message_id": msg.message_data.message_id},
+                        )
         logger.info("Completed thumbnail checks")
         await super().init_post_startup()
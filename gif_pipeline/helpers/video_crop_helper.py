@@ -3,14 +3,16 @@ from typing import Optional
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, FilterGraph, FilterNode, EditStepException
 from gif_pipeline.helpers.helpers import Helper, random_sandbox_video_path, find_video_for_message
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
-class VideoCropHelper(Helper):
+class VideoCropHelper(Helper, FilterNodeHelper):
     LEFT = ["left", "l"]
     RIGHT = ["right", "r"]
     TOP = ["top", "t"]
@@ -18,9 +20,23 @@ class VideoCropHelper(Helper):
     WIDTH = ["width", "w"]
     HEIGHT = ["height", "h"]
     VALID_WORDS = LEFT + RIGHT + TOP + BOTTOM + WIDTH + HEIGHT
+    AUTO_CROP_FAILED = "That video could not be auto cropped."
+    CROP_NOT_UNDERSTOOD = (
+        "I don't understand this crop command. "
+        "Please specify what percentage to cut off the left, right, top, bottom. "
+        "Alternatively specify the desired percentage for the width and height. "
+        "Use the format `crop left 20% right 20% top 10%`. "
+        "If the video has black bars you wish to crop, just use `crop auto`"
+    )
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message):
         # If a message has text saying to crop, some percentages maybe?
@@ -33,36 +49,46 @@ class VideoCropHelper(Helper):
         if video is None:
             return [await self.send_text_reply(chat, message, "I'm not sure which video you would like to crop.")]
         crop_args = text_clean[len("crop"):].strip()
-        if crop_args.lower() == "auto":
+        if crop_args == "auto":
             async with self.progress_message(chat, message, "Detecting auto crop settings"):
                 crop_string = await self.detect_crop(video.message_data.file_path)
             if crop_string is None:
-                return [await self.send_text_reply(chat, message, "That video could not be auto cropped.")]
+                return [await self.send_text_reply(chat, message, self.AUTO_CROP_FAILED)]
         else:
             crop_string = self.parse_crop_input(crop_args)
         if crop_string is None:
-            return [await self.send_text_reply(
-                chat,
-                message,
-                "I don't understand this crop command. "
-                "Please specify what percentage to cut off the left, right, top, bottom. "
-                "Alternatively specify the desired percentage for the width and height. "
-                "Use the format `crop left 20% right 20% top 10%`. "
-                "If the video has black bars you wish to crop, just use `crop auto`"
-            )]
+            return [await self.send_text_reply(chat, message, self.CROP_NOT_UNDERSTOOD)]
         output_path = random_sandbox_video_path()
         async with self.progress_message(chat, message, "Cropping video"):
             task = FfmpegTask(
+                purpose="crop",
                 inputs={video.message_data.file_path: None},
                 outputs={output_path: f"-filter:v \"{crop_string}\" -c:a copy"}
             )
             await self.worker.await_task(task)
             return [await self.send_video_reply(chat, message, output_path, video.tags(self.database))]
 
-    async def detect_crop(self, video_path: str) -> Optional[str]:
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        if not step.startswith("crop"):
+            return None
+        crop_args = step[len("crop"):].strip()
+        if crop_args == "auto":
+            # Detect the black bars as they are at this point in the chain, after any rotating or cutting before it
+            crop_string = await self.detect_crop(video_path, graph)
+            if crop_string is None:
+                raise EditStepException(self.AUTO_CROP_FAILED)
+        else:
+            crop_string = self.parse_crop_input(crop_args)
+            if crop_string is None:
+                raise EditStepException(self.CROP_NOT_UNDERSTOOD)
+        return FilterNode(video_filters=[crop_string])
+
+    async def detect_crop(self, video_path: str, graph: Optional[FilterGraph] = None) -> Optional[str]:
+        graph = graph or FilterGraph()
         task = FfmpegTask(
-            inputs={video_path: None},
-            outputs={"-": "-vf cropdetect=24:16:0 -f null"}
+            purpose="crop_detect",
+            inputs={video_path: graph.input_options},
+            outputs={"-": f"-vf \"{graph.video_filter(['cropdetect=24:16:0'])}\" -an -f null"}
         )
         output, error = await self.worker.await_task(task)
         crop_match = re.compile(r"crop=[0-9]+:[0-9]+:[0-9]+:[0-9]+")
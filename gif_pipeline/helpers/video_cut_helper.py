@@ -1,28 +1,46 @@
 import re
-from typing import Optional, Tuple, Match
+from typing import Optional, Tuple, Match, Union, List
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, FilterGraph, FilterNode, EditStepException
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
+from gif_pipeline.helpers.smart_cut import smart_cut, smart_cut_segments, seek_options
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
-class VideoCutHelper(Helper):
+class VideoCutHelper(Helper, FilterNodeHelper):
+    START_END_NOT_UNDERSTOOD = (
+        "Start and end was not understood for this cut. "
+        "Please provide start and end in the format MM:SS or as a number of seconds, with a space between them."
+    )
+    CUT_OUT_NOT_UNDERSTOOD = (
+        "The sections to cut out were not understood. "
+        "Please provide the start and end of each section in the format MM:SS or as a number of seconds, with a space "
+        "between them, and commas between sections. For example, `cut out 3 5, 1:10 1:20`."
+    )
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message):
         # If a message has text saying to cut, with times?
         # Maybe `cut start:end`, or `cut out start:end` and is a reply to a video, then cut it
         text_clean = message.text.lower().strip()
-        cut_out = False
+        cut_ranges = None
+        start, end = None, None
         if text_clean.startswith("cut out"):
-            start, end = VideoCutHelper.get_start_and_end(text_clean[len("cut out"):].strip())
-            cut_out = True
+            cut_ranges = VideoCutHelper.get_cut_out_ranges(text_clean[len("cut out"):].strip())
         elif text_clean.startswith("cut"):
             start, end = VideoCutHelper.get_start_and_end(text_clean[len("cut"):].strip())
         else:
@@ -35,63 +53,177 @@ class VideoCutHelper(Helper):
                 message,
                 "I am not sure which video you would like to cut. Please reply to the video with your cut command."
             )]
+        tags = video.tags(self.database)
+        if text_clean.startswith("cut out"):
+            if cut_ranges is None:
+                return [await self.send_text_reply(chat, message, self.CUT_OUT_NOT_UNDERSTOOD)]
+            if not self.kept_segments(cut_ranges):
+                return [await self.send_text_reply(chat, message, "That would cut out the whole video.")]
+            async with self.progress_message(chat, message, "Cutting out video sections"):
+                output_path = await self.cut_out_video(video, cut_ranges)
+                return [await self.send_video_reply(chat, message, output_path, tags)]
         if start is None and end is None:
             return [await self.send_text_reply(
                 chat,
                 message,
-                "Start and end was not understood for this cut. "
-                "Please provide start and end in the format MM:SS or as a number of seconds, with a space between them."
+                self.START_END_NOT_UNDERSTOOD
             )]
-        if cut_out and (start is None or end is None):
-            cut_out = False
-            if start is None:
-                start = end
-                end = None
-            else:
-                end = start
-                start = None
-        tags = video.tags(self.database)
-        if not cut_out:
-            async with self.progress_message(chat, message, "Cutting video"):
-                new_path = await self.cut_video(video, start, end)
-                return [await self.send_video_reply(chat, message, new_path, tags)]
-        async with self.progress_message(chat, message, "Cutting out video section"):
-            output_path = await self.cut_out_video(video, start, end)
-            return [await self.send_video_reply(chat, message, output_path, tags)]
-
-    async def cut_video(self, video: Message, start: Optional[str], end: Optional[str]) -> str:
+        if not all(self.is_valid_timestamp(t) for t in [start, end] if t is not None):
+            return [await self.send_text_reply(chat, message, self.START_END_NOT_UNDERSTOOD)]
+        async with self.progress_message(chat, message, "Cutting video"):
+            new_path = await self.cut_video(video, start, end)
+            return [await self.send_video_reply(chat, message, new_path, tags)]
+
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        if step.startswith("cut out"):
+            cut_ranges = VideoCutHelper.get_cut_out_ranges(step[len("cut out"):].strip())
+            if cut_ranges is None:
+                raise EditStepException(self.CUT_OUT_NOT_UNDERSTOOD)
+            # Selecting frames keeps a single input and output, so this chains with other filters, unlike a concat
+            cut_expr = "+".join(
+                f"between(t,{start},{end})" if end is not None else f"gte(t,{start})" for start, end in cut_ranges
+            )
+            segments = self.kept_segments(cut_ranges)
+            return FilterNode(
+                video_filters=[f"select='not({cut_expr})'", "setpts=N/FRAME_RATE/TB"],
+                audio_filters=[f"aselect='not({cut_expr})'", "asetpts=N/SR/TB"],
+                duration=lambda duration: self.segments_duration(segments, duration),
+            )
+        if not step.startswith("cut"):
+            return None
+        start, end = VideoCutHelper.get_start_and_end(step[len("cut"):].strip())
+        if start is None and end is None:
+            raise EditStepException(self.START_END_NOT_UNDERSTOOD)
+        if not all(self.is_valid_timestamp(t) for t in [start, end] if t is not None):
+            raise EditStepException(self.START_END_NOT_UNDERSTOOD)
+        start_secs = self.timestamp_seconds(start) if start is not None else None
+        end_secs = self.timestamp_seconds(end) if end is not None else None
+        trim_args = self.trim_args(start_secs, end_secs)
+        return FilterNode(
+            video_filters=[f"trim={trim_args}", "setpts=PTS-STARTPTS"],
+            audio_filters=[f"atrim={trim_args}", "asetpts=PTS-STARTPTS"],
+            seek=(start_secs, end_secs),
+            duration=lambda duration: self.segments_duration([(start_secs, end_secs)], duration),
+        )
+
+    async def cut_video(
+            self,
+            video: Message,
+            start: Optional[Union[str, float]],
+            end: Optional[Union[str, float]],
+    ) -> str:
         new_path = random_sandbox_video_path()
-        out_string = (f"-ss {start}" if start is not None else "") + " " + (f"-to {end}" if end is not None else "")
+        video_path = video.message_data.file_path
+        start_secs = self.timestamp_seconds(start) if start is not None else None
+        end_secs = self.timestamp_seconds(end) if end is not None else None
+        if await smart_cut(self.worker, self.video_info_store, video_path, new_path, start_secs, end_secs):
+            return new_path
+        input_duration = (await self.video_info_store.get(video_path)).duration
+        # Seeking the input, rather than the output, skips decoding everything before the start
         task = FfmpegTask(
-            inputs={video.message_data.file_path: None},
-            outputs={new_path: out_string}
+            purpose="cut",
+            inputs={video_path: seek_options(start_secs, end_secs)},
+            outputs={new_path: None},
+            duration=self.segments_duration([(start_secs, end_secs)], input_duration),
         )
         await self.worker.await_task(task)
         return new_path
 
-    async def cut_out_video(self, video: Message, start: str, end: str) -> str:
-        first_part_path = random_sandbox_video_path()
-        second_part_path = random_sandbox_video_path()
-        task1 = FfmpegTask(
-            inputs={video.message_data.file_path: None},
-            outputs={first_part_path: f"-to {start}"}
-        )
-        task2 = FfmpegTask(
-            inputs={video.message_data.file_path: None},
-            outputs={second_part_path: f"-ss {end}"}
-        )
-        await self.worker.await_tasks([task1, task2])
-        inputs_file = random_sandbox_video_path("txt")
-        with open(inputs_file, "w") as f:
-            f.write(f"file '{first_part_path.split('/')[1]}'\nfile '{second_part_path.split('/')[1]}'")
+    async def cut_out_video(self, video: Message, cut_ranges: List[Tuple[float, Optional[float]]]) -> str:
+        segments = self.kept_segments(cut_ranges)
+        if len(segments) == 1:
+            return await self.cut_video(video, *segments[0])
+        video_path = video.message_data.file_path
         output_path = random_sandbox_video_path()
-        task_concat = FfmpegTask(
-            inputs={inputs_file: "-safe 0 -f concat"},
-            outputs={output_path: "-c copy"}
+        if await smart_cut_segments(self.worker, self.video_info_store, video_path, output_path, segments):
+            return output_path
+        # Otherwise trim each section from one decode of the video, and join them in the same run
+        video_info = await self.video_info_store.get(video_path)
+        has_audio = video_info.has_audio
+        task = FfmpegTask(
+            purpose="cut_out",
+            global_options=[f"-filter_complex \"{self.trim_concat_filter(segments, has_audio)}\""],
+            inputs={video_path: None},
+            outputs={output_path: "-map [v]" + (" -map [a]" if has_audio else "")},
+            duration=self.segments_duration(segments, video_info.duration),
         )
-        await self.worker.await_task(task_concat)
+        await self.worker.await_task(task)
         return output_path
 
+    @staticmethod
+    def segments_duration(
+            segments: List[Tuple[Optional[float], Optional[float]]],
+            video_duration: Optional[float],
+    ) -> Optional[float]:
+        """
+        Total length, in seconds, of the given (start, end) sections of a video, or None if it depends on the length of
+        the video, which is not known
+        """
+        total = 0.0
+        for start, end in segments:
+            if video_duration is not None:
+                end = video_duration if end is None else min(end, video_duration)
+            elif end is None:
+                return None
+            total += max(0.0, end - (start or 0))
+        return total
+
+    @staticmethod
+    def trim_args(start: Optional[float], end: Optional[float]) -> str:
+        return ":".join(([f"start={start}"] if start is not None else []) + ([f"end={end}"] if end is not None else []))
+
+    @staticmethod
+    def trim_concat_filter(segments: List[Tuple[Optional[float], Optional[float]]], has_audio: bool) -> str:
+        filters = []
+        labels = []
+        for i, (start, end) in enumerate(segments):
+            trim_args = VideoCutHelper.trim_args(start, end)
+            filters.append(f"[0:v]trim={trim_args},setpts=PTS-STARTPTS[v{i}]")
+            labels.append(f"[v{i}]")
+            if has_audio:
+                filters.append(f"[0:a]atrim={trim_args},asetpts=PTS-STARTPTS[a{i}]")
+                labels.append(f"[a{i}]")
+        outputs = "[v][a]" if has_audio else "[v]"
+        filters.append(f"{''.join(labels)}concat=n={len(segments)}:v=1:a={int(has_audio)}{outputs}")
+        return ";".join(filters)
+
+    @staticmethod
+    def get_cut_out_ranges(text_clean: str) -> Optional[List[Tuple[float, Optional[float]]]]:
+        """
+        Parses comma separated sections to cut out, such as `3 5, 1:10 end`, into (start, end) seconds, with None for
+        the end of the video. Returns None if any section is not understood.
+        """
+        cut_ranges = []
+        for range_text in text_clean.split(","):
+            start, end = VideoCutHelper.get_start_and_end(range_text.strip())
+            if start is None and end is None:
+                return None
+            if not all(VideoCutHelper.is_valid_timestamp(t) for t in [start, end] if t is not None):
+                return None
+            start_secs = VideoCutHelper.timestamp_seconds(start) if start is not None else 0.0
+            end_secs = VideoCutHelper.timestamp_seconds(end) if end is not None else None
+            if end_secs is not None and end_secs <= start_secs:
+                return None
+            cut_ranges.append((start_secs, end_secs))
+        return cut_ranges
+
+    @staticmethod
+    def kept_segments(cut_ranges: List[Tuple[float, Optional[float]]]) -> List[Tuple[Optional[float], Optional[float]]]:
+        """
+        The sections of video left around the ranges being cut out, as (start, end) seconds, with None for the start
+        or end of the video
+        """
+        segments = []
+        position = 0.0
+        for start, end in sorted(cut_ranges, key=lambda cut_range: cut_range[0]):
+            if start > position:
+                segments.append((position or None, start))
+            if end is None:
+                return segments
+            position = max(position, end)
+        segments.append((position or None, None))
+        return segments
+
     @staticmethod
     def get_start_and_end(text_clean: str) -> Tuple[Optional[str], Optional[str]]:
         if len(text_clean.replace("-", " ").split()) == 2:
@@ -115,3 +247,12 @@ class VideoCutHelper(Helper):
     @staticmethod
     def is_valid_timestamp(timestamp: str) -> Optional[Match[str]]:
         return re.fullmatch(r"^(((\d+:)?\d)?\d:\d\d(\.\d+)?)|(\d+(\.\d+)?)$", timestamp)
+
+    @staticmethod
+    def timestamp_seconds(timestamp: Union[str, float]) -> float:
+        if isinstance(timestamp, (int, float)):
+            return float(timestamp)
+        seconds = 0.0
+        for part in timestamp.split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
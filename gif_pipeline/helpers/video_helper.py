@@ -6,7 +6,6 @@ from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_
 from gif_pipeline.helpers.telegram_gif_helper import GifSettings
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
-from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
 
 
 class VideoHelper(Helper):
@@ -38,19 +37,12 @@ class VideoHelper(Helper):
             return [await self.send_video_reply(chat, message, output_path, video.tags(self.database))]
 
     async def video_has_audio_track(self, video: Message) -> bool:
-        task = video_has_audio_track_task(video.message_data.file_path)
-        return bool(len(await self.worker.await_task(task)))
-
-
-def video_has_audio_track_task(input_path: str) -> FFprobeTask:
-    return FFprobeTask(
-        global_options=["-v error"],
-        inputs={input_path: "-show_streams -select_streams a -loglevel error"}
-    )
+        return (await self.video_info_store.get(video.message_data.file_path)).has_audio
 
 
 def add_audio_track_task(input_path: str, output_path: str) -> FfmpegTask:
     return FfmpegTask(
+        purpose="add_audio",
         global_options=["-f lavfi"],
         inputs={
             "aevalsrc=0": None,
@@ -68,6 +60,7 @@ def video_to_video(
 ) -> List[FfmpegTask]:
     if not video_settings:
         return [FfmpegTask(
+            purpose="convert",
             inputs={input_path: None},
             outputs={output_path: "-qscale 0"},
             description=task_description,
@@ -83,6 +76,7 @@ def single_pass_convert(input_path: str, output_path: str, video_settings: GifSe
     # first attempt
     ffmpeg_args = video_settings.ffmpeg_options_one_pass
     return FfmpegTask(
+        purpose="gif",
         inputs={input_path: None},
         outputs={output_path: ffmpeg_args}
     )
@@ -91,11 +85,13 @@ def single_pass_convert(input_path: str, output_path: str, video_settings: GifSe
 def two_pass_convert(input_path: str, output_path: str, video_settings: GifSettings) -> List[FfmpegTask]:
     two_pass_args = video_settings.ffmpeg_options_two_pass
     task1 = FfmpegTask(
+        purpose="gif_pass1",
         global_options=["-y"],
         inputs={input_path: None},
         outputs={os.devnull: two_pass_args[0]}
     )
     task2 = FfmpegTask(
+        purpose="gif_pass2",
         global_options=["-y"],
         inputs={input_path: None},
         outputs={output_path: two_pass_args[1]}
@@ -2,14 +2,16 @@ from typing import Optional
 
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, FilterGraph, FilterNode, EditStepException
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
-class VideoRotateHelper(Helper):
+class VideoRotateHelper(Helper, FilterNodeHelper):
     ROTATE_CLOCK = ["right", "90", "clock", "clockwise", "90clock", "90clockwise"]
     ROTATE_ANTICLOCK = [
         "left", "270", "anticlock", "anticlockwise", "90anticlock", "90anticlockwise", "cclock", "counterclock",
@@ -22,8 +24,14 @@ class VideoRotateHelper(Helper):
     FLIP_HORIZONTAL = ["horizontal", "leftright"]
     FLIP_VERTICAL = ["vertical", "topbottom"]
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message):
         # If a message has text saying to rotate, and is a reply to a video, then cut it
@@ -44,12 +52,25 @@ class VideoRotateHelper(Helper):
         async with self.progress_message(chat, message, "Rotating or flipping video.."):
             output_path = random_sandbox_video_path()
             task = FfmpegTask(
+                purpose="rotate",
                 inputs={video.message_data.file_path: None},
                 outputs={output_path: f"-vf \"{transpose}\""}
             )
             await self.worker.await_task(task)
             return [await self.send_video_reply(chat, message, output_path, video.tags(self.database))]
 
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        text_clean = step.replace("-", "")
+        if text_clean.startswith("rotate"):
+            transpose = self.get_rotate_direction(text_clean[len("rotate"):].strip())
+        elif text_clean.startswith("flip"):
+            transpose = self.get_flip_direction(text_clean[len("flip"):].strip())
+        else:
+            return None
+        if transpose is None:
+            raise EditStepException("I do not understand this rotate/flip command.")
+        return FilterNode(video_filters=[transpose])
+
     @staticmethod
     def get_rotate_direction(text_clean: str) -> Optional[str]:
         text_clean = text_clean.replace(" ", "")
@@ -1,16 +1,26 @@
+from typing import Optional
+
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat
+from gif_pipeline.helpers.filter_nodes import FilterNodeHelper, FilterGraph, FilterNode, EditStepException
 from gif_pipeline.helpers.helpers import Helper, find_video_for_message, random_sandbox_video_path
 from gif_pipeline.message import Message
 from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
 from gif_pipeline.tasks.task_worker import TaskWorker
 from gif_pipeline.telegram_client import TelegramClient
+from gif_pipeline.video_info import VideoInfoStore
 
 
-class VideoSpeedHelper(Helper):
+class VideoSpeedHelper(Helper, FilterNodeHelper):
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
-        super().__init__(database, client, worker)
+    def __init__(
+            self,
+            database: Database,
+            client: TelegramClient,
+            worker: TaskWorker,
+            video_info_store: VideoInfoStore,
+    ):
+        super().__init__(database, client, worker, video_info_store)
 
     async def on_new_message(self, chat: Chat, message: Message):
         text_clean = message.text.lower().strip()
@@ -40,6 +50,25 @@ class VideoSpeedHelper(Helper):
             tags = video.tags(self.database)
             return [await self.send_video_reply(chat, message, output_path, tags)]
 
+    async def filter_node(self, step: str, video_path: str, graph: FilterGraph) -> Optional[FilterNode]:
+        if not step.startswith("speed"):
+            return None
+        text_args = step.split()
+        if len(text_args) != 2:
+            raise EditStepException("Please specify how much to speed up the video, in the format `speed 2x`")
+        speed_arg = text_args[1]
+        if speed_arg.endswith("x"):
+            speed_arg = speed_arg[:-1]
+        try:
+            speed = self.parse_speed(speed_arg)
+        except (ValueError, ZeroDivisionError):
+            raise EditStepException("I do not understand that speed.")
+        return FilterNode(
+            video_filters=[f"setpts=PTS/{speed}"],
+            audio_filters=[f"atempo={speed}"],
+            duration=lambda duration: duration / speed,
+        )
+
     # noinspection PyMethodMayBeStatic
     def parse_speed(self, speed_arg: str) -> float:
         if "/" in speed_arg:
@@ -49,9 +78,13 @@ class VideoSpeedHelper(Helper):
 
     async def speed_up_video(self, video: Message, speed: float) -> str:
         new_path = random_sandbox_video_path()
+        video_path = video.message_data.file_path
+        input_duration = (await self.video_info_store.get(video_path)).duration
         task = FfmpegTask(
-            inputs={video.message_data.file_path: None},
+            purpose="speed",
+            inputs={video_path: None},
             outputs={new_path: f"-filter:v \"setpts=PTS/{speed}\" -filter:a \"atempo={speed}\""},
+            duration=input_duration / speed if input_duration is not None else None,
         )
         await self.worker.await_task(task)
         return new_path
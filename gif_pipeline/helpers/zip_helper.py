@@ -46,6 +46,7 @@ class ZipHelper(TelegramGifHelper):
         else:
             processed_path = random_sandbox_video_path()
             task = FfmpegTask(
+                purpose="zip_convert",
                 inputs={video_path: None},
                 outputs={processed_path: "-qscale 0"}
             )
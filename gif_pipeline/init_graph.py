@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from gif_pipeline.startup_monitor import StartupMonitor
+from gif_pipeline.startup_tracer import startup_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class InitStep:
+    def __init__(self, name: str, func: Callable[[], Awaitable[None]], depends_on: List[str]) -> None:
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on
+
+
+class InitGraph:
+    """
+    A set of startup steps and the steps each one depends on. Running the graph starts every step as soon as all of its
+    dependencies are complete, so that independent steps run concurrently.
+    """
+
+    def __init__(self, startup_monitor: StartupMonitor) -> None:
+        self.startup_monitor = startup_monitor
+        self.steps: Dict[str, InitStep] = {}
+
+    def add_step(
+            self,
+            name: str,
+            func: Callable[[], Awaitable[None]],
+            depends_on: Optional[List[str]] = None,
+    ) -> None:
+        if name in self.steps:
+            raise ValueError(f"Startup step {name} has already been added")
+        self.steps[name] = InitStep(name, func, depends_on or [])
+
+    def _check_graph(self) -> None:
+        for step in self.steps.values():
+            for dependency in step.depends_on:
+                if dependency not in self.steps:
+                    raise ValueError(f"Startup step {step.name} depends on unknown step {dependency}")
+        # Check for cycles, by repeatedly removing steps which have no remaining dependencies
+        remaining = {name: set(step.depends_on) for name, step in self.steps.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Startup steps have a dependency cycle: {', '.join(sorted(remaining.keys()))}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    async def _run_step(self, step: InitStep, tasks: Dict[str, asyncio.Task]) -> None:
+        await asyncio.gather(*(tasks[dependency] for dependency in step.depends_on))
+        start_time = time.monotonic()
+        with startup_tracer.span(step.name, "init_step", "helper init"):
+            await step.func()
+        duration = time.monotonic() - start_time
+        self.startup_monitor.record_phase(step.name, duration)
+        logger.debug("Startup step %s completed in %.2f seconds", step.name, duration)
+
+    async def run(self) -> None:
+        self._check_graph()
+        loop = asyncio.get_event_loop()
+        tasks: Dict[str, asyncio.Task] = {}
+        for step in self.steps.values():
+            tasks[step.name] = loop.create_task(self._run_step(step, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
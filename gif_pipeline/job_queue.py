@@ -0,0 +1,272 @@
+import asyncio
+import datetime
+import enum
+import json
+import logging
+import os
+from typing import Dict, Callable, Awaitable, Optional, Set, Any, TypeVar, TYPE_CHECKING
+
+import dateutil.parser
+from prometheus_client import Counter, Gauge, Histogram
+
+if TYPE_CHECKING:
+    from gif_pipeline.database import Database, JobData
+
+
+logger = logging.getLogger(__name__)
+
+job_results = Counter(
+    "gif_pipeline_job_queue_results_total",
+    "Number of job attempts which have finished, by job type and result",
+    labelnames=["job_type", "result"]
+)
+job_age = Histogram(
+    "gif_pipeline_job_queue_job_age_seconds",
+    "Time from a job being queued until it completed or finally failed, by job type",
+    labelnames=["job_type"],
+    buckets=[1, 10, 30, 60, 300, 600, 1800, 3600, 3 * 3600, 12 * 3600, 24 * 3600]
+)
+job_count = Gauge(
+    "gif_pipeline_job_queue_jobs",
+    "Number of jobs in the job queue, by job type and state",
+    labelnames=["job_type", "state"]
+)
+job_oldest_age = Gauge(
+    "gif_pipeline_job_queue_oldest_job_age_seconds",
+    "Age of the oldest job in each job type and state",
+    labelnames=["job_type", "state"]
+)
+
+X = TypeVar("X")
+
+
+class JobFailedException(Exception):
+    """
+    Raised by a job handler when the job can never succeed, such as when what it was for has been removed, so that it
+    fails straight away rather than being retried.
+    """
+    pass
+
+
+class JobState(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _timestamp(time: datetime.datetime) -> str:
+    # Timestamps are compared as strings in queries, so they always use the same format
+    return time.isoformat(timespec="microseconds")
+
+
+class Job:
+    """
+    A unit of work stored in the database, so that it survives restarts. A job records the results of each of its
+    steps as they complete, so a job resumed after a restart can skip the steps it already did.
+    """
+
+    def __init__(self, data: "JobData", queue: "JobQueue") -> None:
+        self.data = data
+        self.queue = queue
+        self.payload: Dict[str, Any] = json.loads(data.payload)
+        self.results: Dict[str, Any] = json.loads(data.result)
+
+    @property
+    def job_id(self) -> int:
+        return self.data.job_id
+
+    @property
+    def attempts(self) -> int:
+        return self.data.attempts
+
+    def save_result(self, step: str, value: Any) -> None:
+        self.results[step] = value
+        self.data.result = json.dumps(self.results)
+        self.queue.save(self.data)
+
+    async def run_step(self, step: str, func: Callable[[], Awaitable[X]], output_file: bool = False) -> X:
+        """
+        Runs a step of the job, unless it completed in an earlier attempt. If output_file is set, the step's result is
+        a file path, and the step is only skipped if that file still exists.
+        """
+        if step in self.results:
+            value = self.results[step]
+            if not output_file or (value is not None and os.path.exists(value)):
+                logger.debug("Skipping step %s of job %s, it already completed", step, self.job_id)
+                return value
+        value = await func()
+        self.save_result(step, value)
+        return value
+
+
+class JobHandler:
+    def __init__(
+            self,
+            job_type: str,
+            func: Callable[[Job], Awaitable[None]],
+            concurrency: int,
+            on_failure: Optional[Callable[[Job, Exception], Awaitable[None]]],
+    ) -> None:
+        self.job_type = job_type
+        self.func = func
+        self.concurrency = concurrency
+        self.on_failure = on_failure
+        self.running: Set[int] = set()
+
+
+class JobQueue:
+    """
+    Durable queue of long-running work, stored in the database. Helpers register a handler for each job type, and
+    queue jobs with a key, so that the same work is not queued twice. Jobs left running when the pipeline stopped are
+    resumed on the next start, and failed jobs are retried a few times with a backoff.
+    """
+    POLL_SECONDS = 30
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 3
+    RETRY_BACKOFF_SECONDS = 60
+    # Finished jobs are kept this long, for job metrics and debugging
+    KEEP_FINISHED_DAYS = 7
+
+    def __init__(self, database: "Database") -> None:
+        self.database = database
+        self.handlers: Dict[str, JobHandler] = {}
+        self._wake = asyncio.Event()
+
+    def register(
+            self,
+            job_type: str,
+            func: Callable[[Job], Awaitable[None]],
+            *,
+            concurrency: int = 1,
+            on_failure: Optional[Callable[[Job, Exception], Awaitable[None]]] = None,
+    ) -> None:
+        self.handlers[job_type] = JobHandler(job_type, func, concurrency, on_failure)
+        for state in JobState:
+            job_count.labels(job_type=job_type, state=state.value)
+            job_oldest_age.labels(job_type=job_type, state=state.value)
+        for result in ["done", "retry", "failed"]:
+            job_results.labels(job_type=job_type, result=result)
+        self._wake.set()
+
+    def enqueue(self, job_type: str, job_key: str, payload: Dict[str, Any]) -> bool:
+        """
+        Queues a job, unless a job of this type with this key is already queued or running. Returns whether it was
+        queued.
+        """
+        added = self.database.add_job(job_type, job_key, json.dumps(payload), _timestamp(_now()))
+        if added:
+            logger.debug("Queued %s job %s", job_type, job_key)
+            self._wake.set()
+        return added
+
+    def save(self, data: "JobData") -> None:
+        data.updated_at = _timestamp(_now())
+        self.database.save_job(data)
+
+    async def run(self) -> None:
+        resumed = self.database.requeue_running_jobs()
+        if resumed:
+            logger.info("Resuming %s jobs which were running when the pipeline last stopped", resumed)
+        self.database.prune_jobs(_timestamp(_now() - datetime.timedelta(days=self.KEEP_FINISHED_DAYS)))
+        while True:
+            self._wake.clear()
+            try:
+                self._requeue_expired_leases()
+                self._dispatch()
+                self._update_metrics()
+            except Exception as e:
+                logger.error("Job queue failed to dispatch jobs", exc_info=e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _requeue_expired_leases(self) -> None:
+        for data in self.database.list_expired_job_leases(_timestamp(_now())):
+            handler = self.handlers.get(data.job_type)
+            if handler is not None and data.job_id in handler.running:
+                # Still running here, its heartbeat has just fallen behind
+                continue
+            logger.warning("Lease expired on %s job %s, queueing it again", data.job_type, data.job_key)
+            data.state = JobState.QUEUED.value
+            data.lease_expires = None
+            self.save(data)
+
+    def _dispatch(self) -> None:
+        now = _now()
+        for handler in self.handlers.values():
+            free = handler.concurrency - len(handler.running)
+            if free <= 0:
+                continue
+            for data in self.database.list_runnable_jobs(handler.job_type, _timestamp(now), free):
+                data.state = JobState.RUNNING.value
+                data.attempts += 1
+                data.lease_expires = _timestamp(now + datetime.timedelta(seconds=self.LEASE_SECONDS))
+                self.save(data)
+                handler.running.add(data.job_id)
+                asyncio.get_event_loop().create_task(self._run_job(handler, Job(data, self)))
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.LEASE_SECONDS / 3)
+            job.data.lease_expires = _timestamp(_now() + datetime.timedelta(seconds=self.LEASE_SECONDS))
+            self.save(job.data)
+
+    async def _run_job(self, handler: JobHandler, job: Job) -> None:
+        data = job.data
+        logger.info("Running %s job %s, attempt %s", data.job_type, data.job_key, data.attempts)
+        heartbeat = asyncio.get_event_loop().create_task(self._heartbeat(job))
+        try:
+            await handler.func(job)
+        except Exception as e:
+            data.error = str(e)
+            data.lease_expires = None
+            if data.attempts < self.MAX_ATTEMPTS and not isinstance(e, JobFailedException):
+                logger.warning("%s job %s failed, will retry", data.job_type, data.job_key, exc_info=e)
+                job_results.labels(job_type=data.job_type, result="retry").inc()
+                data.state = JobState.QUEUED.value
+                backoff = self.RETRY_BACKOFF_SECONDS * data.attempts
+                data.run_after = _timestamp(_now() + datetime.timedelta(seconds=backoff))
+                self.save(data)
+            else:
+                logger.error("%s job %s failed, giving up", data.job_type, data.job_key, exc_info=e)
+                job_results.labels(job_type=data.job_type, result="failed").inc()
+                data.state = JobState.FAILED.value
+                self.save(data)
+                self._observe_age(data)
+                if handler.on_failure is not None:
+                    try:
+                        await handler.on_failure(job, e)
+                    except Exception as failure_e:
+                        logger.error("Failure handler for %s job failed", data.job_type, exc_info=failure_e)
+        else:
+            job_results.labels(job_type=data.job_type, result="done").inc()
+            data.state = JobState.DONE.value
+            data.lease_expires = None
+            self.save(data)
+            self._observe_age(data)
+        finally:
+            # If the pipeline is stopping, the job is left in the running state, to be resumed on next start
+            heartbeat.cancel()
+            handler.running.discard(data.job_id)
+            self._wake.set()
+
+    @staticmethod
+    def _observe_age(data: "JobData") -> None:
+        age = (_now() - dateutil.parser.parse(data.created_at)).total_seconds()
+        job_age.labels(job_type=data.job_type).observe(age)
+
+    def _update_metrics(self) -> None:
+        now = _now()
+        counts = self.database.count_jobs()
+        for job_type in self.handlers:
+            for state in JobState:
+                count, oldest = counts.get((job_type, state.value), (0, None))
+                job_count.labels(job_type=job_type, state=state.value).set(count)
+                age = (now - dateutil.parser.parse(oldest)).total_seconds() if oldest else 0
+                job_oldest_age.labels(job_type=job_type, state=state.value).set(age)
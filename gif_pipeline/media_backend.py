@@ -0,0 +1,132 @@
+import enum
+import json
+import logging
+from typing import Dict, Optional, TYPE_CHECKING, List, Tuple
+
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.ffmprobe_task import FFprobeTask
+from gif_pipeline.tasks.libav_task import LibavProbeTask, LibavFrameTask, LibavKeyframesTask, \
+    libav_available, closed_gop_keyframes, CLOSED_GOP_READ_SECONDS
+
+if TYPE_CHECKING:
+    from gif_pipeline.tasks.task_worker import TaskWorker
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaBackendType(enum.Enum):
+    SUBPROCESS = "subprocess"  # Run ffprobe and ffmpeg as subprocesses
+    LIBAV = "libav"  # Call libav in-process, with PyAV
+
+
+class MediaBackend:
+    """
+    Chooses how probes and single frame grabs are run. Both backends give the same results, the libav backend avoids
+    the cost of starting a subprocess for each one, which adds up over many small files.
+    """
+
+    def __init__(self) -> None:
+        self.backend_type = MediaBackendType.SUBPROCESS
+
+    def configure(self, backend_type: MediaBackendType) -> None:
+        if backend_type == MediaBackendType.LIBAV and not libav_available():
+            logger.warning("The libav media backend requires PyAV to be installed, falling back to subprocesses")
+            backend_type = MediaBackendType.SUBPROCESS
+        if backend_type != self.backend_type:
+            logger.info("Using %s media backend", backend_type.value)
+        self.backend_type = backend_type
+
+    async def probe(self, worker: "TaskWorker", video_path: str) -> Dict:
+        """
+        Returns the format and streams of a file, as parsed `ffprobe -show_format -show_streams` json output
+        """
+        if self.backend_type == MediaBackendType.LIBAV:
+            return await worker.await_task(LibavProbeTask(video_path))
+        probe_task = FFprobeTask(
+            global_options=["-v error -of json -show_format -show_streams"],
+            inputs={video_path: ""}
+        )
+        return json.loads(await worker.await_task(probe_task))
+
+    async def keyframes(
+            self,
+            worker: "TaskWorker",
+            video_path: str,
+            intervals: List[Tuple[float, float]],
+            closed_gop: bool = False,
+    ) -> List[float]:
+        """
+        Returns the sorted timestamps of video keyframes within the given (start, end) intervals, in seconds from the
+        start of the file. Only the packets around each interval are read, so this is quick even for long videos.
+        If closed_gop is set, only keyframes which start a closed GOP, which a stream can be cut at cleanly, are given.
+        """
+        if self.backend_type == MediaBackendType.LIBAV:
+            return await worker.await_task(LibavKeyframesTask(video_path, intervals, closed_gop))
+        read_margin = CLOSED_GOP_READ_SECONDS if closed_gop else 0
+        read_intervals = ",".join(f"{max(0.0, start)}%{end + read_margin}" for start, end in intervals)
+        probe_task = FFprobeTask(
+            global_options=[
+                "-v error -of json -select_streams v:0 -show_entries packet=pts_time,dts_time,flags:format=start_time "
+                f"-read_intervals {read_intervals}"
+            ],
+            inputs={video_path: ""}
+        )
+        probe = json.loads(await worker.await_task(probe_task))
+        # Seeks are relative to the start time of the file, but packet timestamps are not
+        try:
+            start_time = float(probe.get("format", {}).get("start_time", 0))
+        except ValueError:
+            start_time = 0.0
+        packets = []
+        for packet in probe.get("packets", []):
+            try:
+                timestamp = float(packet["pts_time"]) - start_time
+            except (KeyError, ValueError):
+                continue
+            try:
+                dts = float(packet["dts_time"]) - start_time
+            except (KeyError, ValueError):
+                dts = None
+            packets.append((timestamp, dts, "K" in packet.get("flags", "")))
+        if closed_gop:
+            keyframes = closed_gop_keyframes(packets)
+        else:
+            keyframes = {timestamp for timestamp, _, is_keyframe in packets if is_keyframe}
+        return sorted(k for k in keyframes if any(start <= k <= end for start, end in intervals))
+
+    async def grab_frame(
+            self,
+            worker: "TaskWorker",
+            video_path: str,
+            output_path: str,
+            timestamp: float,
+            max_width: Optional[int] = None,
+            max_height: Optional[int] = None,
+    ) -> None:
+        """
+        Saves one frame of the video, at the given timestamp, as an image. If a maximum width and height are given, the
+        frame is shrunk to fit inside them.
+        """
+        if self.backend_type == MediaBackendType.LIBAV:
+            await worker.await_task(LibavFrameTask(video_path, output_path, timestamp, max_width, max_height))
+            return
+        output_options = f"-ss {timestamp} -vframes 1"
+        if max_width is not None and max_height is not None:
+            output_options += (
+                f" -vf \"scale='min({max_width},iw)':'min({max_height},ih)':force_original_aspect_ratio=decrease\""
+            )
+        thumb_task = FfmpegTask(
+            purpose="thumbnail",
+            global_options=["-y"],
+            inputs={
+                video_path: None,
+            },
+            outputs={
+                output_path: output_options
+            }
+        )
+        await worker.await_task(thumb_task)
+
+
+media_backend = MediaBackend()
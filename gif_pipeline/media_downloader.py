@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import itertools
+import logging
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from prometheus_client import Gauge, Counter
+
+from gif_pipeline.startup_tracer import startup_tracer
+from gif_pipeline.tasks.task_worker import Bottleneck, TaskPriority, current_task_tenant
+
+if TYPE_CHECKING:
+    from gif_pipeline.message import Message, MessageData
+    from gif_pipeline.telegram_client import TelegramClient
+
+
+logger = logging.getLogger(__name__)
+
+pending_downloads = Gauge(
+    "gif_pipeline_media_pending_downloads",
+    "Number of messages whose media is still waiting to be downloaded"
+)
+downloads_completed = Counter(
+    "gif_pipeline_media_downloads_total",
+    "Total number of lazy media downloads completed, by the priority they were downloaded at",
+    labelnames=["priority"]
+)
+downloads_failed = Counter(
+    "gif_pipeline_media_download_failures_total",
+    "Total number of lazy media downloads which failed",
+    labelnames=["priority"]
+)
+
+
+class DownloadPriority(enum.IntEnum):
+    COMMAND = 0  # Media referenced by a user command or menu
+    SCHEDULE = 1  # Media sitting in a scheduled channel queue
+    BACKGROUND = 2  # Everything else
+
+
+for _priority in DownloadPriority:
+    downloads_completed.labels(priority=_priority.name.lower())
+    downloads_failed.labels(priority=_priority.name.lower())
+
+# Priority class each download waits for a slot in, as it shares the telegram download pool with other downloads
+TASK_PRIORITIES = {
+    DownloadPriority.COMMAND: TaskPriority.INTERACTIVE,
+    DownloadPriority.SCHEDULE: TaskPriority.SCHEDULED_POST,
+    DownloadPriority.BACKGROUND: TaskPriority.BACKGROUND,
+}
+
+
+class MediaDownloader:
+    """
+    Downloads message media in the background, in priority order, so that chats can be created and the pipeline can
+    start running before every video has been downloaded. Downloads run in the slots of the given bottleneck, so the
+    number at once can be adjusted while running.
+    Downloads are keyed by message data, as a message can be re-created while its download is queued, such as when it is
+    edited, and every message object waiting for the download is marked ready once it completes.
+    """
+
+    def __init__(self, client: TelegramClient, bottleneck: Bottleneck):
+        self.client = client
+        self.bottleneck = bottleneck
+        self._queue: Optional[asyncio.PriorityQueue[Tuple[int, int, MessageData]]] = None
+        self._counter = itertools.count()
+        self._pending: Dict[MessageData, DownloadPriority] = {}
+        self._futures: Dict[MessageData, asyncio.Future] = {}
+        # Message objects waiting for each download, newest last
+        self._messages: Dict[MessageData, List[Message]] = {}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._downloads: Set[asyncio.Task] = set()
+        # The message which the dispatcher is waiting for a slot for, and its place in the queue for a slot
+        self._waiting_message: Optional[MessageData] = None
+        self._slot_waiter = None
+        pending_downloads.set_function(lambda: len(self._pending))
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def _start_dispatcher(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.get_event_loop().create_task(self._dispatch())
+
+    def _track(self, message: Message) -> None:
+        messages = self._messages.setdefault(message.message_data, [])
+        if not any(tracked is message for tracked in messages):
+            messages.append(message)
+
+    def enqueue(self, message: Message, priority: DownloadPriority = DownloadPriority.BACKGROUND) -> None:
+        if not message.media_pending:
+            return
+        self._track(message)
+        key = message.message_data
+        current_priority = self._pending.get(key)
+        if current_priority is not None and current_priority <= priority:
+            return
+        self._start_dispatcher()
+        self._pending[key] = priority
+        if key == self._waiting_message and self._slot_waiter is not None:
+            self.bottleneck.pool.promote(self._slot_waiter, TASK_PRIORITIES[priority])
+        # Any earlier, lower priority, queue entry for this message will be skipped when it is reached
+        self._queue.put_nowait((priority, next(self._counter), key))
+
+    async def wait_for(self, message: Message, priority: DownloadPriority = DownloadPriority.COMMAND) -> None:
+        if not message.media_pending:
+            return
+        future = self._futures.get(message.message_data)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._futures[message.message_data] = future
+        self.enqueue(message, priority)
+        await asyncio.shield(future)
+
+    async def _dispatch(self) -> None:
+        pool = self.bottleneck.pool
+        tenant = current_task_tenant.get()
+        while True:
+            priority, _, key = await self._queue.get()
+            self._queue.task_done()
+            if self._pending.get(key) != priority:
+                # Stale entry, the message has either been downloaded or re-queued at a higher priority
+                continue
+            self._waiting_message = key
+            try:
+                await pool.acquire(TASK_PRIORITIES[priority], tenant, self._set_slot_waiter)
+            finally:
+                self._waiting_message = None
+                self._slot_waiter = None
+            # The message may have been re-queued at a higher priority while waiting for the slot
+            priority = self._pending.get(key, priority)
+            download = asyncio.get_event_loop().create_task(self._download_in_slot(key, DownloadPriority(priority)))
+            self._downloads.add(download)
+            download.add_done_callback(self._downloads.discard)
+
+    def _set_slot_waiter(self, waiter) -> None:
+        self._slot_waiter = waiter
+
+    async def _download_in_slot(self, key: MessageData, priority: DownloadPriority) -> None:
+        try:
+            await self._download(key, priority)
+        finally:
+            self.bottleneck.pool.release()
+
+    async def _download(self, key: MessageData, priority: DownloadPriority) -> None:
+        # The newest message object has the most up to date data for the message
+        message = self._messages[key][-1]
+        message_data = message.message_data
+        priority_label = priority.name.lower()
+        chat_title = message.chat_data.title
+        try:
+            logger.info(f"Downloading video from message: {message_data}, at priority: {priority.name}")
+            video_path = message_data.expected_file_path(message.chat_data)
+            with startup_tracer.group_span(
+                    f"download_{message_data.chat_id}",
+                    f"Download {chat_title}",
+                    "chat_download",
+                    args={"chat_id": message_data.chat_id},
+            ), startup_tracer.span(
+                    f"Download {chat_title} #{message_data.message_id}",
+                    "media_download",
+                    args={"priority": priority.name},
+            ):
+                await self.client.download_media(message_data.chat_id, message_data.message_id, video_path)
+        except Exception as e:
+            logger.error("Failed to download media for message: %s", message_data, exc_info=e)
+            downloads_failed.labels(priority=priority_label).inc()
+            self._pending.pop(key, None)
+            self._messages.pop(key, None)
+            future = self._futures.pop(key, None)
+            if future is not None and not future.done():
+                future.set_exception(e)
+            return
+        self._pending.pop(key, None)
+        for waiting_message in self._messages.pop(key, []):
+            waiting_message.media_ready()
+        downloads_completed.labels(priority=priority_label).inc()
+        future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(None)
@@ -12,6 +12,7 @@ if TYPE_CHECKING:
     from telegram_client import TelegramClient
     from gif_pipeline.database import Database
     from gif_pipeline.chat_data import ChatData
+    from gif_pipeline.media_downloader import MediaDownloader, DownloadPriority
 
 
 logger = logging.getLogger(__name__)
@@ -36,7 +37,8 @@ class MessageData:
             reply_to: Optional[int],
             sender_id: int,
             is_scheduled: bool,
-            forwarded_channel_link: Optional[str] = None
+            forwarded_channel_link: Optional[str] = None,
+            edit_datetime: Optional[datetime.datetime] = None,
     ):
         self.chat_id = chat_id
         self.message_id = message_id
@@ -51,6 +53,7 @@ class MessageData:
         self.sender_id = sender_id
         self.is_scheduled = is_scheduled
         self.forwarded_channel_link = forwarded_channel_link
+        self.edit_datetime = edit_datetime
 
     def __repr__(self) -> str:
         return f"MessageData(chat_id={self.chat_id or self.chat_id}, message_id={self.message_id})"
@@ -82,10 +85,17 @@ class MessageData:
 
 class Message:
 
-    def __init__(self, message_data: MessageData, chat_data: ChatData):
+    def __init__(
+            self,
+            message_data: MessageData,
+            chat_data: ChatData,
+            media_downloader: Optional[MediaDownloader] = None
+    ):
         self.chat_data = chat_data
         self.message_data = message_data
         self._tags = None
+        # Set while the media file for this message is still waiting to be downloaded
+        self._media_downloader = media_downloader
 
     @property
     def has_video(self) -> bool:
@@ -99,9 +109,27 @@ class Message:
     def text(self) -> str:
         return self.message_data.text
 
-    @classmethod
-    async def from_message_data(cls, message_data: MessageData, chat_data: 'ChatData', client: 'TelegramClient'):
-        logger.debug(f"Creating message: {message_data}")
+    @property
+    def media_pending(self) -> bool:
+        return self._media_downloader is not None
+
+    async def ensure_media(self, priority: Optional[DownloadPriority] = None) -> None:
+        """
+        Waits until the media file for this message is available on disc, bumping it to the front of the download
+        queue if it has not been downloaded yet.
+        """
+        if self._media_downloader is None:
+            return
+        if priority is None:
+            await self._media_downloader.wait_for(self)
+        else:
+            await self._media_downloader.wait_for(self, priority)
+
+    def media_ready(self) -> None:
+        self._media_downloader = None
+
+    @staticmethod
+    def _prepare_message_data(message_data: MessageData, chat_data: ChatData) -> None:
         # Update file path if not set
         video_path = message_data.expected_file_path(chat_data)
         if video_path is not None and message_data.file_path is None:
@@ -111,13 +139,36 @@ class Message:
             message_data.file_path = None
             message_data.file_size = None
             message_data.file_mime_type = None
+
+    @classmethod
+    async def from_message_data(cls, message_data: MessageData, chat_data: 'ChatData', client: 'TelegramClient'):
+        logger.debug(f"Creating message: {message_data}")
+        cls._prepare_message_data(message_data, chat_data)
         # Download file if necessary
         if cls.needs_download(message_data):
             logger.info(f"Downloading video from message: {message_data}")
+            video_path = message_data.expected_file_path(chat_data)
             await client.download_media(message_data.chat_id, message_data.message_id, video_path)
         # Create message
         return Message(message_data, chat_data)
 
+    @classmethod
+    def from_message_data_lazy(
+            cls,
+            message_data: MessageData,
+            chat_data: 'ChatData',
+            media_downloader: 'MediaDownloader',
+            priority: 'DownloadPriority',
+    ) -> 'Message':
+        logger.debug(f"Creating message, without waiting for media: {message_data}")
+        cls._prepare_message_data(message_data, chat_data)
+        if not cls.needs_download(message_data):
+            return Message(message_data, chat_data)
+        # Queue the download, and hand back a message in the media pending state
+        message = Message(message_data, chat_data, media_downloader)
+        media_downloader.enqueue(message, priority)
+        return message
+
     @classmethod
     def needs_download(cls, message_data: MessageData) -> bool:
         if message_data.has_file:
@@ -1,6 +1,9 @@
 import asyncio
+import datetime
+import json
 import logging
-from typing import Dict, List, Optional, Iterable, Union, Tuple
+import signal
+from typing import Dict, List, Optional, Iterable, Union, Tuple, AsyncIterator
 
 from prometheus_client import Info
 from telethon import events
@@ -11,30 +14,32 @@ from gif_pipeline.chat_builder import ChannelBuilder, WorkshopBuilder
 from gif_pipeline.database import Database
 from gif_pipeline.chat import Chat, Channel, WorkshopGroup
 from gif_pipeline.chat_config import ChannelConfig, WorkshopConfig
+from gif_pipeline.chat_data import ChannelData, WorkshopData
 from gif_pipeline.helpers.audio_helper import AudioHelper
 from gif_pipeline.helpers.caption_helper import CaptionHelper
 from gif_pipeline.helpers.channel_fwd_tag_helper import ChannelFwdTagHelper
-from gif_pipeline.helpers.chart_helper import ChartHelper
 from gif_pipeline.helpers.chunk_split_helper import ChunkSplitHelper
 from gif_pipeline.helpers.delete_helper import DeleteHelper
 from gif_pipeline.helpers.download_helper import DownloadHelper
 from gif_pipeline.helpers.duplicate_helper import DuplicateHelper
+from gif_pipeline.helpers.edit_chain_helper import EditChainHelper
 from gif_pipeline.helpers.fa_helper import FAHelper
 from gif_pipeline.helpers.ffprobe_helper import FFProbeHelper
-from gif_pipeline.helpers.find_helper import FindHelper
-from gif_pipeline.helpers.frigate_helper import FrigateHelper
+from gif_pipeline.helpers.helpers import Helper
+from gif_pipeline.helpers.lazy_helper import LazyHelper, CommandTrigger, FirstWordTrigger
 from gif_pipeline.helpers.menu_helper import MenuHelper
 from gif_pipeline.helpers.merge_helper import MergeHelper
 from gif_pipeline.helpers.msg_helper import MSGHelper
 from gif_pipeline.helpers.public.public_tag_helper import PublicTagHelper
-from gif_pipeline.helpers.qr_helper import QRCodeReaderHelper
+from gif_pipeline.helpers.reload_helper import ReloadHelper
 from gif_pipeline.helpers.reverse_helper import ReverseHelper
-from gif_pipeline.helpers.scene_split_helper import SceneSplitHelper
 from gif_pipeline.helpers.schedule_helper import ScheduleHelper
 from gif_pipeline.helpers.send_helper import GifSendHelper
 from gif_pipeline.helpers.stabilise_helper import StabiliseHelper
 from gif_pipeline.helpers.subscription_helper import SubscriptionHelper
 from gif_pipeline.helpers.tag_helper import TagHelper
+from gif_pipeline.helpers.task_stats_helper import TaskStatsHelper
+from gif_pipeline.helpers.cancel_helper import CancelHelper
 from gif_pipeline.helpers.telegram_gif_helper import TelegramGifHelper
 from gif_pipeline.helpers.thumbnail_helper import ThumbnailHelper
 from gif_pipeline.helpers.update_yt_dl_helper import UpdateYoutubeDlHelper
@@ -44,13 +49,24 @@ from gif_pipeline.helpers.video_helper import VideoHelper
 from gif_pipeline.helpers.video_rotate_helper import VideoRotateHelper
 from gif_pipeline.helpers.video_speed_helper import VideoSpeedHelper
 from gif_pipeline.helpers.zip_helper import ZipHelper
+from gif_pipeline.media_downloader import MediaDownloader, DownloadPriority
+from gif_pipeline.init_graph import InitGraph
+from gif_pipeline.job_queue import JobQueue
+from gif_pipeline.media_backend import media_backend, MediaBackendType
 from gif_pipeline.menu_cache import MenuCache
 from gif_pipeline.message import Message, MessageData
+from gif_pipeline.remote_workers import RemoteWorkerConfig, RemoteWorkerServer
+from gif_pipeline.snapshot import SnapshotStore, PipelineSnapshot
 from gif_pipeline.startup_monitor import StartupMonitor, StartupState
+from gif_pipeline.startup_tracer import startup_tracer
 from gif_pipeline.tag_manager import TagManager
-from gif_pipeline.tasks.task_worker import TaskWorker, Bottleneck
+from gif_pipeline.tasks.cpu_budget import cpu_budget
+from gif_pipeline.tasks.concurrency_controller import ConcurrencyController, AdaptiveConcurrencyConfig
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import TaskWorker, Bottleneck, task_tenant
 from gif_pipeline.telegram_client import TelegramClient, message_data_from_telegram, chat_id_from_telegram
-from gif_pipeline.utils import tqdm_gather
+from gif_pipeline.utils import stream_gather, StreamGroup
+from gif_pipeline.video_info import VideoInfoStore
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +75,9 @@ version_info = Info(
     "Version of gif pipeline currently running"
 )
 
+# How often to prune the database change log, when there is no warm start snapshot to replay it onto
+CHANGE_PRUNE_INTERVAL_MINUTES = 15
+
 
 class WebsiteConfig:
 
@@ -78,13 +97,23 @@ class WebsiteConfig:
 
 
 class PipelineConfig:
-
-    def __init__(self, config: Dict):
-        version_info.info({
-            "version": _version.__VERSION__
-        })
-        self.startup_monitor = StartupMonitor()
-        self.startup_monitor.set_state(StartupState.LOADING_CONFIG)
+    # Maximum number of messages being created at once during startup
+    MESSAGE_INIT_CONCURRENCY = 100
+
+    def __init__(self, config: Dict, config_path: str = "config.json", startup_monitor: Optional[StartupMonitor] = None):
+        self.config_path = config_path
+        if startup_monitor is None:
+            version_info.info({
+                "version": _version.__VERSION__
+            })
+            # Optional chrome trace of startup, enabled first so that it covers every startup state
+            trace_config = config.get("startup_trace")
+            if trace_config is not None:
+                startup_tracer.enable(trace_config["path"], trace_config.get("post_startup_seconds", 0))
+            startup_monitor = StartupMonitor()
+            startup_monitor.set_state(StartupState.LOADING_CONFIG)
+        # A config being reloaded into a running pipeline is given the running pipeline's startup monitor
+        self.startup_monitor = startup_monitor
         self.channels = [ChannelConfig.from_json(x) for x in config['channels']]
         self.workshops = [WorkshopConfig.from_json(x) for x in config["workshop_groups"]]
         self.workshops += [chan.queue for chan in self.channels if chan.queue is not None]
@@ -98,6 +127,32 @@ class PipelineConfig:
         self.api_keys = config.get("api_keys", {})
         # Website configuration
         self.website_config = WebsiteConfig.from_json(config.get("website", {}))
+        # Warm start snapshot configuration
+        self.warm_start_config = config.get("warm_start")
+        # Number of task worker slots for each resource class
+        self.task_pool_sizes = {
+            ResourceClass(name): size for name, size in config.get("task_pools", {}).items()
+        }
+        # Whether to probe videos and grab frames with ffmpeg subprocesses, or in-process with PyAV
+        self.media_backend = MediaBackendType(config.get("media_backend", MediaBackendType.SUBPROCESS.value))
+        # Time limits for tasks by task type, in seconds, overriding their defaults. null for no limit.
+        self.task_timeouts = config.get("task_timeouts", {})
+        # Number of threads shared between the running encode and hash tasks, or None or 0 to let ffmpeg decide
+        self.thread_budget = config.get("thread_budget")
+        # Bounds for adaptively sizing task pools, if enabled
+        self.adaptive_concurrency = None
+        if "adaptive_concurrency" in config:
+            self.adaptive_concurrency = AdaptiveConcurrencyConfig.from_json(config["adaptive_concurrency"])
+        # Optional server for remote worker nodes to take encode and hash tasks from
+        self.remote_worker_config = None
+        if "remote_workers" in config:
+            self.remote_worker_config = RemoteWorkerConfig.from_json(config["remote_workers"])
+
+    @classmethod
+    def from_file(cls, config_path: str, startup_monitor: Optional[StartupMonitor] = None) -> "PipelineConfig":
+        with open(config_path, "r") as f:
+            config = json.load(f)
+        return cls(config, config_path, startup_monitor)
 
     def initialise_pipeline(self) -> 'Pipeline':
         self.startup_monitor.set_state(StartupState.CREATING_DATABASE)
@@ -105,19 +160,47 @@ class PipelineConfig:
         self.startup_monitor.set_state(StartupState.CONNECTING_TELEGRAM)
         client = TelegramClient(self.api_id, self.api_hash, self.pipeline_bot_token, self.public_bot_token)
         client.synchronise_async(client.initialise())
-        channels, workshops = client.synchronise_async(self.initialise_chats(database, client))
+        self.startup_monitor.set_state(StartupState.LOADING_SNAPSHOT)
+        snapshot_store = None
+        snapshot = None
+        if self.warm_start_config is not None:
+            snapshot_store = SnapshotStore(
+                database,
+                self.warm_start_config.get("path", "pipeline_snapshot.bin"),
+                self.warm_start_config.get("interval_minutes", 15),
+            )
+            snapshot = snapshot_store.load()
+        else:
+            # Nothing will replay the change log without a snapshot, so don't let it grow
+            database.prune_changes(database.get_latest_change_id())
+        media_downloader = MediaDownloader(client, Bottleneck(3, "telegram_download"))
+        channels, workshops = client.synchronise_async(
+            self.initialise_chats(database, client, media_downloader, snapshot)
+        )
         self.startup_monitor.set_state(StartupState.CREATING_PIPELINE)
-        pipe = Pipeline(database, client, channels, workshops, self.api_keys, self.startup_monitor)
+        pipe = Pipeline(
+            self,
+            database,
+            client,
+            channels,
+            workshops,
+            self.api_keys,
+            self.startup_monitor,
+            media_downloader,
+            snapshot_store,
+            snapshot,
+        )
         return pipe
 
     async def initialise_chats(
             self,
             database: Database,
-            client: TelegramClient
+            client: TelegramClient,
+            media_downloader: MediaDownloader,
+            snapshot: Optional[PipelineSnapshot] = None,
     ) -> Tuple[List[Channel], List[WorkshopGroup]]:
-        download_bottleneck = Bottleneck(3)
-        workshop_builder = WorkshopBuilder(database, client, download_bottleneck)
-        channel_builder = ChannelBuilder(database, client, download_bottleneck)
+        workshop_builder = WorkshopBuilder(database, client, media_downloader, snapshot)
+        channel_builder = ChannelBuilder(database, client, media_downloader, snapshot)
         # Get chat data for chat config
         self.startup_monitor.set_state(StartupState.INITIALISING_CHAT_DATA)
         logger.info("Initialising workshop data")
@@ -125,35 +208,26 @@ class PipelineConfig:
         logger.info("Initialising channel data")
         channel_data = await channel_builder.get_chat_data(self.channels)
 
-        message_inits = []
-        self.startup_monitor.set_state(StartupState.LISTING_WORKSHOP_MESSAGES)
-        logger.info("Listing messages in workshops")
-        workshop_message_lists = await workshop_builder.get_message_inits(self.workshops, workshop_data)
-        workshop_message_counts = [len(x) for x in workshop_message_lists]
-        message_inits += [init for message_list in workshop_message_lists for init in message_list]
-        self.startup_monitor.set_state(StartupState.LISTING_CHANNEL_MESSAGES)
-        logger.info("Listing messages in channels")
-        channel_message_lists = await channel_builder.get_message_inits(self.channels, channel_data)
-        channel_message_counts = [len(x) for x in channel_message_lists]
-        message_inits += [init for message_list in channel_message_lists for init in message_list]
-
-        self.startup_monitor.set_state(StartupState.DOWNLOADING_MESSAGES)
-        logger.info("Downloading messages")
-        all_messages = await tqdm_gather(message_inits, desc="Downloading messages")
+        # Messages are listed chat by chat, and created as they are listed, with a bounded number in flight.
+        # Media is not downloaded here, messages start in the media pending state and download in the background
+        chat_messages: Dict[int, List[Message]] = {}
+        message_groups = self.iter_message_groups(workshop_builder, workshop_data, channel_builder, channel_data)
+        async for chat_id, messages in stream_gather(message_groups, self.MESSAGE_INIT_CONCURRENCY, "Creating messages"):
+            logger.info("Created %s messages for chat ID %s", len(messages), chat_id)
+            chat_messages[chat_id] = messages
+        logger.info("Queued %s media downloads", media_downloader.pending_count)
 
         logger.info("Creating workshops")
         self.startup_monitor.set_state(StartupState.CREATING_WORKSHOPS)
         workshop_dict = {}
-        for work_conf, work_data, message_count in zip(self.workshops, workshop_data, workshop_message_counts):
-            work_messages = all_messages[:message_count]
-            all_messages = all_messages[message_count:]
+        for work_conf, work_data in zip(self.workshops, workshop_data):
+            work_messages = chat_messages.pop(work_data.chat_id)
             workshop_dict[work_conf.handle] = WorkshopGroup(work_data, work_conf, work_messages, client)
         logger.info("Creating channels")
         self.startup_monitor.set_state(StartupState.CREATING_CHANNELS)
         channels = []
-        for chan_conf, chan_data, message_count in zip(self.channels, channel_data, channel_message_counts):
-            chan_messages = all_messages[:message_count]
-            all_messages = all_messages[message_count:]
+        for chan_conf, chan_data in zip(self.channels, channel_data):
+            chan_messages = chat_messages.pop(chan_data.chat_id)
             queue = None
             if chan_conf.queue:
                 queue = workshop_dict[chan_conf.queue.handle]
@@ -168,28 +242,75 @@ class PipelineConfig:
         logger.info("Initialised channels and workshops")
         return channels, workshops
 
+    async def iter_message_groups(
+            self,
+            workshop_builder: WorkshopBuilder,
+            workshop_data: List[WorkshopData],
+            channel_builder: ChannelBuilder,
+            channel_data: List[ChannelData],
+    ) -> AsyncIterator[StreamGroup[int, Message]]:
+        self.startup_monitor.set_state(StartupState.LISTING_WORKSHOP_MESSAGES)
+        logger.info("Listing messages in workshops")
+        async for group in workshop_builder.iter_message_inits(self.workshops, workshop_data):
+            yield group
+        self.startup_monitor.set_state(StartupState.LISTING_CHANNEL_MESSAGES)
+        logger.info("Listing messages in channels")
+        async for group in channel_builder.iter_message_inits(self.channels, channel_data):
+            yield group
+        # Listing is complete, any remaining time is spent creating the messages already listed
+        self.startup_monitor.set_state(StartupState.DOWNLOADING_MESSAGES)
+        logger.info("Creating messages")
+
 
 class Pipeline:
     def __init__(
             self,
+            pipeline_config: PipelineConfig,
             database: Database,
             client: TelegramClient,
             channels: List[Channel],
             workshops: List[WorkshopGroup],
             api_keys: Dict[str, Dict[str, str]],
-            startup_monitor: StartupMonitor
+            startup_monitor: StartupMonitor,
+            media_downloader: MediaDownloader,
+            snapshot_store: Optional[SnapshotStore] = None,
+            snapshot: Optional[PipelineSnapshot] = None,
     ):
+        self.pipeline_config = pipeline_config
         self.database = database
         self.channels = channels
         self.workshops = workshops
         self.client = client
         self.api_keys = api_keys
-        self.worker = TaskWorker(3)
-        self.helpers = {}
+        self.worker = TaskWorker(pipeline_config.task_pool_sizes)
+        self.worker.set_task_timeouts(pipeline_config.task_timeouts)
+        media_backend.configure(pipeline_config.media_backend)
+        cpu_budget.configure(pipeline_config.thread_budget, self.cpu_bound_running_count)
+        self.video_info_store = VideoInfoStore(self.database, self.worker)
+        self.remote_workers = None
+        if pipeline_config.remote_worker_config is not None:
+            self.remote_workers = RemoteWorkerServer(pipeline_config.remote_worker_config)
+            self.worker.remote = self.remote_workers
+        # Durable queue of long-running background work, which helpers register job types with
+        self.job_queue = JobQueue(self.database)
+        self.helpers: Dict[str, Union[Helper, LazyHelper]] = {}
         self.public_helpers = {}
         self.menu_cache = MenuCache(database)  # MenuHelper later populates this from database
-        self.download_bottleneck = Bottleneck(3)
+        # Lazy media downloads share this bottleneck, so that the controller can size all telegram downloads together
+        self.download_bottleneck = media_downloader.bottleneck
+        self.concurrency_controller = ConcurrencyController({
+            **{pool.name: pool for pool in self.worker.pools.values()},
+            self.download_bottleneck.pool.name: self.download_bottleneck.pool,
+        })
+        self.concurrency_controller.configure(pipeline_config.adaptive_concurrency)
+        self.media_downloader = media_downloader
         self.startup_monitor = startup_monitor
+        self.snapshot_store = snapshot_store
+        # Snapshot the pipeline was warm started from, if any. Dropped once chats have been reconciled with telegram
+        self.snapshot = snapshot
+        # Chat IDs which event handlers listen to, updated in place when config is reloaded
+        self.watched_chat_ids: List[int] = []
+        self.reload_lock = asyncio.Lock()
 
     @property
     def all_chats(self) -> List[Chat]:
@@ -226,92 +347,145 @@ class Pipeline:
         handle = link_split[-2]
         return self.get_message_for_handle_and_id(handle, message_id)
 
+    def get_helper(self, name: str) -> Helper:
+        helper = self.helpers[name]
+        if isinstance(helper, LazyHelper):
+            return helper.load()
+        return helper
+
     def initialise_helpers(self) -> None:
         logger.info("Initialising helpers")
-        self.startup_monitor.set_state(StartupState.INITIALISING_DUPLICATE_DETECTOR)
-        duplicate_helper = self.client.synchronise_async(self.initialise_duplicate_detector())
         self.startup_monitor.set_state(StartupState.INITIALISING_HELPERS)
+        # The duplicate helper hashes any unhashed videos in the background, once startup is complete
+        duplicate_helper = DuplicateHelper(self.database, self.client, self.worker, self.video_info_store, self)
         tag_manager = TagManager(self.database)
-        delete_helper = DeleteHelper(self.database, self.client, self.worker, self.menu_cache)
-        menu_helper = MenuHelper(self.database, self.client, self.worker, self, delete_helper, tag_manager)
+        delete_helper = DeleteHelper(self.database, self.client, self.worker, self.video_info_store, self.menu_cache)
+        menu_helper = MenuHelper(
+            self.database, self.client, self.worker, self.video_info_store, self, delete_helper, tag_manager
+        )
         twitter_keys = self.api_keys.get("twitter", {})
-        send_helper = GifSendHelper(self.database, self.client, self.worker, self.channels, menu_helper, twitter_keys)
+        send_helper = GifSendHelper(
+            self.database, self.client, self.worker, self.video_info_store, self.channels, menu_helper, twitter_keys
+        )
         schedule_helper = ScheduleHelper(
             self.database,
             self.client,
             self.worker,
+            self.video_info_store,
             self.channels,
             menu_helper,
             send_helper,
             delete_helper,
             tag_manager
         )
-        download_helper = DownloadHelper(self.database, self.client, self.worker)
-        ffprobe_helper = FFProbeHelper(self.database, self.client, self.worker)
+        download_helper = DownloadHelper(self.database, self.client, self.worker, self.video_info_store)
+        ffprobe_helper = FFProbeHelper(self.database, self.client, self.worker, self.video_info_store)
         subscription_helper = SubscriptionHelper(
             self.database,
             self.client,
             self.worker,
+            self.video_info_store,
             self,
             duplicate_helper,
             download_helper,
             ffprobe_helper,
             self.api_keys,
         )
+        gif_helper = TelegramGifHelper(self.database, self.client, self.worker, self.video_info_store)
+        rotate_helper = VideoRotateHelper(self.database, self.client, self.worker, self.video_info_store)
+        cut_helper = VideoCutHelper(self.database, self.client, self.worker, self.video_info_store)
+        crop_helper = VideoCropHelper(self.database, self.client, self.worker, self.video_info_store)
+        speed_helper = VideoSpeedHelper(self.database, self.client, self.worker, self.video_info_store)
+        audio_helper = AudioHelper(self.database, self.client, self.worker, self.video_info_store)
+        reverse_helper = ReverseHelper(self.database, self.client, self.worker, self.video_info_store)
         helpers = [
             duplicate_helper,
             menu_helper,
-            TelegramGifHelper(self.database, self.client, self.worker),
-            VideoRotateHelper(self.database, self.client, self.worker),
-            VideoCutHelper(self.database, self.client, self.worker),
-            VideoCropHelper(self.database, self.client, self.worker),
-            VideoSpeedHelper(self.database, self.client, self.worker),
-            CaptionHelper(self.database, self.client, self.worker),
+            gif_helper,
+            rotate_helper,
+            cut_helper,
+            crop_helper,
+            speed_helper,
+            CaptionHelper(self.database, self.client, self.worker, self.video_info_store),
             download_helper,
-            StabiliseHelper(self.database, self.client, self.worker),
-            VideoHelper(self.database, self.client, self.worker),
-            AudioHelper(self.database, self.client, self.worker),
-            MSGHelper(self.database, self.client, self.worker),
-            FAHelper(self.database, self.client, self.worker),
-            SceneSplitHelper(self.database, self.client, self.worker, menu_helper),
-            ChunkSplitHelper(self.database, self.client, self.worker, ffprobe_helper),
+            StabiliseHelper(self.database, self.client, self.worker, self.video_info_store),
+            VideoHelper(self.database, self.client, self.worker, self.video_info_store),
+            audio_helper,
+            MSGHelper(self.database, self.client, self.worker, self.video_info_store),
+            FAHelper(self.database, self.client, self.worker, self.video_info_store),
+            LazyHelper(
+                "gif_pipeline.helpers.scene_split_helper",
+                "SceneSplitHelper",
+                CommandTrigger(["split scenes", "scenesplit", "scene split"]),
+                lambda cls: cls(self.database, self.client, self.worker, self.video_info_store, menu_helper),
+            ),
+            ChunkSplitHelper(self.database, self.client, self.worker, self.video_info_store, ffprobe_helper),
             send_helper,
             delete_helper,
-            MergeHelper(self.database, self.client, self.worker),
-            ReverseHelper(self.database, self.client, self.worker),
+            MergeHelper(self.database, self.client, self.worker, self.video_info_store),
+            reverse_helper,
+            EditChainHelper(
+                self.database,
+                self.client,
+                self.worker,
+                self.video_info_store,
+                [crop_helper, cut_helper, rotate_helper, speed_helper, reverse_helper],
+                [gif_helper, audio_helper],
+            ),
             ffprobe_helper,
-            ZipHelper(self.database, self.client, self.worker),
-            TagHelper(self.database, self.client, self.worker, self),
-            ChannelFwdTagHelper(self.database, self.client, self.worker),
-            UpdateYoutubeDlHelper(self.database, self.client, self.worker),
-            ChartHelper(self.database, self.client, self.worker, self, tag_manager),
+            ZipHelper(self.database, self.client, self.worker, self.video_info_store),
+            TagHelper(self.database, self.client, self.worker, self.video_info_store, self),
+            ChannelFwdTagHelper(self.database, self.client, self.worker, self.video_info_store),
+            UpdateYoutubeDlHelper(self.database, self.client, self.worker, self.video_info_store),
+            LazyHelper(
+                "gif_pipeline.helpers.chart_helper",
+                "ChartHelper",
+                CommandTrigger(["chart"]),
+                lambda cls: cls(self.database, self.client, self.worker, self.video_info_store, self, tag_manager),
+            ),
             schedule_helper,
             subscription_helper,
-            FindHelper(self.database, self.client, self.worker, duplicate_helper, download_helper),
-            ThumbnailHelper(self.database, self.client, self.worker, self),
-            QRCodeReaderHelper(self.database, self.client, self.worker),
+            LazyHelper(
+                "gif_pipeline.helpers.find_helper",
+                "FindHelper",
+                CommandTrigger(["find"]),
+                lambda cls: cls(
+                    self.database, self.client, self.worker, self.video_info_store, duplicate_helper, download_helper
+                ),
+                priority_trigger=FirstWordTrigger(["find"]),
+            ),
+            ThumbnailHelper(self.database, self.client, self.worker, self.video_info_store, self),
+            LazyHelper(
+                "gif_pipeline.helpers.qr_helper",
+                "QRCodeReaderHelper",
+                CommandTrigger(["qr", "readqr"], ignore_spaces=True),
+                lambda cls: cls(self.database, self.client, self.worker, self.video_info_store),
+            ),
+            ReloadHelper(self.database, self.client, self.worker, self.video_info_store, self),
+            TaskStatsHelper(self.database, self.client, self.worker, self.video_info_store),
+            CancelHelper(self.database, self.client, self.worker, self.video_info_store),
         ]
         if "frigate" in self.api_keys:
-            frigate_helper = FrigateHelper(
-                self.database,
-                self.client,
-                self.worker,
-                download_helper,
-                self.api_keys["frigate"]["url"],
-            )
-            helpers.append(frigate_helper)
+            helpers.append(self.create_frigate_helper(download_helper))
         # Store helpers as a dict
         for helper in helpers:
             self.helpers[helper.name] = helper
-        # Check yt-dl install
-        self.startup_monitor.set_state(StartupState.INSTALLING_YT_DL)
-        self.client.synchronise_async(download_helper.check_yt_dl())
-        # Load menus from database
-        self.startup_monitor.set_state(StartupState.LOADING_MENUS)
-        self.client.synchronise_async(menu_helper.refresh_from_database())
-        # Do all helper pre-startup initialisation
+        # Check yt-dl install, load menus, and do all helper pre-startup initialisation, concurrently where possible
+        self.startup_monitor.set_state(StartupState.RUNNING_HELPER_INIT)
+        init_graph = InitGraph(self.startup_monitor)
+        init_graph.add_step("check_yt_dl", download_helper.check_yt_dl)
+        init_graph.add_step("restore_menus", menu_helper.refresh_from_database)
+        pre_startup_dependencies = {
+            download_helper.name: ["check_yt_dl"],
+            menu_helper.name: ["restore_menus"],
+        }
         for helper in self.helpers.values():
-            self.client.synchronise_async(helper.init_pre_startup())
+            init_graph.add_step(
+                f"{helper.name}.init_pre_startup",
+                helper.init_pre_startup,
+                pre_startup_dependencies.get(helper.name),
+            )
+        self.client.synchronise_async(init_graph.run())
         # Trigger helper post-startup initialisation
         loop = asyncio.get_event_loop()
         for helper in self.helpers.values():
@@ -321,31 +495,263 @@ class Pipeline:
         # Set up public helpers
         self.startup_monitor.set_state(StartupState.INITIALISING_PUBLIC_HELPERS)
         public_helpers = [
-            PublicTagHelper(self.database, self.client, self.worker, self)
+            PublicTagHelper(self.database, self.client, self.worker, self.video_info_store, self)
         ]
         for helper in public_helpers:
             self.public_helpers[helper.name] = helper
         logger.info(f"Initialised {len(self.public_helpers)} public helpers")
 
-    async def initialise_duplicate_detector(self) -> DuplicateHelper:
-        helper = DuplicateHelper(self.database, self.client, self.worker)
-        logger.info("Initialising DuplicateHelper")
-        await helper.initialise_hashes(self.workshops)
-        logger.info("Initialised DuplicateHelper")
-        return helper
+    def create_frigate_helper(self, download_helper: DownloadHelper) -> LazyHelper:
+        frigate_url = self.api_keys["frigate"]["url"]
+        return LazyHelper(
+            "gif_pipeline.helpers.frigate_helper",
+            "FrigateHelper",
+            CommandTrigger(["frigate"]),
+            lambda cls: cls(
+                self.database, self.client, self.worker, self.video_info_store, download_helper, frigate_url
+            ),
+        )
+
+    def cpu_bound_running_count(self) -> int:
+        pools = [self.worker.pools[ResourceClass.ENCODE], self.worker.pools[ResourceClass.HASH]]
+        return sum(max(0, pool.size - pool.free_slots) for pool in pools)
 
     def watch_workshop(self) -> None:
         # Set status to running
         self.startup_monitor.set_running()
         logger.info("Registering handlers")
         # Set up handlers
-        self.client.add_message_handler(self.on_new_message, self.all_chat_ids)
+        self.watched_chat_ids[:] = self.all_chat_ids
+        self.client.add_message_handler(self.on_new_message, self.watched_chat_ids)
         self.client.add_public_message_handler(self.pass_message_to_public_handlers)
-        self.client.add_edit_handler(self.on_edit_message, self.all_chat_ids)
+        self.client.add_edit_handler(self.on_edit_message, self.watched_chat_ids)
         self.client.add_delete_handler(self.on_deleted_message)
         self.client.add_callback_query_handler(self.on_callback_query)
         logger.info("Handlers registered, watching workshops")
-        self.client.client.run_until_disconnected()
+        loop = asyncio.get_event_loop()
+        if self.snapshot is not None:
+            loop.create_task(self.reconcile_chats())
+        if self.snapshot_store is not None:
+            loop.create_task(self.snapshot_store.save_periodically())
+        else:
+            loop.create_task(self.prune_changes_periodically())
+        loop.create_task(self.job_queue.run())
+        loop.create_task(self.concurrency_controller.run())
+        if self.remote_workers is not None:
+            loop.create_task(self.remote_workers.start())
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self.reload_config_on_signal()))
+        try:
+            self.client.client.run_until_disconnected()
+        finally:
+            if self.snapshot_store is not None:
+                logger.info("Saving warm start snapshot before shutdown")
+                self.snapshot_store.save()
+
+    async def prune_changes_periodically(self) -> None:
+        # Without a snapshot store, nothing prunes the change log as snapshots are saved, so it is pruned here instead
+        while True:
+            await asyncio.sleep(CHANGE_PRUNE_INTERVAL_MINUTES * 60)
+            try:
+                self.database.prune_changes(self.database.get_latest_change_id())
+            except Exception as e:
+                logger.error("Failed to prune database change log", exc_info=e)
+
+    async def reconcile_chats(self) -> None:
+        """
+        After a warm start, older messages come from the snapshot rather than telegram, so list each chat in full to
+        find any messages which were deleted, edited, or missed, while the pipeline was offline.
+        """
+        logger.info("Reconciling warm started chats with telegram")
+        for chat in self.all_chats:
+            listing_start = datetime.datetime.now(datetime.timezone.utc)
+            try:
+                channel_messages = [
+                    m async for m in self.client.iter_channel_messages(chat.chat_data, not chat.config.read_only)
+                ]
+            except Exception as e:
+                logger.error("Failed to reconcile chat %s with telegram", chat.chat_data, exc_info=e)
+                continue
+            listed_messages = set(channel_messages)
+            known_messages = {message.message_data: message for message in chat.messages}
+            # Messages which arrived while the chat was being listed are missing from the listing, so only delete
+            # messages inside the range of IDs which was listed, and which are older than the listing. The listing
+            # runs back to the start of the chat, so only the newest listed ID bounds that range.
+            max_listed_ids = {}
+            for message_data in channel_messages:
+                max_listed_ids[message_data.is_scheduled] = max(
+                    message_data.message_id, max_listed_ids.get(message_data.is_scheduled, message_data.message_id)
+                )
+            for message_data, message in known_messages.items():
+                if message_data in listed_messages:
+                    continue
+                max_listed_id = max_listed_ids.get(message_data.is_scheduled)
+                if max_listed_id is None or message_data.message_id > max_listed_id:
+                    continue
+                # Scheduled messages are dated when they will be posted, and are listed in one request
+                if not message_data.is_scheduled and message_data.datetime >= listing_start:
+                    continue
+                await self.delete_message(chat, message)
+            for message_data in channel_messages:
+                known_message = known_messages.get(message_data)
+                if known_message is not None:
+                    if message_data.edit_datetime == known_message.message_data.edit_datetime:
+                        continue
+                    logger.info("Updating message edited while offline: %s", message_data)
+                    chat.remove_message(message_data)
+                self.database.save_message(message_data)
+                message = Message.from_message_data_lazy(
+                    message_data,
+                    chat.chat_data,
+                    self.media_downloader,
+                    DownloadPriority.BACKGROUND,
+                )
+                chat.add_message(message)
+        self.snapshot = None
+        logger.info("Reconciled warm started chats with telegram")
+
+    async def reload_config_on_signal(self) -> None:
+        logger.info("Received SIGHUP, reloading config")
+        try:
+            summary = await self.reload_config()
+        except Exception as e:
+            logger.error("Failed to reload config", exc_info=e)
+            return
+        logger.info("Config reloaded: %s", summary)
+
+    async def reload_config(self) -> str:
+        """
+        Re-reads the config file, and applies the differences to the running pipeline: chats added to the config are
+        initialised, chats removed from it are torn down, kept chats have their config swapped, and API keys are
+        updated on the helpers which use them. Returns a summary of the changes.
+        """
+        async with self.reload_lock:
+            new_config = PipelineConfig.from_file(self.pipeline_config.config_path, self.startup_monitor)
+            summary = await self.apply_config(new_config)
+            self.pipeline_config = new_config
+            return summary
+
+    async def apply_config(self, new_config: PipelineConfig) -> str:
+        old_workshops = {str(workshop.config.handle): workshop for workshop in self.workshops}
+        old_channels = {str(channel.config.handle): channel for channel in self.channels}
+        new_workshop_confs = {str(conf.handle): conf for conf in new_config.workshops}
+        new_channel_confs = {str(conf.handle): conf for conf in new_config.channels}
+
+        def queue_handle(conf: ChannelConfig) -> Optional[str]:
+            return str(conf.queue.handle) if conf.queue is not None else None
+
+        # A channel whose queue has changed is linked to a different workshop, so it is removed and added again
+        removed_channels = [
+            channel for handle, channel in old_channels.items()
+            if handle not in new_channel_confs or queue_handle(new_channel_confs[handle]) != queue_handle(channel.config)
+        ]
+        removed_workshops = [
+            workshop for handle, workshop in old_workshops.items() if handle not in new_workshop_confs
+        ]
+        removed_channel_handles = {str(channel.config.handle) for channel in removed_channels}
+        added_workshop_confs = [conf for handle, conf in new_workshop_confs.items() if handle not in old_workshops]
+        added_channel_confs = [
+            conf for handle, conf in new_channel_confs.items()
+            if handle not in old_channels or handle in removed_channel_handles
+        ]
+        # Swap config on the chats which are kept
+        for handle, workshop in old_workshops.items():
+            if handle in new_workshop_confs:
+                workshop.update_config(new_workshop_confs[handle])
+        for handle, channel in old_channels.items():
+            if handle in new_channel_confs and handle not in removed_channel_handles:
+                channel.update_config(new_channel_confs[handle])
+        # Tear down removed chats, channels first so that nothing is left linked to a removed queue
+        for chat in [*removed_channels, *removed_workshops]:
+            self.remove_chat(chat)
+        # Initialise added chats
+        added_workshops, added_channels = await self.initialise_added_chats(added_workshop_confs, added_channel_confs)
+        # Event handlers filter on this list, so update it in place
+        self.watched_chat_ids[:] = self.all_chat_ids
+        self.worker.resize_pools(new_config.task_pool_sizes)
+        self.worker.set_task_timeouts(new_config.task_timeouts)
+        self.concurrency_controller.configure(new_config.adaptive_concurrency)
+        cpu_budget.configure(new_config.thread_budget, self.cpu_bound_running_count)
+        media_backend.configure(new_config.media_backend)
+        # Update API keys
+        api_keys_changed = new_config.api_keys != self.api_keys
+        if api_keys_changed:
+            self.update_api_keys(new_config.api_keys)
+        lines = [
+            f"Added chats: {', '.join(chat.chat_data.title for chat in [*added_channels, *added_workshops]) or 'none'}",
+            f"Removed chats: {', '.join(chat.chat_data.title for chat in [*removed_channels, *removed_workshops]) or 'none'}",
+            f"API keys: {'updated' if api_keys_changed else 'unchanged'}",
+        ]
+        return "\n".join(lines)
+
+    async def initialise_added_chats(
+            self,
+            workshop_confs: List[WorkshopConfig],
+            channel_confs: List[ChannelConfig],
+    ) -> Tuple[List[WorkshopGroup], List[Channel]]:
+        workshop_builder = WorkshopBuilder(self.database, self.client, self.media_downloader)
+        channel_builder = ChannelBuilder(self.database, self.client, self.media_downloader)
+        # Chats which are no longer configured have already been removed, others must not be deleted here
+        workshop_data = await workshop_builder.get_chat_data(workshop_confs, delete_excess=False)
+        channel_data = await channel_builder.get_chat_data(channel_confs, delete_excess=False)
+
+        async def message_groups() -> AsyncIterator[StreamGroup[int, Message]]:
+            async for group in workshop_builder.iter_message_inits(workshop_confs, workshop_data):
+                yield group
+            async for group in channel_builder.iter_message_inits(channel_confs, channel_data):
+                yield group
+
+        chat_messages: Dict[int, List[Message]] = {}
+        message_stream = stream_gather(message_groups(), PipelineConfig.MESSAGE_INIT_CONCURRENCY, "Reloading messages")
+        async for chat_id, messages in message_stream:
+            chat_messages[chat_id] = messages
+        workshops = []
+        for work_conf, work_data in zip(workshop_confs, workshop_data):
+            workshop = WorkshopGroup(work_data, work_conf, chat_messages.pop(work_data.chat_id), self.client)
+            workshop.cleanup_excess_files()
+            self.workshops.append(workshop)
+            workshops.append(workshop)
+        channels = []
+        for chan_conf, chan_data in zip(channel_confs, channel_data):
+            queue = None
+            if chan_conf.queue:
+                queue = next(w for w in self.workshops if str(w.config.handle) == str(chan_conf.queue.handle))
+            channel = Channel(chan_data, chan_conf, chat_messages.pop(chan_data.chat_id), self.client, queue)
+            channel.cleanup_excess_files()
+            self.channels.append(channel)
+            channels.append(channel)
+        for chat in [*workshops, *channels]:
+            logger.info("Added chat from reloaded config: %s", chat)
+        return workshops, channels
+
+    def remove_chat(self, chat: Chat) -> None:
+        logger.info("Removing chat which is no longer in config: %s", chat)
+        for message in chat.messages:
+            self.menu_cache.remove_menu_by_message(message)
+        self.get_helper(SubscriptionHelper.__name__).remove_subscriptions_for_chat(chat.chat_data.chat_id)
+        # Helpers hold references to these lists, so they are modified in place
+        if isinstance(chat, Channel):
+            self.channels.remove(chat)
+            ChannelBuilder(self.database, self.client, self.media_downloader).delete_chats([chat.chat_data])
+        else:
+            self.workshops.remove(chat)
+            WorkshopBuilder(self.database, self.client, self.media_downloader).delete_chats([chat.chat_data])
+        chat.close()
+
+    def update_api_keys(self, api_keys: Dict[str, Dict[str, str]]) -> None:
+        frigate_changed = api_keys.get("frigate") != self.api_keys.get("frigate")
+        self.api_keys = api_keys
+        for helper in self.helpers.values():
+            if isinstance(helper, LazyHelper):
+                if helper.is_loaded:
+                    helper.helper.update_api_keys(api_keys)
+            else:
+                helper.update_api_keys(api_keys)
+        # The frigate helper is only present when configured, and is given its URL when created
+        if frigate_changed:
+            self.helpers.pop("FrigateHelper", None)
+            if "frigate" in api_keys:
+                self.helpers["FrigateHelper"] = self.create_frigate_helper(self.get_helper(DownloadHelper.__name__))
 
     async def on_edit_message(self, event: events.MessageEdited.Event):
         # Get chat, check it's one we know
@@ -380,12 +786,29 @@ class Pipeline:
         chat.add_message(new_message)
         self.database.save_message(new_message.message_data)
         logger.info(f"New message initialised: {new_message}")
+        # Probe new videos in the background, so their metadata is ready before helpers need it
+        if new_message.has_video and new_message.message_data.file_path:
+            asyncio.get_event_loop().create_task(self.video_info_store.prefetch(new_message.message_data.file_path))
         # Pass to helpers
         await self.pass_message_to_handlers(new_message, chat)
 
+    async def ensure_message_media(self, chat: Chat, message: Optional[Message]) -> None:
+        # Commands usually reply to the video they refer to, so make sure both are downloaded before handling
+        if message is None:
+            return
+        reply_to = chat.message_by_id(message.message_data.reply_to)
+        for msg in [message, reply_to]:
+            if msg is None:
+                continue
+            try:
+                await msg.ensure_media(DownloadPriority.COMMAND)
+            except Exception as e:
+                logger.error("Failed to download media for message %s before passing to helpers", msg, exc_info=e)
+
     async def pass_message_to_handlers(self, new_message: Message, chat: Chat = None):
         if chat is None:
             chat = self.chat_by_id(new_message.chat_data.chat_id)
+        await self.ensure_message_media(chat, new_message)
         # If any helpers say that a message is priority, send only to those helpers
         priority_helpers = [helper for helper in self.helpers.values() if helper.is_priority(chat, new_message)]
         if priority_helpers:
@@ -393,14 +816,17 @@ class Pipeline:
         else:
             # Send only to helpers which can handle the message
             helpers = [helper for helper in self.helpers.values() if helper.can_handle(chat, new_message)]
-        # Call the helpers
-        helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
-            *(helper.on_new_message(chat, new_message) for helper in helpers),
-            return_exceptions=True
-        )
+        # Call the helpers, with their tasks sharing the task worker fairly with other chats
+        with task_tenant(str(chat.chat_data.chat_id), chat.config.task_weight):
+            helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
+                *(helper.on_new_message(chat, new_message) for helper in helpers),
+                return_exceptions=True
+            )
         # Handle helper results
         for helper, result in zip(helpers, helper_results):
-            if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                logger.info(f"Helper {helper.name} was cancelled while handling message {new_message}.")
+            elif isinstance(result, BaseException):
                 logger.error(
                     f"Helper {helper.name} threw an exception trying to handle message {new_message}.",
                     exc_info=result
@@ -427,24 +853,27 @@ class Pipeline:
         chat = self.chat_by_id(event.chat_id)
         messages = self.get_messages_for_delete_event(event)
         for message in messages:
-            # Tell helpers
-            helper_results = await asyncio.gather(
-                *(helper.on_deleted_message(chat, message) for helper in self.helpers.values()),
-                return_exceptions=True
-            )
-            results_dict = dict(zip(self.helpers.keys(), helper_results))
-            for helper, result in results_dict.items():
-                if isinstance(result, Exception):
-                    logger.error(
-                        f"Helper {helper} threw an exception trying to handle deleting message {message}.",
-                        exc_info=result
-                    )
-            # If it's a menu, remove that
-            self.menu_cache.remove_menu_by_message(message)
-            # Remove messages from store
-            logger.info(f"Deleting message {message} from chat: {message.chat_data}")
-            message.delete(self.database)
-            chat.remove_message(message.message_data)
+            await self.delete_message(chat, message)
+
+    async def delete_message(self, chat: Chat, message: Message) -> None:
+        # Tell helpers
+        helper_results = await asyncio.gather(
+            *(helper.on_deleted_message(chat, message) for helper in self.helpers.values()),
+            return_exceptions=True
+        )
+        results_dict = dict(zip(self.helpers.keys(), helper_results))
+        for helper, result in results_dict.items():
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Helper {helper} threw an exception trying to handle deleting message {message}.",
+                    exc_info=result
+                )
+        # If it's a menu, remove that
+        self.menu_cache.remove_menu_by_message(message)
+        # Remove messages from store
+        logger.info(f"Deleting message {message} from chat: {message.chat_data}")
+        message.delete(self.database)
+        chat.remove_message(message.message_data)
 
     def get_messages_for_delete_event(self, event: events.MessageDeleted.Event) -> Iterable[Message]:
         deleted_ids = event.deleted_ids
@@ -483,14 +912,18 @@ class Pipeline:
             logger.info("Callback received for a menu which has already been clicked")
             await event.answer("That menu has already been clicked.")
             return
+        await self.ensure_message_media(chat, menu.menu.video)
         # Hand callback queries to helpers
-        helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
-            *(helper.on_callback_query(event.data, menu, event.sender_id) for helper in self.helpers.values()),
-            return_exceptions=True
-        )
+        with task_tenant(str(chat.chat_data.chat_id), chat.config.task_weight):
+            helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
+                *(helper.on_callback_query(event.data, menu, event.sender_id) for helper in self.helpers.values()),
+                return_exceptions=True
+            )
         answered = False
         for helper, result in zip(self.helpers.keys(), helper_results):
-            if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                logger.info(f"Helper {helper} was cancelled while handling callback query {event}.")
+            elif isinstance(result, BaseException):
                 logger.error(
                     f"Helper {helper} threw an exception trying to handle callback query {event}.",
                     exc_info=result
@@ -505,11 +938,16 @@ class Pipeline:
     async def on_stateless_callback(self, event: events.CallbackQuery.Event, chat: Chat) -> None:
         # Get message
         msg = chat.message_by_id(event.message_id)
+        await self.ensure_message_media(chat, msg)
         # Handle callback query
-        helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
-            *(helper.on_stateless_callback(event.data, chat, msg, event.sender_id) for helper in self.helpers.values()),
-            return_exceptions=True
-        )
+        with task_tenant(str(chat.chat_data.chat_id), chat.config.task_weight):
+            helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
+                *(
+                    helper.on_stateless_callback(event.data, chat, msg, event.sender_id)
+                    for helper in self.helpers.values()
+                ),
+                return_exceptions=True
+            )
         answered = False
         for helper, result in zip(self.helpers.keys(), helper_results):
             if isinstance(result, BaseException):
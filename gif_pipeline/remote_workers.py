@@ -0,0 +1,371 @@
+import asyncio
+import glob
+import hmac
+import itertools
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Any, Set
+
+from aiohttp import web
+from prometheus_client import Counter, Gauge
+
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask, is_file_output, current_progress_tracker
+from gif_pipeline.tasks.hash_dir_task import HashDirectoryTask
+from gif_pipeline.tasks.task import Task, TaskException, ResourceClass
+from gif_pipeline.tasks.task_worker import current_task_priority
+
+logger = logging.getLogger(__name__)
+
+remote_jobs = Counter(
+    "gif_pipeline_remote_workers_jobs_total",
+    "Number of tasks sent to remote worker nodes, by node and result",
+    labelnames=["node", "result"]
+)
+remote_nodes_connected = Gauge(
+    "gif_pipeline_remote_workers_nodes_connected",
+    "Number of remote worker nodes which have been seen recently"
+)
+remote_jobs_running = Gauge(
+    "gif_pipeline_remote_workers_jobs_running",
+    "Number of tasks currently running on remote worker nodes"
+)
+
+# Resource classes which remote worker nodes can run tasks for
+REMOTE_RESOURCE_CLASSES = [ResourceClass.ENCODE, ResourceClass.HASH]
+
+
+class RemoteWorkerConfig:
+    def __init__(self, host: str, port: int, token: str) -> None:
+        self.host = host
+        self.port = port
+        self.token = token
+
+    @classmethod
+    def from_json(cls, json_dict: Dict[str, Any]) -> "RemoteWorkerConfig":
+        return cls(
+            json_dict.get("host", "0.0.0.0"),
+            json_dict.get("port", 7190),
+            json_dict["token"],
+        )
+
+
+def ffmpeg_task_is_remotable(task: FfmpegTask) -> bool:
+    for path, options in (task.inputs or {}).items():
+        # Concat lists refer to other files by path, which would not exist on the node
+        if options and "concat" in options:
+            return False
+    for path, options in (task.outputs or {}).items():
+        # Image sequences write an unknown number of files
+        if "%" in path:
+            return False
+        # Two pass encodes share a log file in the working directory between passes
+        if options and "-pass " in options:
+            return False
+    return True
+
+
+class RemoteJob:
+    def __init__(
+            self,
+            job_id: int,
+            task: Task,
+            spec: Dict[str, Any],
+            input_paths: List[str],
+            output_paths: List[str],
+    ) -> None:
+        self.job_id = job_id
+        self.task = task
+        self.spec = spec
+        self.input_paths = input_paths
+        self.output_paths = output_paths
+        self.node: Optional[str] = None
+        self.future = asyncio.get_event_loop().create_future()
+        # Set once the node shows it received the job, by acknowledging it or making any request for it
+        self.acknowledged = asyncio.Event()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "spec": self.spec,
+            "input_exts": [os.path.splitext(path)[1] for path in self.input_paths],
+            "output_exts": [os.path.splitext(path)[1] for path in self.output_paths],
+        }
+
+
+class RemoteNode:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.last_seen = time.monotonic()
+        # Free slots the node reported on its latest poll, by resource class
+        self.free_slots: Dict[ResourceClass, int] = {}
+        self.jobs: Set[int] = set()
+        # Set while the node is waiting on a poll, and resolved with a job to give it
+        self.waiting: Optional[asyncio.Future] = None
+
+
+class RemoteWorkerServer:
+    """
+    Serves encode and hash tasks to worker nodes over HTTP. Nodes long-poll for a task, reporting their free slots,
+    download the input files, post progress while running, then upload the output files and the result. A task is only
+    sent to a node if one is waiting with more free slots than the local pool has, and then to the waiting node with the
+    most free slots, otherwise it runs locally as usual. A node must acknowledge a task soon after it is sent, or it is
+    withdrawn and offered to the next waiting node, as the poll response may never have reached the node.
+    """
+    POLL_SECONDS = 20
+    # How long a node has to acknowledge a task sent to it
+    ACK_SECONDS = 10
+    # Nodes which have not polled or sent a heartbeat in this long are considered gone, and their tasks fail
+    NODE_TIMEOUT = 60
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, config: RemoteWorkerConfig) -> None:
+        self.config = config
+        self.nodes: Dict[str, RemoteNode] = {}
+        self.jobs: Dict[int, RemoteJob] = {}
+        self._job_ids = itertools.count(1)
+        self.runner: Optional[web.AppRunner] = None
+        remote_nodes_connected.set_function(lambda: len(self.live_nodes()))
+        remote_jobs_running.set_function(lambda: len(self.jobs))
+
+    def _build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._auth_middleware])
+        app.router.add_post("/nodes/{node}/poll", self.handle_poll)
+        app.router.add_post("/nodes/{node}/heartbeat", self.handle_heartbeat)
+        app.router.add_post("/jobs/{job_id}/ack", self.handle_ack)
+        app.router.add_get("/jobs/{job_id}/inputs/{index}", self.handle_get_input)
+        app.router.add_put("/jobs/{job_id}/outputs/{index}", self.handle_put_output)
+        app.router.add_post("/jobs/{job_id}/progress", self.handle_progress)
+        app.router.add_post("/jobs/{job_id}/complete", self.handle_complete)
+        return app
+
+    async def start(self) -> None:
+        self.runner = web.AppRunner(self._build_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.config.host, self.config.port)
+        await site.start()
+        logger.info("Remote worker server listening on %s:%s", self.config.host, self.config.port)
+        asyncio.get_event_loop().create_task(self.watch_nodes())
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def _auth_middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {self.config.token}"):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    def live_nodes(self) -> List[RemoteNode]:
+        cutoff = time.monotonic() - self.NODE_TIMEOUT
+        return [node for node in self.nodes.values() if node.last_seen > cutoff]
+
+    def _seen_node(self, name: str) -> RemoteNode:
+        node = self.nodes.get(name)
+        if node is None:
+            logger.info("Remote worker node %s connected", name)
+            node = self.nodes[name] = RemoteNode(name)
+            for result in ["done", "failed", "lost", "unacknowledged"]:
+                remote_jobs.labels(node=name, result=result)
+        node.last_seen = time.monotonic()
+        return node
+
+    def _waiting_node(self, resource_class: ResourceClass) -> Optional[RemoteNode]:
+        waiting = [
+            node for node in self.live_nodes()
+            if node.waiting is not None and not node.waiting.done() and node.free_slots.get(resource_class, 0) > 0
+        ]
+        if not waiting:
+            return None
+        return max(waiting, key=lambda node: node.free_slots[resource_class])
+
+    def free_slots(self, resource_class: ResourceClass) -> int:
+        node = self._waiting_node(resource_class)
+        if node is None:
+            return 0
+        return node.free_slots[resource_class]
+
+    @staticmethod
+    def can_run(task: Task) -> bool:
+        if task.resource_class not in REMOTE_RESOURCE_CLASSES:
+            return False
+        if isinstance(task, FfmpegTask):
+            return ffmpeg_task_is_remotable(task)
+        return isinstance(task, HashDirectoryTask)
+
+    def _create_job(self, task: Task) -> RemoteJob:
+        job_id = next(self._job_ids)
+        if isinstance(task, HashDirectoryTask):
+            input_paths = sorted(glob.glob(f"{task.directory}/*.png"))
+            return RemoteJob(job_id, task, {"kind": "hash"}, input_paths, [])
+        input_paths = []
+        inputs = []
+        for path, options in (task.inputs or {}).items():
+            if os.path.isfile(path):
+                inputs.append({"file": len(input_paths), "options": options})
+                input_paths.append(path)
+            else:
+                # Not a local file, such as a lavfi source, so it is passed to the node as it is
+                inputs.append({"arg": path, "options": options})
+        output_paths = []
+        outputs = []
+        for path, options in (task.outputs or {}).items():
+            if is_file_output(path):
+                outputs.append({"file": len(output_paths), "options": options})
+                output_paths.append(path)
+            else:
+                outputs.append({"arg": path, "options": options})
+        global_options = task.global_options
+        if isinstance(global_options, str):
+            global_options = [global_options]
+        spec = {
+            "kind": "ffmpeg",
+            "global_options": global_options,
+            "inputs": inputs,
+            "outputs": outputs,
+            "purpose": task.purpose,
+            "duration": task.progress.duration,
+            "stall_timeout": task.stall_timeout,
+            # So that the node runs background encodes at a low OS priority too
+            "priority": current_task_priority.get().value,
+        }
+        return RemoteJob(job_id, task, spec, input_paths, output_paths)
+
+    async def assign(self, task: Task) -> Optional[RemoteJob]:
+        """
+        Sends a task to the waiting node with the most free slots, and waits for the node to acknowledge it. If no node
+        acknowledges it, None is returned, so that the task can be run locally instead.
+        """
+        while True:
+            node = self._waiting_node(task.resource_class)
+            if node is None:
+                return None
+            # A new job each time, so that a late request from a node which did not acknowledge it is refused
+            job = self._create_job(task)
+            self.jobs[job.job_id] = job
+            job.node = node.name
+            node.jobs.add(job.job_id)
+            node.free_slots[task.resource_class] -= 1
+            node.waiting.set_result(job)
+            logger.debug("Sent task to remote worker node %s: %s", node.name, task)
+            try:
+                await asyncio.wait_for(job.acknowledged.wait(), self.ACK_SECONDS)
+                return job
+            except asyncio.TimeoutError:
+                logger.warning("Remote worker node %s did not acknowledge job %s, withdrawing it", node.name, job.job_id)
+                remote_jobs.labels(node=node.name, result="unacknowledged").inc()
+                self._withdraw(job)
+            except asyncio.CancelledError:
+                self._withdraw(job)
+                raise
+
+    def _withdraw(self, job: RemoteJob) -> None:
+        self.jobs.pop(job.job_id, None)
+        node = self.nodes.get(job.node)
+        if node is not None:
+            node.jobs.discard(job.job_id)
+
+    async def await_result(self, job: RemoteJob) -> Any:
+        task = job.task
+        if isinstance(task, FfmpegTask):
+            tracker = current_progress_tracker.get()
+            if tracker is not None:
+                tracker.add(task.progress)
+        try:
+            result = await job.future
+        finally:
+            self._withdraw(job)
+            if isinstance(task, FfmpegTask):
+                task.progress.done = True
+        if isinstance(task, HashDirectoryTask):
+            return set(result)
+        return tuple(result)
+
+    async def watch_nodes(self) -> None:
+        while True:
+            await asyncio.sleep(self.NODE_TIMEOUT / 4)
+            live_names = {node.name for node in self.live_nodes()}
+            for node in list(self.nodes.values()):
+                if node.name in live_names:
+                    continue
+                for job_id in list(node.jobs):
+                    job = self.jobs.get(job_id)
+                    if job is not None and not job.future.done():
+                        remote_jobs.labels(node=node.name, result="lost").inc()
+                        job.future.set_exception(
+                            TaskException(f"Remote worker node {node.name} stopped responding")
+                        )
+                if not node.jobs:
+                    logger.info("Remote worker node %s disconnected", node.name)
+                    del self.nodes[node.name]
+
+    def _job_for_request(self, request: web.Request) -> RemoteJob:
+        job = self.jobs.get(int(request.match_info["job_id"]))
+        if job is None or job.future.done():
+            # The task was cancelled, or the node was considered lost, so the node should stop working on it
+            raise web.HTTPGone()
+        self._seen_node(job.node)
+        job.acknowledged.set()
+        return job
+
+    async def handle_poll(self, request: web.Request) -> web.Response:
+        node = self._seen_node(request.match_info["node"])
+        body = await request.json()
+        node.free_slots = {
+            ResourceClass(name): slots for name, slots in body.get("free_slots", {}).items()
+            if name in [rc.value for rc in REMOTE_RESOURCE_CLASSES]
+        }
+        node.waiting = asyncio.get_event_loop().create_future()
+        try:
+            job = await asyncio.wait_for(asyncio.shield(node.waiting), self.POLL_SECONDS)
+        except asyncio.TimeoutError:
+            return web.Response(status=204)
+        finally:
+            if not node.waiting.done():
+                node.waiting.cancel()
+            node.waiting = None
+        return web.json_response(job.to_json())
+
+    async def handle_heartbeat(self, request: web.Request) -> web.Response:
+        self._seen_node(request.match_info["node"])
+        return web.Response(status=204)
+
+    async def handle_ack(self, request: web.Request) -> web.Response:
+        self._job_for_request(request)
+        return web.Response(status=204)
+
+    async def handle_get_input(self, request: web.Request) -> web.StreamResponse:
+        job = self._job_for_request(request)
+        index = int(request.match_info["index"])
+        if not 0 <= index < len(job.input_paths):
+            raise web.HTTPNotFound()
+        return web.FileResponse(job.input_paths[index])
+
+    async def handle_put_output(self, request: web.Request) -> web.Response:
+        job = self._job_for_request(request)
+        index = int(request.match_info["index"])
+        if not 0 <= index < len(job.output_paths):
+            raise web.HTTPNotFound()
+        with open(job.output_paths[index], "wb") as f:
+            async for chunk in request.content.iter_chunked(self.CHUNK_SIZE):
+                f.write(chunk)
+        return web.Response(status=204)
+
+    async def handle_progress(self, request: web.Request) -> web.Response:
+        job = self._job_for_request(request)
+        if isinstance(job.task, FfmpegTask):
+            job.task.progress.update(await request.json())
+        return web.Response(status=204)
+
+    async def handle_complete(self, request: web.Request) -> web.Response:
+        job = self._job_for_request(request)
+        body = await request.json()
+        if body.get("error") is not None:
+            remote_jobs.labels(node=job.node, result="failed").inc()
+            job.future.set_exception(TaskException(f"Remote worker node {job.node} failed: {body['error']}"))
+        else:
+            remote_jobs.labels(node=job.node, result="done").inc()
+            job.future.set_result(body["result"])
+        return web.Response(status=204)
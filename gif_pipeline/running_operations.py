@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import shutil
+from contextvars import ContextVar
+from typing import Dict, Tuple, List, Optional, Set
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+operations_cancelled = Counter(
+    "gif_pipeline_operations_cancelled_total",
+    "Number of helper operations which users cancelled, by helper",
+    labelnames=["helper"]
+)
+
+
+class RunningOperation:
+    """
+    A helper's handling of a command, which has a progress message, and can be cancelled by users. Cancelling it
+    cancels the asyncio task running it, which kills any subprocesses and frees task worker slots, and then removes any
+    sandbox files it had created.
+    """
+
+    def __init__(self, helper_name: str, chat_id: int, message_ids: List[int], task: asyncio.Task) -> None:
+        self.helper_name = helper_name
+        self.chat_id = chat_id
+        # The command message and the progress message, either can be used to cancel the operation
+        self.message_ids = message_ids
+        self.task = task
+        self.sandbox_paths: Set[str] = set()
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        if self.cancelled:
+            return
+        logger.info("Cancelling %s operation on message %s in chat %s", self.helper_name, self.message_ids, self.chat_id)
+        operations_cancelled.labels(helper=self.helper_name).inc()
+        self.cancelled = True
+        self.task.cancel()
+
+    def cleanup(self) -> None:
+        for path in self.sandbox_paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning("Failed to remove sandbox file of cancelled operation: %s", path, exc_info=e)
+
+
+# The operation being run, so that sandbox paths created while running it can be cleaned up if it is cancelled
+current_operation: ContextVar[Optional[RunningOperation]] = ContextVar("current_operation", default=None)
+
+
+def register_sandbox_path(path: str) -> None:
+    operation = current_operation.get()
+    if operation is not None:
+        operation.sandbox_paths.add(path)
+
+
+class OperationRegistry:
+    def __init__(self) -> None:
+        self.operations: Dict[Tuple[int, int], RunningOperation] = {}
+
+    def add(self, operation: RunningOperation) -> None:
+        for message_id in operation.message_ids:
+            self.operations[(operation.chat_id, message_id)] = operation
+
+    def remove(self, operation: RunningOperation) -> None:
+        for message_id in operation.message_ids:
+            if self.operations.get((operation.chat_id, message_id)) is operation:
+                del self.operations[(operation.chat_id, message_id)]
+
+    def find(self, chat_id: int, message_id: int) -> Optional[RunningOperation]:
+        return self.operations.get((chat_id, message_id))
+
+
+operation_registry = OperationRegistry()
@@ -0,0 +1,218 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import pickle
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Type, TypeVar
+
+from prometheus_client import Gauge, Counter
+
+from gif_pipeline.chat_data import ChatData
+from gif_pipeline.database import Database, MenuData, SubscriptionData, chat_types
+from gif_pipeline.message import MessageData
+
+logger = logging.getLogger(__name__)
+
+snapshot_load_time = Gauge(
+    "gif_pipeline_snapshot_load_time_seconds",
+    "Time taken to load the warm start snapshot, and replay database changes made since it was written"
+)
+snapshot_replayed_changes = Gauge(
+    "gif_pipeline_snapshot_replayed_changes",
+    "Number of database changes which were replayed on top of the warm start snapshot at startup"
+)
+snapshot_last_saved = Gauge(
+    "gif_pipeline_snapshot_last_saved_unixtime",
+    "Time that the warm start snapshot was last written"
+)
+snapshot_save_failures = Counter(
+    "gif_pipeline_snapshot_save_failures_total",
+    "Number of times writing the warm start snapshot has failed"
+)
+
+T = TypeVar("T", bound=ChatData)
+
+SNAPSHOT_MAGIC = b"GIFPIPESNAP"
+SNAPSHOT_VERSION = 1
+
+
+def _schema_hash() -> str:
+    # Snapshots written against a different database schema are not trusted
+    with open(Path(__file__).parent / "database_schema.sql", "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class PipelineSnapshot:
+    """
+    Copy of the database state the pipeline needs at startup, as of a given database change ID: chat data, messages,
+    menus, and subscriptions. Rows are keyed by their database keys, so that later changes can be replayed onto it.
+    """
+
+    def __init__(
+            self,
+            change_id: int,
+            created: datetime.datetime,
+            chats: Dict[int, ChatData],
+            messages: Dict[int, MessageData],
+            menus: Dict[int, MenuData],
+            subscriptions: Dict[int, SubscriptionData],
+            subscription_items: Dict[int, List[str]],
+    ) -> None:
+        self.change_id = change_id
+        self.created = created
+        self.chats = chats
+        self.messages = messages
+        self.menus = menus
+        self.subscriptions = subscriptions
+        self.subscription_items = subscription_items
+        self._messages_by_chat: Optional[Dict[int, List[MessageData]]] = None
+
+    def list_chats(self, chat_type: Type[T]) -> List[T]:
+        return [chat for chat in self.chats.values() if isinstance(chat, chat_type)]
+
+    def messages_for_chat(self, chat_id: int) -> Optional[List[MessageData]]:
+        if chat_id not in self.chats:
+            return None
+        if self._messages_by_chat is None:
+            self._messages_by_chat = {}
+            for message in self.messages.values():
+                self._messages_by_chat.setdefault(message.chat_id, []).append(message)
+        return self._messages_by_chat.get(chat_id, [])
+
+    def list_menus(self) -> List[MenuData]:
+        return list(self.menus.values())
+
+    def list_subscriptions(self) -> List[SubscriptionData]:
+        return list(self.subscriptions.values())
+
+    def list_item_ids_for_subscription(self, subscription: SubscriptionData) -> List[str]:
+        return self.subscription_items.get(subscription.subscription_id, [])
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_messages_by_chat"] = None
+        return state
+
+
+class SnapshotStore:
+    """
+    Writes the pipeline's startup state to a versioned binary snapshot file, on shutdown and periodically, and loads it
+    at startup, replaying only the database changes which were made after it was written.
+    """
+
+    def __init__(self, database: Database, path: str, interval_minutes: int = 15) -> None:
+        self.database = database
+        self.path = path
+        self.interval_minutes = interval_minutes
+
+    def create_snapshot(self) -> PipelineSnapshot:
+        # Change ID is read first, so any change made while the snapshot is being read is replayed again on load
+        change_id = self.database.get_latest_change_id()
+        chats = {}
+        for chat_type in chat_types.values():
+            for chat_data in self.database.list_chats(chat_type):
+                chats[chat_data.chat_id] = chat_data
+        subscriptions = {sub.subscription_id: sub for sub in self.database.list_subscriptions()}
+        return PipelineSnapshot(
+            change_id,
+            datetime.datetime.now(datetime.timezone.utc),
+            chats,
+            self.database.list_messages_by_entry_id(),
+            self.database.list_menus_by_entry_id(),
+            subscriptions,
+            {sub_id: self.database.list_item_ids_for_subscription(sub) for sub_id, sub in subscriptions.items()},
+        )
+
+    def save(self) -> None:
+        start_time = time.monotonic()
+        snapshot = self.create_snapshot()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            pickle.dump({"version": SNAPSHOT_VERSION, "schema": _schema_hash()}, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        # Changes older than the snapshot will never need replaying again
+        self.database.prune_changes(snapshot.change_id)
+        snapshot_last_saved.set_to_current_time()
+        logger.info(
+            "Saved warm start snapshot with %s messages at change %s, in %.2f seconds",
+            len(snapshot.messages), snapshot.change_id, time.monotonic() - start_time
+        )
+
+    def load(self) -> Optional[PipelineSnapshot]:
+        if not os.path.exists(self.path):
+            logger.info("No warm start snapshot found, starting cold")
+            return None
+        start_time = time.monotonic()
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    logger.warning("Warm start snapshot file is not a snapshot, starting cold")
+                    return None
+                header = pickle.load(f)
+                if header.get("version") != SNAPSHOT_VERSION or header.get("schema") != _schema_hash():
+                    logger.info("Warm start snapshot is from a different version, starting cold")
+                    return None
+                snapshot: PipelineSnapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning("Failed to read warm start snapshot, starting cold", exc_info=e)
+            return None
+        if self.database.get_oldest_change_id() > snapshot.change_id + 1:
+            logger.warning("Database changes since the warm start snapshot have been pruned, starting cold")
+            return None
+        num_changes = self.replay_changes(snapshot)
+        duration = time.monotonic() - start_time
+        snapshot_load_time.set(duration)
+        snapshot_replayed_changes.set(num_changes)
+        logger.info(
+            "Loaded warm start snapshot from %s, replayed %s changes, in %.2f seconds",
+            snapshot.created, num_changes, duration
+        )
+        return snapshot
+
+    def replay_changes(self, snapshot: PipelineSnapshot) -> int:
+        changes = self.database.list_changes_since(snapshot.change_id)
+        # Each changed row only needs reading once, whatever happened to it, as the current row is what matters
+        changed_keys: Dict[str, set] = {}
+        for table_name, row_key in changes:
+            changed_keys.setdefault(table_name, set()).add(row_key)
+        for chat_id in changed_keys.get("chats", set()):
+            chat_data = self.database.get_chat_by_id(chat_id)
+            if chat_data is None:
+                snapshot.chats.pop(chat_id, None)
+            else:
+                snapshot.chats[chat_id] = chat_data
+        for entry_id in changed_keys.get("messages", set()):
+            message = self.database.list_messages_by_entry_id(entry_id).get(entry_id)
+            if message is None:
+                snapshot.messages.pop(entry_id, None)
+            else:
+                snapshot.messages[entry_id] = message
+        # Menus are joined to messages, so re-read them all if either changed
+        if changed_keys.get("menu_cache") or changed_keys.get("messages"):
+            snapshot.menus = self.database.list_menus_by_entry_id()
+        for subscription_id in changed_keys.get("subscriptions", set()):
+            sub_data = next(iter(self.database.list_subscriptions(subscription_id)), None)
+            if sub_data is None:
+                snapshot.subscriptions.pop(subscription_id, None)
+                snapshot.subscription_items.pop(subscription_id, None)
+            else:
+                snapshot.subscriptions[subscription_id] = sub_data
+        for subscription_id in changed_keys.get("subscription_items", set()):
+            if subscription_id in snapshot.subscriptions:
+                snapshot.subscription_items[subscription_id] = \
+                    self.database.list_item_ids_for_subscription_id(subscription_id)
+        return len(changes)
+
+    async def save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_minutes * 60)
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self.save)
+            except Exception as e:
+                snapshot_save_failures.inc()
+                logger.error("Failed to save warm start snapshot", exc_info=e)
@@ -4,6 +4,8 @@ from typing import Optional
 
 from prometheus_client import Enum, Gauge
 
+from gif_pipeline.startup_tracer import startup_tracer
+
 startup_time = Gauge(
     "gif_pipeline_startup_unixtime",
     "Time the gif pipeline was last started"
@@ -14,6 +16,7 @@ class StartupState(enum.Enum):
     LOADING_CONFIG = "01_loading_config"
     CREATING_DATABASE = "02_creating_database"
     CONNECTING_TELEGRAM = "03_connecting_telegram"
+    LOADING_SNAPSHOT = "04_loading_snapshot"
     INITIALISING_CHAT_DATA = "10_initialise_chat_data"
     LISTING_WORKSHOP_MESSAGES = "11_list_workshop_messages"
     LISTING_CHANNEL_MESSAGES = "12_list_channel_messages"
@@ -24,8 +27,7 @@ class StartupState(enum.Enum):
     CREATING_PIPELINE = "20_creating_pipeline"
     INITIALISING_DUPLICATE_DETECTOR = "21_initialising_duplicate_detector"
     INITIALISING_HELPERS = "22_initialising_helpers"
-    INSTALLING_YT_DL = "23_install_yt_dl"
-    LOADING_MENUS = "24_load_menus"
+    RUNNING_HELPER_INIT = "23_running_helper_init"
     INITIALISING_PUBLIC_HELPERS = "27_initialise_public_helpers"
     RUNNING = "30_running"
 
@@ -46,12 +48,18 @@ startup_state_duration = Gauge(
 )
 for state in StartupState:
     startup_state_duration.labels(state=state.value)
+startup_phase_duration = Gauge(
+    "gif_pipeline_startup_phase_duration_seconds",
+    "Time that the gif pipeline spent in the given startup phase, which may run concurrently with other phases",
+    labelnames=["phase"]
+)
 
 
 class StartupMonitor:
     def __init__(self):
         self.current_state: Optional[StartupState] = None
         self.current_state_start: Optional[datetime.datetime] = None
+        self.current_state_trace_start: Optional[float] = None
 
     def set_state(self, state: StartupState) -> None:
         if self.current_state is not None:
@@ -59,17 +67,25 @@ class StartupMonitor:
             last_duration = self.current_duration()
             if last_duration is not None:
                 startup_state_duration.labels(state=last_state.value).set_function(lambda: last_duration)
+            startup_tracer.record(
+                last_state.value, "startup_state", "startup state", self.current_state_trace_start, startup_tracer.now()
+            )
         startup_state.state(state.value)
         startup_state_latest_state_change.set_to_current_time()
         startup_state_duration.labels(state=state.value).set_function(self.current_duration)
         self.current_state = state
         self.current_state_start = datetime.datetime.now()
+        self.current_state_trace_start = startup_tracer.now()
 
     def current_duration(self) -> Optional[float]:
         if self.current_state_start is None:
             return None
         return (datetime.datetime.now() - self.current_state_start).total_seconds()
 
+    def record_phase(self, phase: str, duration: float) -> None:
+        startup_phase_duration.labels(phase=phase).set(duration)
+
     def set_running(self) -> None:
         self.set_state(StartupState.RUNNING)
         startup_time.set_to_current_time()
+        startup_tracer.schedule_write()
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TraceSpan:
+    def __init__(self, name: str, category: str, lane: str, start_us: float, args: Optional[Dict] = None) -> None:
+        self.name = name
+        self.category = category
+        self.lane = lane
+        self.start_us = start_us
+        self.end_us: Optional[float] = None
+        self.args = args or {}
+
+
+class StartupTracer:
+    """
+    Opt-in tracer, which records spans during startup and writes them out as a Chrome trace-event JSON file, to be
+    opened in chrome://tracing or https://ui.perfetto.dev
+    Spans are assigned to lanes when the file is written, so that concurrent spans of the same lane are shown on
+    separate rows, and any serialisation is visible.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.path: Optional[str] = None
+        self.post_startup_seconds = 0
+        self._start = time.perf_counter()
+        self._spans: List[TraceSpan] = []
+        self._groups: Dict[str, TraceSpan] = {}
+
+    def enable(self, path: str, post_startup_seconds: int = 0) -> None:
+        logger.info("Startup tracing enabled, trace will be written to %s", path)
+        self.enabled = True
+        self.path = path
+        self.post_startup_seconds = post_startup_seconds
+
+    def now(self) -> float:
+        return (time.perf_counter() - self._start) * 1_000_000
+
+    def record(
+            self,
+            name: str,
+            category: str,
+            lane: str,
+            start_us: float,
+            end_us: float,
+            args: Optional[Dict] = None,
+    ) -> None:
+        if not self.enabled:
+            return
+        span = TraceSpan(name, category, lane, start_us, args)
+        span.end_us = end_us
+        self._spans.append(span)
+
+    @contextmanager
+    def span(
+            self,
+            name: str,
+            category: str,
+            lane: Optional[str] = None,
+            args: Optional[Dict] = None,
+    ) -> Generator[None, None, None]:
+        if not self.enabled:
+            yield
+            return
+        start_us = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, category, lane or category, start_us, self.now(), args)
+
+    @contextmanager
+    def group_span(
+            self,
+            key: str,
+            name: str,
+            category: str,
+            lane: Optional[str] = None,
+            args: Optional[Dict] = None,
+    ) -> Generator[None, None, None]:
+        """
+        Records a single span, covering every use of the group with the given key, from the first start to the last
+        end. Used to show per-chat spans for work which is spread out over many separate awaitables.
+        """
+        if not self.enabled:
+            yield
+            return
+        group = self._groups.get(key)
+        if group is None:
+            group = TraceSpan(name, category, lane or category, self.now(), args)
+            group.args["count"] = 0
+            self._groups[key] = group
+            self._spans.append(group)
+        try:
+            yield
+        finally:
+            group.end_us = self.now()
+            group.args["count"] += 1
+
+    def schedule_write(self) -> None:
+        if not self.enabled:
+            return
+        if self.post_startup_seconds <= 0:
+            self.write()
+            return
+        logger.info("Startup trace will be written in %s seconds", self.post_startup_seconds)
+        asyncio.get_event_loop().call_later(self.post_startup_seconds, self.write)
+
+    def _trace_events(self) -> List[Dict]:
+        events = []
+        lane_ends: Dict[str, List[float]] = {}
+        thread_ids: Dict[str, List[int]] = {}
+        spans = sorted([span for span in self._spans if span.end_us is not None], key=lambda s: s.start_us)
+        for span in spans:
+            ends = lane_ends.setdefault(span.lane, [])
+            ids = thread_ids.setdefault(span.lane, [])
+            # Place the span on the first row of its lane which is free
+            row = next((i for i, end_us in enumerate(ends) if end_us <= span.start_us), None)
+            if row is None:
+                row = len(ends)
+                ends.append(span.end_us)
+                thread_id = sum(len(x) for x in thread_ids.values()) + 1
+                ids.append(thread_id)
+                events.append({
+                    "name": "thread_name", "ph": "M", "pid": 1, "tid": thread_id,
+                    "args": {"name": f"{span.lane} #{row + 1}"},
+                })
+                events.append({
+                    "name": "thread_sort_index", "ph": "M", "pid": 1, "tid": thread_id,
+                    "args": {"sort_index": thread_id},
+                })
+            ends[row] = span.end_us
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start_us,
+                "dur": span.end_us - span.start_us,
+                "pid": 1,
+                "tid": ids[row],
+                "args": span.args,
+            })
+        events.insert(0, {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "gif_pipeline startup"}})
+        return events
+
+    def write(self) -> None:
+        if not self.enabled:
+            return
+        events = self._trace_events()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info("Wrote startup trace with %s spans to %s", len(self._spans), self.path)
+        # Stop recording, so that the trace does not keep growing while the pipeline runs
+        self.enabled = False
+        self._spans.clear()
+        self._groups.clear()
+
+
+startup_tracer = StartupTracer()
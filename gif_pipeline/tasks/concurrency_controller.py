@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, NamedTuple, Any, Tuple, List
+
+from prometheus_client import Counter, Gauge, Enum
+
+from gif_pipeline.tasks.task_worker import SlotPool
+
+logger = logging.getLogger(__name__)
+
+REASONS = ["none", "queue", "load", "memory", "throughput"]
+
+concurrency_adjustments = Counter(
+    "gif_pipeline_concurrency_adjustments_total",
+    "Number of times the adaptive concurrency controller changed a pool's size, by pool, direction and reason",
+    labelnames=["pool", "direction", "reason"]
+)
+concurrency_last_reason = Enum(
+    "gif_pipeline_concurrency_last_adjustment_reason",
+    "Reason for the latest change the adaptive concurrency controller made to each pool's size",
+    labelnames=["pool"],
+    states=REASONS
+)
+concurrency_throughput = Gauge(
+    "gif_pipeline_concurrency_throughput_per_minute",
+    "Tasks completed per minute by each pool, since its size last changed",
+    labelnames=["pool"]
+)
+system_cpu_utilisation = Gauge(
+    "gif_pipeline_system_cpu_utilisation_ratio",
+    "Fraction of CPU time in use across all cores, as seen by the adaptive concurrency controller"
+)
+system_load_per_cpu = Gauge(
+    "gif_pipeline_system_load_per_cpu",
+    "One minute load average divided by the number of cores"
+)
+system_run_queue_per_cpu = Gauge(
+    "gif_pipeline_system_run_queue_per_cpu",
+    "Number of runnable threads divided by the number of cores, as seen by the adaptive concurrency controller"
+)
+system_memory_available = Gauge(
+    "gif_pipeline_system_memory_available_ratio",
+    "Fraction of memory available for new processes"
+)
+
+# Pools whose tasks mostly use CPU, so are shrunk when the host is overloaded. Network bound pools are only sized by
+# their queue and throughput.
+CPU_BOUND_POOLS = {"encode", "hash"}
+
+
+class PoolLimits(NamedTuple):
+    min_size: int
+    max_size: int
+
+
+class AdaptiveConcurrencyConfig:
+    def __init__(
+            self,
+            pool_limits: Dict[str, PoolLimits],
+            interval_seconds: float,
+            load_target: float,
+            min_memory_available: float,
+    ) -> None:
+        self.pool_limits = pool_limits
+        self.interval_seconds = interval_seconds
+        self.load_target = load_target
+        self.min_memory_available = min_memory_available
+
+    @classmethod
+    def from_json(cls, json_dict: Dict[str, Any]) -> "AdaptiveConcurrencyConfig":
+        return cls(
+            {
+                name: PoolLimits(limits.get("min", 1), limits["max"])
+                for name, limits in json_dict.get("pools", {}).items()
+            },
+            json_dict.get("interval_seconds", 15),
+            json_dict.get("load_target", 1.5),
+            json_dict.get("min_memory_available", 0.1),
+        )
+
+
+class SystemSample(NamedTuple):
+    # Each is None if it cannot be measured on this platform
+    cpu_utilisation: Optional[float]
+    load_per_cpu: Optional[float]
+    run_queue_per_cpu: Optional[float]
+    memory_available: Optional[float]
+
+
+class SystemMonitor:
+    """
+    Samples CPU, load, run queue and memory use from /proc and the load average. Signals which are not available on the platform,
+    such as on Windows, are left as None.
+    """
+
+    def __init__(self) -> None:
+        self._last_cpu_times: Optional[Tuple[int, int]] = None
+
+    def _cpu_utilisation(self, stat_lines: List[str]) -> Optional[float]:
+        try:
+            fields = [int(x) for x in stat_lines[0].split()[1:]]
+        except (IndexError, ValueError):
+            return None
+        # Idle time is the idle and iowait columns
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        total = sum(fields[:8])
+        last = self._last_cpu_times
+        self._last_cpu_times = idle, total
+        if last is None or total <= last[1]:
+            return None
+        return 1 - (idle - last[0]) / (total - last[1])
+
+    @staticmethod
+    def _run_queue_per_cpu(stat_lines: List[str]) -> Optional[float]:
+        for line in stat_lines:
+            if line.startswith("procs_running "):
+                try:
+                    return int(line.split()[1]) / (os.cpu_count() or 1)
+                except (IndexError, ValueError):
+                    return None
+        return None
+
+    @staticmethod
+    def _load_per_cpu() -> Optional[float]:
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (OSError, AttributeError):
+            return None
+
+    @staticmethod
+    def _memory_available() -> Optional[float]:
+        meminfo = {}
+        try:
+            with open("/proc/meminfo", "r") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    meminfo[key] = int(value.split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+        if not meminfo.get("MemTotal") or "MemAvailable" not in meminfo:
+            return None
+        return meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+    def sample(self) -> SystemSample:
+        try:
+            with open("/proc/stat", "r") as f:
+                stat_lines = f.readlines()
+        except OSError:
+            stat_lines = []
+        return SystemSample(
+            self._cpu_utilisation(stat_lines),
+            self._load_per_cpu(),
+            self._run_queue_per_cpu(stat_lines),
+            self._memory_available(),
+        )
+
+
+class _PoolState:
+    def __init__(self, pool: SlotPool) -> None:
+        self.pool = pool
+        self.changed_at = time.monotonic()
+        self.completed_at_change = pool.completed
+        # Throughput over the period before the latest increase, to check whether the increase helped
+        self.throughput_before_increase: Optional[float] = None
+        # After an increase failed to help, the pool is not grown past this size until the time given
+        self.ceiling: Optional[Tuple[int, float]] = None
+
+    def throughput(self, now: float) -> float:
+        elapsed = now - self.changed_at
+        if elapsed <= 0:
+            return 0
+        return (self.pool.completed - self.completed_at_change) / elapsed
+
+    def mark_changed(self, now: float) -> None:
+        self.changed_at = now
+        self.completed_at_change = self.pool.completed
+
+
+class ConcurrencyController:
+    """
+    Adjusts the size of slot pools within configured bounds, by additive increase and multiplicative decrease. A pool
+    grows by one slot at a time while tasks are queueing for it and the host has capacity to spare, and the growth is
+    undone if throughput does not improve. CPU bound pools shrink by a quarter when there are more runnable threads than
+    the cores can keep up with, or memory is short. High CPU use alone does not shrink them, as a single encode can use
+    every core while the host still has headroom.
+    """
+    DECREASE_FACTOR = 0.75
+    # A pool must keep a size for this many intervals before it can grow again, so that its throughput can be measured
+    SETTLE_INTERVALS = 4
+    # An increase is undone if throughput dropped by more than this fraction
+    THROUGHPUT_TOLERANCE = 0.1
+    # How many intervals an increase which did not help is remembered for
+    CEILING_INTERVALS = 20
+
+    def __init__(self, pools: Dict[str, SlotPool]) -> None:
+        self.pools = pools
+        self.config: Optional[AdaptiveConcurrencyConfig] = None
+        self.monitor = SystemMonitor()
+        self.states: Dict[str, _PoolState] = {}
+        for name in pools:
+            concurrency_last_reason.labels(pool=name).state("none")
+
+    def configure(self, config: Optional[AdaptiveConcurrencyConfig]) -> None:
+        self.config = config
+        self.states.clear()
+        if config is None:
+            return
+        for name, limits in config.pool_limits.items():
+            pool = self.pools.get(name)
+            if pool is None:
+                logger.warning("Adaptive concurrency configured for unknown pool: %s", name)
+                continue
+            self.states[name] = _PoolState(pool)
+            concurrency_throughput.labels(pool=name).set(0)
+            for reason in REASONS[1:]:
+                direction = "up" if reason == "queue" else "down"
+                concurrency_adjustments.labels(pool=name, direction=direction, reason=reason)
+            clamped = min(max(pool.size, limits.min_size), limits.max_size)
+            if clamped != pool.size:
+                logger.info("Clamping %s pool size from %s to %s", name, pool.size, clamped)
+                pool.resize(clamped)
+
+    async def run(self) -> None:
+        while True:
+            interval = self.config.interval_seconds if self.config is not None else 60
+            await asyncio.sleep(interval)
+            if self.config is None:
+                continue
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.error("Adaptive concurrency controller failed to adjust pools", exc_info=e)
+
+    def adjust(self) -> None:
+        sample = self.monitor.sample()
+        if sample.cpu_utilisation is not None:
+            system_cpu_utilisation.set(sample.cpu_utilisation)
+        if sample.load_per_cpu is not None:
+            system_load_per_cpu.set(sample.load_per_cpu)
+        if sample.run_queue_per_cpu is not None:
+            system_run_queue_per_cpu.set(sample.run_queue_per_cpu)
+        if sample.memory_available is not None:
+            system_memory_available.set(sample.memory_available)
+        now = time.monotonic()
+        for name, state in self.states.items():
+            limits = self.config.pool_limits[name]
+            throughput = state.throughput(now)
+            concurrency_throughput.labels(pool=name).set(throughput * 60)
+            decision = self._decide(name, state, limits, sample, throughput, now)
+            if decision is None:
+                continue
+            new_size, reason = decision
+            old_size = state.pool.size
+            direction = "up" if new_size > old_size else "down"
+            logger.info(
+                "Adaptive concurrency: resizing %s pool from %s to %s, reason: %s", name, old_size, new_size, reason
+            )
+            concurrency_adjustments.labels(pool=name, direction=direction, reason=reason).inc()
+            concurrency_last_reason.labels(pool=name).state(reason)
+            state.throughput_before_increase = throughput if direction == "up" else None
+            state.pool.resize(new_size)
+            state.mark_changed(now)
+
+    def _overloaded(self, sample: SystemSample) -> bool:
+        """
+        Whether there are more runnable threads than the cores can serve. The load average shows the overload has
+        lasted, and the current run queue, if it can be read, shows that it has not already passed, since the load
+        average lags behind by a minute or more.
+        """
+        load_target = self.config.load_target
+        if sample.load_per_cpu is None or sample.load_per_cpu <= load_target:
+            return False
+        return sample.run_queue_per_cpu is None or sample.run_queue_per_cpu > load_target
+
+    def _decide(
+            self,
+            name: str,
+            state: _PoolState,
+            limits: PoolLimits,
+            sample: SystemSample,
+            throughput: float,
+            now: float,
+    ) -> Optional[Tuple[int, str]]:
+        config = self.config
+        pool = state.pool
+        size = pool.size
+        decreased = max(limits.min_size, min(size - 1, int(size * self.DECREASE_FACTOR)))
+        if name in CPU_BOUND_POOLS:
+            overload_reason = None
+            if sample.memory_available is not None and sample.memory_available < config.min_memory_available:
+                overload_reason = "memory"
+            elif self._overloaded(sample):
+                overload_reason = "load"
+            if overload_reason is not None:
+                if decreased < size:
+                    return decreased, overload_reason
+                return None
+        if now - state.changed_at < config.interval_seconds * self.SETTLE_INTERVALS:
+            return None
+        if state.throughput_before_increase is not None:
+            before = state.throughput_before_increase
+            state.throughput_before_increase = None
+            if throughput < before * (1 - self.THROUGHPUT_TOLERANCE) and size > limits.min_size:
+                state.ceiling = (size - 1, now + config.interval_seconds * self.CEILING_INTERVALS)
+                return size - 1, "throughput"
+        max_size = limits.max_size
+        if state.ceiling is not None:
+            ceiling_size, ceiling_until = state.ceiling
+            if now < ceiling_until:
+                max_size = min(max_size, ceiling_size)
+            else:
+                state.ceiling = None
+        saturated = pool.free_slots <= 0 and pool.queue_length() > 0
+        if saturated and size < max_size:
+            return size + 1, "queue"
+        return None
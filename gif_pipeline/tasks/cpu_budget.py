@@ -0,0 +1,71 @@
+import logging
+import shutil
+from typing import Callable, List, Optional, Dict, Tuple
+
+from prometheus_client import Gauge
+
+from gif_pipeline.tasks.task_worker import TaskPriority
+
+logger = logging.getLogger(__name__)
+
+cpu_budget_threads = Gauge(
+    "gif_pipeline_cpu_budget_threads_per_task",
+    "Number of threads each CPU bound task is currently given from the thread budget, or 0 if the budget is disabled"
+)
+
+# Niceness, and ionice arguments, for subprocesses started by tasks in lower priority classes, so that they yield CPU
+# and disk to user commands
+PROCESS_PRIORITIES: Dict[TaskPriority, Tuple[int, List[str]]] = {
+    TaskPriority.SUBSCRIPTION: (5, ["-c", "2", "-n", "7"]),
+    TaskPriority.BACKGROUND: (10, ["-c", "3"]),
+}
+
+
+class CpuBudget:
+    """
+    Shares a budget of CPU threads between the CPU bound tasks which are running, so that concurrent encodes and
+    hashing do not each try to use every core. Also decides the OS priority for subprocesses of each priority class.
+    """
+
+    def __init__(self) -> None:
+        self.total_threads: Optional[int] = None
+        self._running_count: Callable[[], int] = lambda: 1
+        self._nice_path = shutil.which("nice")
+        self._ionice_path = shutil.which("ionice")
+        cpu_budget_threads.set_function(lambda: self.threads_per_task() or 0)
+
+    def configure(self, total_threads: Optional[int], running_count: Callable[[], int]) -> None:
+        """
+        Sets the number of threads to share, or None or 0 to disable the budget. running_count gives the number of CPU
+        bound tasks currently running, which the budget is split between.
+        """
+        self.total_threads = total_threads or None
+        self._running_count = running_count
+
+    def threads_per_task(self) -> Optional[int]:
+        """
+        Number of threads each CPU bound task should use, or None to leave it to ffmpeg. This is called as each task
+        starts, so it counts the task itself, and a task running alone gets the whole budget.
+        """
+        if self.total_threads is None:
+            return None
+        return max(1, self.total_threads // max(1, self._running_count()))
+
+    def priority_prefix(self, priority: TaskPriority) -> List[str]:
+        """
+        Command prefix to run a subprocess at the OS priority for the given task priority. Empty if the priority class
+        runs at normal priority, or nice and ionice are not available, such as on Windows.
+        """
+        if priority not in PROCESS_PRIORITIES:
+            return []
+        niceness, ionice_args = PROCESS_PRIORITIES[priority]
+        prefix = []
+        if self._nice_path is not None:
+            prefix += [self._nice_path, "-n", str(niceness)]
+        if self._ionice_path is not None:
+            # Ignore failures to set the IO priority, rather than not running the command
+            prefix += [self._ionice_path, "-t", *ionice_args]
+        return prefix
+
+
+cpu_budget = CpuBudget()
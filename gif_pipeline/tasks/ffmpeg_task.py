@@ -1,30 +1,324 @@
+import asyncio
+import copy
+import logging
+import os
+import re
+import shutil
 import subprocess
-from typing import Tuple
+import time
+from asyncio import StreamReader
+from contextvars import ContextVar
+from typing import Tuple, Optional, Dict, List, Set, Hashable
 
 import ffmpy3
+from prometheus_client import Histogram, Gauge, Counter
 
-from gif_pipeline.tasks.task import Task
+from gif_pipeline.tasks.cpu_budget import cpu_budget
+from gif_pipeline.tasks.task import Task, ResourceClass, TaskException, DEFAULT_TIMEOUT, file_identity, start_process, \
+    kill_process, shared_output_path, remove_output_file
+from gif_pipeline.tasks.task_worker import current_task_priority
+
+logger = logging.getLogger(__name__)
+
+ffmpeg_speed = Histogram(
+    "gif_pipeline_ffmpeg_speed_ratio",
+    "Average speed of completed ffmpeg tasks, as a multiple of realtime",
+    buckets=[0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+)
+ffmpeg_running_speed = Gauge(
+    "gif_pipeline_ffmpeg_running_speed_ratio",
+    "Total current speed of running ffmpeg tasks, as a multiple of realtime"
+)
+ffmpeg_longest_eta = Gauge(
+    "gif_pipeline_ffmpeg_longest_eta_seconds",
+    "Estimated time until the running ffmpeg task with the most remaining work completes"
+)
+ffmpeg_stalls = Counter(
+    "gif_pipeline_ffmpeg_stalled_total",
+    "Number of ffmpeg tasks which were killed for giving no progress updates"
+)
+
+DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+def is_file_output(path: str) -> bool:
+    return path not in ["-", os.devnull] and not path.startswith("pipe:")
+
+
+class FfmpegProgress:
+    """
+    Progress of a running ffmpeg process, as reported by its `-progress` output.
+    """
+
+    def __init__(self, duration: Optional[float]) -> None:
+        # Expected duration of the output, in seconds, if known
+        self.duration = duration
+        self.frame = 0
+        self.out_time = 0.0
+        self.speed: Optional[float] = None
+        self.started_at = time.monotonic()
+        self.updated_at = self.started_at
+        self.done = False
+
+    def update(self, values: Dict[str, str]) -> None:
+        self.updated_at = time.monotonic()
+        try:
+            self.frame = int(values.get("frame", self.frame))
+        except ValueError:
+            pass
+        try:
+            # Despite its name, out_time_ms is in microseconds too
+            out_time_us = values.get("out_time_us", values.get("out_time_ms"))
+            if out_time_us is not None:
+                self.out_time = max(0.0, int(out_time_us) / 1_000_000)
+        except ValueError:
+            pass
+        try:
+            self.speed = float(values.get("speed", "").rstrip("x"))
+        except ValueError:
+            pass
+
+    @property
+    def fraction(self) -> Optional[float]:
+        if not self.duration:
+            return None
+        return min(1.0, self.out_time / self.duration)
+
+    @property
+    def eta(self) -> Optional[float]:
+        if not self.duration or not self.speed:
+            return None
+        return max(0.0, self.duration - self.out_time) / self.speed
+
+    def describe(self) -> str:
+        parts = []
+        if self.speed:
+            parts.append(f"{self.speed:.1f}x speed")
+        eta = self.eta
+        if eta is not None:
+            parts.append(f"about {eta:.0f}s left")
+        fraction = self.fraction
+        if fraction is None:
+            return f"{self.out_time:.0f}s processed" + (f" ({', '.join(parts)})" if parts else "")
+        return f"{fraction:.0%}" + (f" ({', '.join(parts)})" if parts else "")
+
+
+_running_progress: Set[FfmpegProgress] = set()
+ffmpeg_running_speed.set_function(lambda: sum(p.speed or 0 for p in _running_progress))
+ffmpeg_longest_eta.set_function(lambda: max([p.eta or 0 for p in _running_progress], default=0))
+
+
+class ProgressTracker:
+    """
+    Collects the progress of ffmpeg tasks started while it is the current tracker, so that whatever is waiting on
+    them, such as a progress message, can show how far along they are.
+    """
+
+    def __init__(self) -> None:
+        self.progresses: List[FfmpegProgress] = []
+
+    def add(self, progress: FfmpegProgress) -> None:
+        self.progresses.append(progress)
+
+    def describe(self) -> Optional[str]:
+        running = [progress for progress in self.progresses if not progress.done]
+        if not running:
+            return None
+        return running[-1].describe()
+
+
+current_progress_tracker: ContextVar[Optional[ProgressTracker]] = ContextVar("current_progress_tracker", default=None)
 
 
 class FfmpegTask(Task[Tuple[str, str]]):
+    # Kill ffmpeg if it gives no progress updates for this many seconds
+    STALL_TIMEOUT = DEFAULT_TIMEOUT
+    # Time limit for encodes, in seconds, unless their purpose has its own below
+    TIMEOUT = 2 * 60 * 60
+    PURPOSE_TIMEOUTS = {
+        "thumbnail": 2 * 60,
+        "crop_detect": 10 * 60,
+        "stabilise": 6 * 60 * 60,
+        "decompose": 60 * 60,
+        # The whole video is split into chunks in one run
+        "chunk_split": 6 * 60 * 60,
+    }
 
-    def __init__(self, *, global_options=None, inputs=None, outputs=None, description=None) -> None:
+    def __init__(
+            self,
+            *,
+            global_options=None,
+            inputs=None,
+            outputs=None,
+            description=None,
+            resource_class: ResourceClass = None,
+            duration: Optional[float] = None,
+            stall_timeout: Optional[float] = None,
+            purpose: Optional[str] = None,
+    ) -> None:
         super().__init__(description=description)
         self.global_options = global_options
         self.inputs = inputs
         self.outputs = outputs
+        if resource_class is not None:
+            self.resource_class = resource_class
+        self.stall_timeout = stall_timeout or self.STALL_TIMEOUT
+        # Expected output duration, for progress percentages. If not given, the first input duration is used.
+        self.progress = FfmpegProgress(duration)
+        # What the encode is for, such as "cut" or "thumbnail", so that metrics can be split by purpose
+        self.purpose = purpose
+
+    @property
+    def task_type(self) -> str:
+        if self.purpose is None:
+            return "ffmpeg"
+        return f"ffmpeg_{self.purpose}"
+
+    @property
+    def timeout(self) -> Optional[float]:
+        return self.PURPOSE_TIMEOUTS.get(self.purpose, self.TIMEOUT)
+
+    def _progress_global_options(self) -> List[str]:
+        if self.global_options is None:
+            global_options = []
+        elif isinstance(self.global_options, str):
+            global_options = [self.global_options]
+        else:
+            global_options = list(self.global_options)
+        return ["-progress pipe:1 -nostats"] + global_options
+
+    def _budgeted_options(self) -> Tuple[List[str], Optional[Dict]]:
+        """
+        Global options and outputs to run with, limited to this task's share of the thread budget, unless the task
+        already sets its own thread counts.
+        """
+        global_options = self._progress_global_options()
+        threads = cpu_budget.threads_per_task()
+        if threads is None or self.resource_class not in [ResourceClass.ENCODE, ResourceClass.HASH]:
+            return global_options, self.outputs
+        if not any("-filter_threads" in option for option in global_options):
+            global_options.append(f"-filter_threads {threads} -filter_complex_threads {threads}")
+        outputs = {}
+        for path, options in (self.outputs or {}).items():
+            if options is None:
+                options = f"-threads {threads}"
+            elif isinstance(options, str):
+                if "-threads " not in options:
+                    options = f"-threads {threads} {options}"
+            elif not any("-threads " in option for option in options):
+                options = [f"-threads {threads}", *options]
+            outputs[path] = options
+        return global_options, outputs
+
+    def coalesce_key(self) -> Optional[Hashable]:
+        outputs = []
+        for path, options in (self.outputs or {}).items():
+            if not is_file_output(path):
+                outputs.append((path, options))
+                continue
+            # Image sequence outputs write an unknown number of files, so cannot be copied for a shared run
+            if "%" in path:
+                return None
+            # Output paths are usually random, so only their extension is part of the key
+            outputs.append((os.path.splitext(path)[1], options))
+        inputs = tuple((file_identity(path), options) for path, options in (self.inputs or {}).items())
+        return "ffmpeg", tuple(self._progress_global_options()), inputs, tuple(outputs)
+
+    def shared_run_task(self) -> "FfmpegTask":
+        shared_task = copy.copy(self)
+        shared_task.outputs = {
+            (shared_output_path(path) if is_file_output(path) else path): options
+            for path, options in (self.outputs or {}).items()
+        }
+        return shared_task
+
+    def copy_outputs(self, caller: "FfmpegTask") -> None:
+        for path, caller_path in zip(self.outputs or {}, caller.outputs or {}):
+            if not is_file_output(path):
+                continue
+            if not os.path.isfile(path):
+                raise TaskException(f"Output of shared ffmpeg run is missing: {path}")
+            shutil.copyfile(path, caller_path)
+
+    def remove_outputs(self) -> None:
+        for path in self.outputs or {}:
+            if is_file_output(path):
+                remove_output_file(path)
+
+    async def _read_progress(self, stream: StreamReader) -> str:
+        output_lines = []
+        values: Dict[str, str] = {}
+        while True:
+            line_bytes = await asyncio.wait_for(stream.readline(), self.stall_timeout)
+            if line_bytes == b"":
+                break
+            line = line_bytes.decode("utf-8", errors="replace").strip()
+            key, sep, value = line.partition("=")
+            if not sep:
+                output_lines.append(line)
+                continue
+            values[key] = value
+            # Each block of progress output ends with a progress line
+            if key == "progress":
+                self.progress.update(values)
+                values = {}
+        return "\n".join(output_lines)
+
+    async def _read_stderr(self, stream: StreamReader) -> str:
+        chunks = []
+        while True:
+            chunk = await stream.read(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if self.progress.duration is None:
+                match = DURATION_PATTERN.search(b"".join(chunks).decode("utf-8", errors="replace"))
+                if match:
+                    hours, minutes, seconds = match.groups()
+                    self.progress.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        return b"".join(chunks).decode("utf-8", errors="replace").strip()
 
     async def run(self) -> Tuple[str, str]:
+        tracker = current_progress_tracker.get()
+        if tracker is not None:
+            tracker.add(self.progress)
+        global_options, outputs = self._budgeted_options()
         ff = ffmpy3.FFmpeg(
-            global_options=self.global_options,
+            global_options=global_options,
             inputs=self.inputs,
-            outputs=self.outputs
+            outputs=outputs
         )
-        ff_process = await ff.run_async(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ff_out = await ff_process.communicate()
+        # ffmpy3 builds the command, but it is started here, behind the priority prefix without altering ffmpy3's
+        # copy, and in its own process group, so that it can be killed along with nice and ionice. ffmpy3 is then given
+        # the process, to check its exit code.
+        command = cpu_budget.priority_prefix(current_task_priority.get()) + ff._cmd
+        ff_process = await start_process(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        ff.process = ff_process
+        self.progress.started_at = self.progress.updated_at = time.monotonic()
+        _running_progress.add(self.progress)
+        try:
+            output, error = await asyncio.gather(
+                self._read_progress(ff_process.stdout),
+                self._read_stderr(ff_process.stderr),
+            )
+        except asyncio.TimeoutError:
+            ffmpeg_stalls.inc()
+            logger.error("ffmpeg gave no progress for %s seconds, killing: %s", self.stall_timeout, ff.cmd)
+            kill_process(ff_process)
+            await ff_process.wait()
+            raise TaskException(f"ffmpeg stalled, with no progress for {self.stall_timeout} seconds")
+        except asyncio.CancelledError:
+            logger.info("ffmpeg task cancelled, killing: %s", ff.cmd)
+            kill_process(ff_process)
+            raise
+        finally:
+            self.progress.done = True
+            _running_progress.discard(self.progress)
         await ff.wait()
-        output = ff_out[0].decode('utf-8', errors="replace").strip()
-        error = ff_out[1].decode('utf-8', errors="replace").strip()
+        run_time = time.monotonic() - self.progress.started_at
+        if run_time > 0 and self.progress.out_time > 0:
+            ffmpeg_speed.observe(self.progress.out_time / run_time)
+        logger.debug("ffmpeg finished in %.1f seconds, %s: %s", run_time, self.progress.describe(), ff.cmd)
         return output, error
 
     def _formatted_args(self) -> list[str]:
@@ -1,11 +1,16 @@
+import asyncio
 import subprocess
+from typing import Optional, Hashable
 
 import ffmpy3
 
-from gif_pipeline.tasks.task import Task
+from gif_pipeline.tasks.task import Task, ResourceClass, file_identity, start_process, kill_process
 
 
 class FFprobeTask(Task[str]):
+    resource_class = ResourceClass.PROBE
+    task_type = "ffprobe"
+    timeout = 2 * 60
 
     def __init__(self, *, global_options=None, inputs=None, outputs=None, description=None):
         super().__init__(description=description)
@@ -18,12 +23,22 @@ class FFprobeTask(Task[str]):
             global_options=self.global_options,
             inputs=self.inputs
         )
-        ffprobe_process = await ffprobe.run_async(stdout=subprocess.PIPE)
-        ffprobe_out = await ffprobe_process.communicate()
+        ffprobe_process = await start_process(ffprobe._cmd, stdout=subprocess.PIPE)
+        ffprobe.process = ffprobe_process
+        try:
+            ffprobe_out = await ffprobe_process.communicate()
+        except asyncio.CancelledError:
+            kill_process(ffprobe_process)
+            raise
         await ffprobe.wait()
         output = ffprobe_out[0].decode('utf-8').strip()
         return output
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        global_options = self.global_options if isinstance(self.global_options, str) else tuple(self.global_options or [])
+        inputs = tuple((file_identity(path), options) for path, options in (self.inputs or {}).items())
+        return "ffprobe", global_options, inputs
+
     def _formatted_args(self) -> list[str]:
         return self._format_args({
             "global_options": self.global_options,
@@ -5,7 +5,8 @@ from concurrent.futures import Executor
 import imagehash
 from PIL import Image
 
-from gif_pipeline.tasks.task import Task
+from gif_pipeline.tasks.cpu_budget import cpu_budget
+from gif_pipeline.tasks.task import Task, ResourceClass
 
 
 def hash_image(image_file: str) -> str:
@@ -15,6 +16,9 @@ def hash_image(image_file: str) -> str:
 
 
 class HashDirectoryTask(Task[set[str]]):
+    resource_class = ResourceClass.HASH
+    task_type = "hash"
+    timeout = 30 * 60
 
     def __init__(self, directory: str, executor: Executor, description: str = None) -> None:
         super().__init__(description=description)
@@ -24,9 +28,16 @@ class HashDirectoryTask(Task[set[str]]):
     async def run(self) -> set[str]:
         image_files = glob.glob(f"{self.directory}/*.png")
         loop = asyncio.get_running_loop()
-        hash_list = await asyncio.gather(
-            *[loop.run_in_executor(self.executor, hash_image, image_file) for image_file in image_files]
-        )
+        # The executor is shared by every hash task, so each one only submits as many images at a time as its share of
+        # the thread budget
+        threads = cpu_budget.threads_per_task() or len(image_files) or 1
+        semaphore = asyncio.Semaphore(threads)
+
+        async def hash_file(image_file: str) -> str:
+            async with semaphore:
+                return await loop.run_in_executor(self.executor, hash_image, image_file)
+
+        hash_list = await asyncio.gather(*[hash_file(image_file) for image_file in image_files])
         return set(hash_list)
 
     def _formatted_args(self) -> list[str]:
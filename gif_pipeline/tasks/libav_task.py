@@ -0,0 +1,298 @@
+import asyncio
+import copy
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from typing import Dict, Optional, Hashable, List, Tuple, Set
+
+from gif_pipeline.tasks.task import Task, TaskException, ResourceClass, file_identity, shared_output_path, \
+    remove_output_file
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+# How far past the end of an interval to read, when checking for closed GOPs, to see the frames after a keyframe
+CLOSED_GOP_READ_SECONDS = 2
+
+
+def libav_available() -> bool:
+    return av is not None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # PyAV releases the GIL while demuxing and decoding, so threads are enough to run these in parallel
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="libav")
+    return _executor
+
+
+def _format_rate(rate: Optional[Fraction]) -> Optional[str]:
+    if rate is None:
+        return None
+    return f"{rate.numerator}/{rate.denominator}"
+
+
+def probe_file(video_path: str) -> Dict:
+    """
+    Reads the container and stream headers of a file, and returns them in the same layout as the json output of
+    `ffprobe -show_format -show_streams`, for the fields the pipeline uses.
+    """
+    with av.open(video_path) as container:
+        probe_format = {
+            "filename": video_path,
+            "format_name": container.format.name,
+            "nb_streams": len(container.streams),
+        }
+        if container.duration is not None:
+            probe_format["duration"] = str(container.duration / av.time_base)
+        if container.bit_rate:
+            probe_format["bit_rate"] = str(container.bit_rate)
+        streams = []
+        for stream in container.streams:
+            codec_context = stream.codec_context
+            stream_data = {
+                "index": stream.index,
+                "codec_type": stream.type,
+                "codec_name": codec_context.name if codec_context else None,
+            }
+            if stream.type == "video":
+                stream_data["width"] = codec_context.width
+                stream_data["height"] = codec_context.height
+                stream_data["pix_fmt"] = codec_context.pix_fmt
+                stream_data["profile"] = codec_context.profile
+                stream_data["avg_frame_rate"] = _format_rate(stream.average_rate)
+                stream_data["r_frame_rate"] = _format_rate(stream.base_rate)
+            if stream.type == "audio":
+                stream_data["sample_rate"] = str(codec_context.sample_rate)
+            streams.append(stream_data)
+    return {"format": probe_format, "streams": streams}
+
+
+def grab_frame(
+        video_path: str,
+        output_path: str,
+        timestamp: float,
+        max_width: Optional[int] = None,
+        max_height: Optional[int] = None,
+) -> str:
+    """
+    Saves the first frame at or after the given timestamp to an image file, optionally shrunk to fit the given size
+    while keeping its aspect ratio. Image format is chosen by the output file extension.
+    """
+    with av.open(video_path) as container:
+        if not container.streams.video:
+            raise TaskException(f"No video stream in {video_path}")
+        stream = container.streams.video[0]
+        # Seeking lands on the keyframe before the timestamp, then frames are decoded up to the timestamp
+        if timestamp > 0 and stream.time_base is not None:
+            container.seek(int(timestamp / stream.time_base), stream=stream)
+        for frame in container.decode(stream):
+            if frame.time is not None and frame.time < timestamp:
+                continue
+            image = frame.to_image()
+            if max_width is not None and max_height is not None:
+                image.thumbnail((max_width, max_height))
+            image.save(output_path)
+            return output_path
+    raise TaskException(f"Video {video_path} has no frame at {timestamp} seconds")
+
+
+def closed_gop_keyframes(packets: List[Tuple[float, Optional[float], bool]]) -> Set[float]:
+    """
+    Given a video stream's packets in decode order, as (timestamp, decode timestamp, is keyframe), returns the
+    keyframes which start a closed GOP, as IDR frames do. An open GOP keyframe, such as an h264 I-frame which is not an
+    IDR frame, or an HEVC CRA frame, is followed in decode order by frames which are shown before it, and refer back to
+    the GOP before, so a stream cannot be cut there cleanly. A decode timestamp going backwards, from a seek to another
+    interval, ends the GOP being checked.
+    """
+    keyframes = set()
+    current = None
+    last_dts = None
+    for timestamp, dts, is_keyframe in packets:
+        if dts is not None and last_dts is not None and dts < last_dts:
+            if current is not None:
+                keyframes.add(current)
+            current = None
+        if dts is not None:
+            last_dts = dts
+        if is_keyframe:
+            if current is not None:
+                keyframes.add(current)
+            current = timestamp
+        elif current is not None and timestamp < current:
+            current = None
+    if current is not None:
+        keyframes.add(current)
+    return keyframes
+
+
+def read_keyframes(video_path: str, intervals: List[Tuple[float, float]], closed_gop: bool = False) -> List[float]:
+    """
+    Returns the timestamps of video keyframes within the given (start, end) intervals, in seconds from the start of the
+    file, optionally only those which start a closed GOP. Only packets are read, nothing is decoded.
+    """
+    keyframes = set()
+    with av.open(video_path) as container:
+        if not container.streams.video:
+            return []
+        stream = container.streams.video[0]
+        start_time = (container.start_time or 0) / av.time_base
+        for interval_start, interval_end in intervals:
+            packets = []
+            # Seeking lands on the keyframe before the interval start
+            container.seek(int((start_time + max(0.0, interval_start)) * av.time_base))
+            read_end = interval_end + (CLOSED_GOP_READ_SECONDS if closed_gop else 0)
+            for packet in container.demux(stream):
+                if packet.pts is None:
+                    continue
+                timestamp = float(packet.pts * packet.time_base) - start_time
+                if timestamp > read_end:
+                    break
+                dts = float(packet.dts * packet.time_base) - start_time if packet.dts is not None else None
+                packets.append((timestamp, dts, packet.is_keyframe))
+            if closed_gop:
+                interval_keyframes = closed_gop_keyframes(packets)
+            else:
+                interval_keyframes = {timestamp for timestamp, _, is_keyframe in packets if is_keyframe}
+            keyframes.update(k for k in interval_keyframes if interval_start <= k <= interval_end)
+    return sorted(keyframes)
+
+
+class LibavProbeTask(Task[Dict]):
+    """
+    Probes a file in-process with PyAV, rather than running ffprobe. Returns parsed json, as ffprobe would give.
+    """
+    resource_class = ResourceClass.PROBE
+    task_type = "libav_probe"
+    timeout = 2 * 60
+
+    def __init__(self, video_path: str, *, description: str = None) -> None:
+        super().__init__(description=description)
+        self.video_path = video_path
+
+    async def run(self) -> Dict:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(_get_executor(), probe_file, self.video_path)
+        except av.error.FFmpegError as e:
+            raise TaskException(f"Failed to probe {self.video_path}: {e}")
+
+    def coalesce_key(self) -> Optional[Hashable]:
+        return "libav_probe", file_identity(self.video_path)
+
+    def _formatted_args(self) -> list[str]:
+        return self._format_args({"video_path": self.video_path})
+
+
+class LibavKeyframesTask(Task[List[float]]):
+    """
+    Lists the keyframes of a video around some timestamps in-process with PyAV, rather than running ffprobe.
+    """
+    resource_class = ResourceClass.PROBE
+    task_type = "libav_keyframes"
+    timeout = 2 * 60
+
+    def __init__(
+            self,
+            video_path: str,
+            intervals: List[Tuple[float, float]],
+            closed_gop: bool = False,
+            *,
+            description: str = None,
+    ) -> None:
+        super().__init__(description=description)
+        self.video_path = video_path
+        self.intervals = intervals
+        self.closed_gop = closed_gop
+
+    async def run(self) -> List[float]:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(
+                _get_executor(), read_keyframes, self.video_path, self.intervals, self.closed_gop
+            )
+        except av.error.FFmpegError as e:
+            raise TaskException(f"Failed to read keyframes of {self.video_path}: {e}")
+
+    def coalesce_key(self) -> Optional[Hashable]:
+        return "libav_keyframes", file_identity(self.video_path), tuple(self.intervals), self.closed_gop
+
+    def _formatted_args(self) -> list[str]:
+        return self._format_args({
+            "video_path": self.video_path,
+            "intervals": self.intervals,
+            "closed_gop": self.closed_gop,
+        })
+
+
+class LibavFrameTask(Task[str]):
+    """
+    Extracts a single frame of a video to an image file in-process with PyAV, rather than running ffmpeg.
+    """
+    resource_class = ResourceClass.PROBE
+    task_type = "libav_frame"
+    timeout = 2 * 60
+
+    def __init__(
+            self,
+            video_path: str,
+            output_path: str,
+            timestamp: float,
+            max_width: Optional[int] = None,
+            max_height: Optional[int] = None,
+            *,
+            description: str = None,
+    ) -> None:
+        super().__init__(description=description)
+        self.video_path = video_path
+        self.output_path = output_path
+        self.timestamp = timestamp
+        self.max_width = max_width
+        self.max_height = max_height
+
+    async def run(self) -> str:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(
+                _get_executor(),
+                grab_frame,
+                self.video_path,
+                self.output_path,
+                self.timestamp,
+                self.max_width,
+                self.max_height,
+            )
+        except av.error.FFmpegError as e:
+            raise TaskException(f"Failed to extract frame from {self.video_path}: {e}")
+
+    def coalesce_key(self) -> Optional[Hashable]:
+        output_ext = os.path.splitext(self.output_path)[1]
+        return "libav_frame", file_identity(self.video_path), output_ext, self.timestamp, self.max_width, self.max_height
+
+    def shared_run_task(self) -> "LibavFrameTask":
+        shared_task = copy.copy(self)
+        shared_task.output_path = shared_output_path(self.output_path)
+        return shared_task
+
+    def copy_outputs(self, caller: "LibavFrameTask") -> None:
+        if not os.path.isfile(self.output_path):
+            raise TaskException(f"Output of shared frame grab is missing: {self.output_path}")
+        shutil.copyfile(self.output_path, caller.output_path)
+
+    def remove_outputs(self) -> None:
+        remove_output_file(self.output_path)
+
+    def _formatted_args(self) -> list[str]:
+        return self._format_non_null_args({
+            "video_path": self.video_path,
+            "output_path": self.output_path,
+            "timestamp": self.timestamp,
+            "max_width": self.max_width,
+            "max_height": self.max_height,
+        })
@@ -1,10 +1,14 @@
 import asyncio
+import enum
 import json
 import logging
+import os
+import signal
+import uuid
 from abc import ABC, abstractmethod
 from asyncio import StreamReader
 from asyncio.subprocess import Process
-from typing import TypeVar, Generic, Optional, Tuple
+from typing import TypeVar, Generic, Optional, Tuple, Hashable
 
 T = TypeVar('T')
 logger = logging.getLogger(__name__)
@@ -16,14 +20,25 @@ class TaskException(Exception):
     pass
 
 
-async def log_output(proc: Process, timeout: int = DEFAULT_TIMEOUT) -> Tuple[str, str]:
+class ResourceClass(enum.Enum):
+    ENCODE = "encode"  # CPU heavy ffmpeg encodes
+    PROBE = "probe"  # Quick ffprobe calls
+    DOWNLOAD = "download"  # Network bound downloads
+    HASH = "hash"  # Decomposing videos to frames, and hashing the frames
+
+
+async def log_output(proc: Process, timeout: Optional[float] = DEFAULT_TIMEOUT) -> Tuple[str, str]:
     return await asyncio.gather(
         log_stream(proc.stdout, timeout, "stdout"),
         log_stream(proc.stderr, timeout, "stderr")
     )
 
 
-async def log_stream(stream: StreamReader, timeout: int = DEFAULT_TIMEOUT, prefix: Optional[str] = None) -> str:
+async def log_stream(
+        stream: StreamReader,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+        prefix: Optional[str] = None,
+) -> str:
     lines = []
     if prefix is None:
         prefix = ""
@@ -44,33 +59,90 @@ async def log_stream(stream: StreamReader, timeout: int = DEFAULT_TIMEOUT, prefi
     return "\n".join(lines)
 
 
-async def run_subprocess(args, timeout: int = DEFAULT_TIMEOUT) -> str:
-    proc = await asyncio.create_subprocess_exec(
-        *args,
+async def start_process(args, **kwargs) -> Process:
+    """
+    Starts a subprocess in its own process group, so that it can be killed along with any processes it starts, such as
+    the ffmpeg processes yt-dlp runs, or ffmpeg under nice.
+    """
+    if os.name == "posix":
+        kwargs["start_new_session"] = True
+    return await asyncio.create_subprocess_exec(*args, **kwargs)
+
+
+def kill_process(proc: Process) -> None:
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass
+
+
+async def run_subprocess(args, timeout: Optional[float] = None) -> str:
+    """
+    Runs a subprocess to completion and returns its stdout. By default it has no time limit of its own, so that the task
+    worker's limit for the task running it, which can be configured per task type, is the one which applies.
+    """
+    proc = await start_process(
+        args,
         limit=1024 * 1024 * 5,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
     logger.debug("Running subprocess: %s", args)
     try:
-        stdout, stderr = await asyncio.wait_for(log_output(proc), timeout=timeout)
+        stdout, stderr = await asyncio.wait_for(log_output(proc, timeout), timeout=timeout)
         # A short timeout to close the subprocess, because the above should have ran it to completion.
         await asyncio.wait_for(proc.communicate(), timeout=CLOSE_TIMEOUT)
         return_code = proc.returncode
     except asyncio.TimeoutError:
         logger.error("Subprocess timed out, killing: %s", args)
-        try:
-            proc.kill()
-        except OSError:
-            pass
+        kill_process(proc)
         raise TaskException("Task timed out")
+    except asyncio.CancelledError:
+        logger.info("Subprocess cancelled, killing: %s", args)
+        kill_process(proc)
+        raise
     if return_code != 0:
         logger.warning("Subprocess returned exit code %s: %s", return_code, args)
         raise TaskException(f"Task returned exit code {return_code}. stderr: {stderr}")
     return stdout
 
 
+def shared_output_path(path: str) -> str:
+    # Output path for a shared run, which is not registered with any caller's operation, so is never cleaned up by one
+    os.makedirs("sandbox", exist_ok=True)
+    return f"sandbox/shared-{uuid.uuid4()}{os.path.splitext(path)[1]}"
+
+
+def remove_output_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Failed to remove output of shared run: %s", path, exc_info=e)
+
+
+def file_identity(path: str) -> Hashable:
+    # Identifies the current contents of a file without reading it, so that tasks on a changed file are not shared
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return path, stat.st_size, stat.st_mtime_ns
+
+
 class Task(ABC, Generic[T]):
+    # Which task worker pool this task runs in
+    resource_class = ResourceClass.ENCODE
+    # Label for this kind of task, in task metrics and stats
+    task_type = "task"
+    # Time limit for this kind of task, in seconds, or None for no limit. Can be overridden by task type in config.
+    timeout: Optional[float] = DEFAULT_TIMEOUT
 
     def __init__(self, *, description: str = None) -> None:
         self.description = description
@@ -79,6 +151,32 @@ class Task(ABC, Generic[T]):
     async def run(self) -> T:
         pass
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        """
+        Identifies the work this task does, so that identical tasks queued at the same time can share a single run.
+        None if this task should always run separately.
+        """
+        return None
+
+    def shared_run_task(self) -> "Task[T]":
+        """
+        Returns the task to run when identical tasks share a run. Its output files must belong to the shared run, not
+        to any one caller, so that one caller being cancelled and cleaning up its files does not fail the others.
+        """
+        return self
+
+    def copy_outputs(self, caller: "Task[T]") -> None:
+        """
+        Called after a shared run task has run, for each task which shared its run, to give it the output files.
+        """
+        pass
+
+    def remove_outputs(self) -> None:
+        """
+        Called on a shared run task once its output files have been copied to every caller.
+        """
+        pass
+
     @staticmethod
     def _format_arg(name: str, value: object) -> str:
         return f"{name}={json.dumps(value)}"
@@ -1,64 +1,549 @@
 import asyncio
+import collections
+import enum
 import logging
-from typing import List, Awaitable
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Awaitable, Dict, Generator, Optional, NamedTuple, Tuple, Deque, Hashable, Callable, \
+    TYPE_CHECKING
 
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Histogram, Counter
 
-from gif_pipeline.tasks.task import Task, T
+from gif_pipeline.startup_tracer import startup_tracer
+from gif_pipeline.tasks.task import Task, T, ResourceClass, TaskException
+
+if TYPE_CHECKING:
+    from gif_pipeline.remote_workers import RemoteWorkerServer
 
 worker_queue_length = Gauge(
     "gif_pipeline_taskworker_tasks_in_progress",
     "Number of tasks currently in progress"
 )
+worker_queue_depth = Gauge(
+    "gif_pipeline_taskworker_queue_depth",
+    "Number of tasks waiting for a task worker slot, by resource pool and priority class",
+    labelnames=["pool", "priority"]
+)
+worker_wait_time = Histogram(
+    "gif_pipeline_taskworker_wait_seconds",
+    "Time tasks spent waiting for a task worker slot, by resource pool and priority class",
+    labelnames=["pool", "priority"],
+    buckets=[0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+)
+worker_tenant_wait_time = Histogram(
+    "gif_pipeline_taskworker_tenant_wait_seconds",
+    "Time tasks spent waiting for a task worker slot, by the ID of the chat the task is for",
+    labelnames=["tenant"],
+    buckets=[0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+)
+worker_promotions = Counter(
+    "gif_pipeline_taskworker_starvation_promotions_total",
+    "Number of tasks given a slot ahead of a higher priority class, because they had waited too long",
+    labelnames=["pool", "priority"]
+)
+worker_pool_size = Gauge(
+    "gif_pipeline_taskworker_pool_size",
+    "Number of slots in each task worker resource pool",
+    labelnames=["pool"]
+)
+worker_pool_in_use = Gauge(
+    "gif_pipeline_taskworker_pool_in_use",
+    "Number of slots in each task worker resource pool which are currently running a task",
+    labelnames=["pool"]
+)
+task_wait_time = Histogram(
+    "gif_pipeline_taskworker_task_wait_seconds",
+    "Time tasks spent queued before running, by task type",
+    labelnames=["task_type"],
+    buckets=[0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+)
+task_run_time = Histogram(
+    "gif_pipeline_taskworker_task_run_seconds",
+    "Time tasks spent running, by task type",
+    labelnames=["task_type"],
+    buckets=[0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+)
+task_failures = Counter(
+    "gif_pipeline_taskworker_task_failures_total",
+    "Number of tasks which raised an exception, by task type",
+    labelnames=["task_type"]
+)
+task_timeouts = Counter(
+    "gif_pipeline_taskworker_task_timeouts_total",
+    "Number of tasks which were cancelled for running longer than their time limit, by task type",
+    labelnames=["task_type"]
+)
+task_coalesced = Counter(
+    "gif_pipeline_taskworker_coalesced_tasks_total",
+    "Number of tasks which shared the run of an identical task already queued or running, rather than running again",
+    labelnames=["task_type"]
+)
 
 logger = logging.getLogger(__name__)
 
 
+class TaskPriority(enum.IntEnum):
+    INTERACTIVE = 0  # User commands and menu presses
+    SCHEDULED_POST = 1  # Posting from channel queues at their scheduled time
+    SUBSCRIPTION = 2  # Processing new subscription items
+    BACKGROUND = 3  # Backlogs and housekeeping
+
+
+# Default number of slots for each resource pool, if not set in config
+DEFAULT_POOL_SIZES = {
+    ResourceClass.ENCODE: 3,
+    ResourceClass.PROBE: 4,
+    ResourceClass.DOWNLOAD: 3,
+    ResourceClass.HASH: 2,
+}
+
+# Priority class for tasks which are not given one explicitly. Set by long-running loops, such as the subscription
+# checker, so that every task they cause, including in shared helper methods, is queued in their class.
+current_task_priority: ContextVar[TaskPriority] = ContextVar("current_task_priority", default=TaskPriority.INTERACTIVE)
+
+
+@contextmanager
+def task_priority(priority: TaskPriority) -> Generator[None, None, None]:
+    token = current_task_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_task_priority.reset(token)
+
+
+class TaskTenant(NamedTuple):
+    name: str
+    weight: float = 1
+
+
+# The chat which tasks are being run for, by chat ID, so that slots can be shared fairly between chats
+current_task_tenant: ContextVar[TaskTenant] = ContextVar("current_task_tenant", default=TaskTenant("pipeline"))
+
+
+@contextmanager
+def task_tenant(name: str, weight: float = 1) -> Generator[None, None, None]:
+    token = current_task_tenant.set(TaskTenant(name, weight))
+    try:
+        yield
+    finally:
+        current_task_tenant.reset(token)
+
+
+class _Waiter:
+    def __init__(self, priority: TaskPriority, tenant: TaskTenant, tag: float, future: asyncio.Future) -> None:
+        self.priority = priority
+        self.tenant = tenant
+        self.tag = tag
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class SlotPool:
+    """
+    A limited number of slots for one class of resource. Slots go to higher priority classes first, and within a class
+    are shared between tenants (chats) in proportion to their weights, using start-time fair queueing, so that a burst
+    of commands in one chat does not hold up every other chat.
+    """
+    # A waiting task is treated as one priority class higher for every this many seconds it has waited, so that lower
+    # classes are not starved by a steady stream of higher priority tasks
+    STARVATION_SECONDS = 60
+
+    def __init__(self, name: str, size: int) -> None:
+        self.name = name
+        self.size = size
+        self.free_slots = size
+        # Number of tasks which have finished with a slot from this pool, for measuring throughput
+        self.completed = 0
+        self.waiters: Dict[TaskPriority, List[_Waiter]] = {priority: [] for priority in TaskPriority}
+        for priority, waiters in self.waiters.items():
+            worker_queue_depth.labels(
+                pool=name, priority=priority.name.lower()
+            ).set_function(lambda w=waiters: len(w))
+            worker_wait_time.labels(pool=name, priority=priority.name.lower())
+            worker_promotions.labels(pool=name, priority=priority.name.lower())
+        worker_pool_size.labels(pool=name).set_function(lambda: self.size)
+        worker_pool_in_use.labels(pool=name).set_function(lambda: self.size - self.free_slots)
+        # Fair queueing state: the start tag of the latest dispatched task per class, and the next tag per tenant
+        self.virtual_time: Dict[TaskPriority, float] = {priority: 0 for priority in TaskPriority}
+        self.tenant_tags: Dict[Tuple[TaskPriority, str], float] = {}
+
+    def _start_tag(self, priority: TaskPriority, tenant: TaskTenant) -> float:
+        key = (priority, tenant.name)
+        start_tag = max(self.tenant_tags.get(key, 0), self.virtual_time[priority])
+        # Each task moves its tenant's tag on by 1/weight, so a tenant with double the weight gets double the slots
+        self.tenant_tags[key] = start_tag + 1 / tenant.weight
+        return start_tag
+
+    def _effective_priority(self, waiter: _Waiter, now: float) -> int:
+        promotion = int((now - waiter.queued_at) // self.STARVATION_SECONDS)
+        return max(0, waiter.priority - promotion)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        now = time.monotonic()
+        # Within each class, the waiter with the lowest start tag is next
+        heads = [min(waiters, key=lambda w: (w.tag, w.queued_at)) for waiters in self.waiters.values() if waiters]
+        if not heads:
+            return None
+        return min(heads, key=lambda w: (self._effective_priority(w, now), w.queued_at))
+
+    async def acquire(
+            self,
+            priority: TaskPriority,
+            tenant: TaskTenant,
+            on_queued: Optional[Callable[[_Waiter], None]] = None,
+    ) -> None:
+        start_tag = self._start_tag(priority, tenant)
+        if self.free_slots > 0 and not any(self.waiters.values()):
+            self.free_slots -= 1
+            self.virtual_time[priority] = start_tag
+            worker_wait_time.labels(pool=self.name, priority=priority.name.lower()).observe(0)
+            worker_tenant_wait_time.labels(tenant=tenant.name).observe(0)
+            return
+        waiter = _Waiter(priority, tenant, start_tag, asyncio.get_event_loop().create_future())
+        self.waiters[priority].append(waiter)
+        if on_queued is not None:
+            on_queued(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # A slot was handed over just as this was cancelled, so pass it on
+                self.free_slots += 1
+                self._dispatch()
+            else:
+                self.waiters[waiter.priority].remove(waiter)
+            raise
+        wait_time = time.monotonic() - waiter.queued_at
+        worker_wait_time.labels(pool=self.name, priority=waiter.priority.name.lower()).observe(wait_time)
+        worker_tenant_wait_time.labels(tenant=tenant.name).observe(wait_time)
+
+    def promote(self, waiter: _Waiter, priority: TaskPriority) -> None:
+        """
+        Moves a queued waiter up to a higher priority class, such as when a user command joins a background task's run
+        """
+        if priority >= waiter.priority or waiter not in self.waiters[waiter.priority]:
+            return
+        self.waiters[waiter.priority].remove(waiter)
+        waiter.priority = priority
+        waiter.tag = self._start_tag(priority, waiter.tenant)
+        self.waiters[priority].append(waiter)
+
+    def release(self) -> None:
+        self.completed += 1
+        self.free_slots += 1
+        self._dispatch()
+
+    def queue_length(self) -> int:
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+    async def run(
+            self,
+            awaitable: Awaitable[T],
+            priority: TaskPriority,
+            tenant: TaskTenant,
+            on_queued: Optional[Callable[[_Waiter], None]] = None,
+    ) -> T:
+        try:
+            await self.acquire(priority, tenant, on_queued)
+        except asyncio.CancelledError:
+            # The awaitable will never be run, so close it rather than leaving it unawaited
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        try:
+            return await awaitable
+        finally:
+            self.release()
+
+    def _dispatch(self) -> None:
+        while self.free_slots > 0:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            higher_waiting = any(self.waiters[p] for p in TaskPriority if p < waiter.priority)
+            if higher_waiting:
+                worker_promotions.labels(pool=self.name, priority=waiter.priority.name.lower()).inc()
+            self.waiters[waiter.priority].remove(waiter)
+            self.virtual_time[waiter.priority] = waiter.tag
+            self.free_slots -= 1
+            waiter.future.set_result(None)
+
+    def resize(self, size: int) -> None:
+        # Shrinking a pool can leave it with negative free slots, until enough running tasks have finished
+        self.free_slots += size - self.size
+        self.size = size
+        self._dispatch()
+
+
 class Bottleneck:
+    """
+    Limits how many of some kind of work, outside of task worker pools, run at once. Backed by a slot pool, so that
+    its size can be changed while running.
+    """
 
-    def __init__(self, num_concurrent: int):
-        self.num_concurrent = num_concurrent
-        self.semaphore = asyncio.Semaphore(num_concurrent)
+    def __init__(self, num_concurrent: int, name: str = "bottleneck"):
+        self.pool = SlotPool(name, num_concurrent)
+
+    @property
+    def num_concurrent(self) -> int:
+        return self.pool.size
 
     async def await_run(self, awaitable: Awaitable[T]) -> T:
-        async with self.semaphore:
-            return await awaitable
+        return await self.pool.run(awaitable, current_task_priority.get(), current_task_tenant.get())
+
+
+class TaskRecord(NamedTuple):
+    wait_seconds: float
+    run_seconds: float
+    failed: bool
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
 
 
-class TaskWorker(Bottleneck):
+class TaskStats:
+    """
+    Rolling record of the most recent tasks of each type, for summarising how long tasks are queueing and running.
+    """
+    RECORDS_PER_TYPE = 200
 
-    def __init__(self, num_concurrent: int):
-        super().__init__(num_concurrent)
-        self.current_tasks: List[T] = []
-        self.task_watch_lock = asyncio.Lock()
+    def __init__(self) -> None:
+        self.records: Dict[str, Deque[TaskRecord]] = {}
+        self.running: Dict[str, int] = collections.Counter()
 
-    def _log_tasks(self) -> None:
-        task_lines = ["\n" + repr(task) for task in self.current_tasks]
-        logger.debug("TaskWorker current tasks (%s):\n%s", len(task_lines), "".join(task_lines))
+    def start(self, task_type: str) -> None:
+        self.running[task_type] += 1
 
-    async def _pre_task(self, task: Task[T]) -> None:
-        async with self.task_watch_lock:
-            self.current_tasks.append(task)
-            self._log_tasks()
-            logger.debug("Starting task: %s", task)
+    def finish(self, task_type: str, wait_seconds: float, run_seconds: float, failed: bool) -> None:
+        self.running[task_type] -= 1
+        if task_type not in self.records:
+            self.records[task_type] = collections.deque(maxlen=self.RECORDS_PER_TYPE)
+        self.records[task_type].append(TaskRecord(wait_seconds, run_seconds, failed))
 
-    async def _post_task(self, task: Task[T]) -> None:
-        async with self.task_watch_lock:
-            self.current_tasks.remove(task)
-            self._log_tasks()
-            logger.debug("Finished task: %s", task)
+    def running_summary(self) -> str:
+        return ", ".join(f"{count} {task_type}" for task_type, count in sorted(self.running.items()) if count)
 
-    async def _run_task(self, task: Task[T]) -> T:
-        await self._pre_task(task)
+    def table(self) -> str:
+        lines = []
+        for task_type, records in sorted(self.records.items()):
+            waits = [record.wait_seconds for record in records]
+            runs = [record.run_seconds for record in records]
+            failures = sum(1 for record in records if record.failed)
+            lines.append(
+                f"{task_type}: {len(records)} recent, {failures} failed, {self.running[task_type]} running. "
+                f"Wait p50 {_percentile(waits, 0.5):.1f}s, p95 {_percentile(waits, 0.95):.1f}s. "
+                f"Run p50 {_percentile(runs, 0.5):.1f}s, p95 {_percentile(runs, 0.95):.1f}s."
+            )
+        return "\n".join(lines)
+
+
+class _InFlightTask:
+    def __init__(self, task: Task, priority: TaskPriority) -> None:
+        # The task which is run, writing to output files of its own, which are copied to each caller
+        self.task = task.shared_run_task()
+        self.run: Optional[asyncio.Task] = None
+        # Highest priority class of the callers, and the run's place in its pool's queue, while it is waiting for a slot
+        self.priority = priority
+        self.queued: Optional[Tuple[SlotPool, _Waiter]] = None
+        # Number of callers awaiting the run. It is only cancelled once every one of them has been cancelled.
+        self.waiting = 0
+        # Identical tasks sharing this run, which are given its output files once it completes
+        self.callers: List[Task] = []
+        # Errors copying output files to callers, by caller id
+        self.copy_errors: Dict[int, Exception] = {}
+
+    def raise_priority(self, priority: TaskPriority) -> None:
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        if self.queued is not None:
+            pool, waiter = self.queued
+            pool.promote(waiter, priority)
+
+
+class TaskWorker:
+    """
+    Runs tasks in separate pools of slots, by the resource class each task declares, so that cheap probes and network
+    bound downloads do not queue behind long encodes.
+    """
+
+    def __init__(self, pool_sizes: Optional[Dict[ResourceClass, int]] = None):
+        self.stats = TaskStats()
+        self.in_flight: Dict[Hashable, _InFlightTask] = {}
+        # Time limits by task type, in seconds, overriding the task's own default
+        self.task_timeouts: Dict[str, Optional[float]] = {}
+        # If set, tasks are sent to remote worker nodes when they have more free slots than the local pool
+        self.remote: Optional["RemoteWorkerServer"] = None
+        pool_sizes = {**DEFAULT_POOL_SIZES, **(pool_sizes or {})}
+        self.pools: Dict[ResourceClass, SlotPool] = {
+            resource_class: SlotPool(resource_class.value, pool_sizes[resource_class])
+            for resource_class in ResourceClass
+        }
+
+    def resize_pools(self, pool_sizes: Dict[ResourceClass, int]) -> None:
+        pool_sizes = {**DEFAULT_POOL_SIZES, **pool_sizes}
+        for resource_class, pool in self.pools.items():
+            if pool.size != pool_sizes[resource_class]:
+                logger.info("Resizing %s task pool from %s to %s", pool.name, pool.size, pool_sizes[resource_class])
+                pool.resize(pool_sizes[resource_class])
+
+    async def await_run(
+            self,
+            awaitable: Awaitable[T],
+            priority: Optional[TaskPriority] = None,
+            tenant: Optional[TaskTenant] = None,
+            resource_class: ResourceClass = ResourceClass.ENCODE,
+            on_queued: Optional[Callable[[_Waiter], None]] = None,
+    ) -> T:
+        if priority is None:
+            priority = current_task_priority.get()
+        if tenant is None:
+            tenant = current_task_tenant.get()
+        return await self.pools[resource_class].run(awaitable, priority, tenant, on_queued)
+
+    async def _run_task(
+            self,
+            task: Task[T],
+            queued_at: float,
+            priority: TaskPriority,
+            run: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> T:
+        task_name = task.__class__.__name__
+        task_type = task.task_type
+        startup_tracer.record(
+            f"Queued {task_name}", "task_queue", f"{task.resource_class.value} queue", queued_at, startup_tracer.now(),
+            {"priority": priority.name}
+        )
+        start_time = time.monotonic()
+        # queued_at is from the startup tracer clock, which counts in microseconds
+        wait_seconds = max(0.0, (startup_tracer.now() - queued_at) / 1_000_000)
+        task_wait_time.labels(task_type=task_type).observe(wait_seconds)
+        self.stats.start(task_type)
+        logger.debug("Starting task: %s", task)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("TaskWorker running tasks: %s", self.stats.running_summary())
+        timeout = self.task_timeouts.get(task_type, task.timeout)
+        failed = True
         try:
-            resp = await task.run()
+            # The task is only described for the trace while the tracer is recording, as most tasks run after startup
+            span_args = {"task": repr(task)} if startup_tracer.enabled else None
+            with startup_tracer.span(task_name, "task", f"{task.resource_class.value} pool", args=span_args):
+                resp = await asyncio.wait_for((run or task.run)(), timeout)
+            failed = False
             return resp
+        except asyncio.TimeoutError:
+            task_timeouts.labels(task_type=task_type).inc()
+            logger.error("Task ran for longer than its %s second limit, cancelled it: %s", timeout, task)
+            raise TaskException(f"Task took longer than its time limit of {timeout:.0f} seconds")
         finally:
-            await self._post_task(task)
+            run_seconds = time.monotonic() - start_time
+            task_run_time.labels(task_type=task_type).observe(run_seconds)
+            if failed:
+                task_failures.labels(task_type=task_type).inc()
+            self.stats.finish(task_type, wait_seconds, run_seconds, failed)
+            logger.debug("Finished task in %.2f seconds: %s", run_seconds, task)
+
+    async def await_task(
+            self,
+            task: Task[T],
+            priority: Optional[TaskPriority] = None,
+            tenant: Optional[TaskTenant] = None,
+    ) -> T:
+        key = task.coalesce_key()
+        if key is None:
+            return await self._await_task(task, priority, tenant)
+        if priority is None:
+            priority = current_task_priority.get()
+        in_flight = self.in_flight.get(key)
+        if in_flight is None:
+            in_flight = _InFlightTask(task, priority)
+            # The run is a separate asyncio task, so that it carries on for the other callers if the first is cancelled
+            in_flight.run = asyncio.get_event_loop().create_task(self._run_shared(key, in_flight, tenant))
+            self.in_flight[key] = in_flight
+        else:
+            task_coalesced.labels(task_type=task.task_type).inc()
+            logger.debug("Sharing the run of an identical task: %s", task)
+            # The run should not wait in a lower priority class than any caller waiting on it
+            in_flight.raise_priority(priority)
+        in_flight.callers.append(task)
+        in_flight.waiting += 1
+        try:
+            result = await asyncio.shield(in_flight.run)
+        except asyncio.CancelledError:
+            in_flight.waiting -= 1
+            if task in in_flight.callers:
+                in_flight.callers.remove(task)
+            if in_flight.waiting == 0:
+                in_flight.run.cancel()
+            raise
+        copy_error = in_flight.copy_errors.get(id(task))
+        if copy_error is not None:
+            raise copy_error
+        return result
+
+    async def _run_shared(
+            self,
+            key: Hashable,
+            in_flight: _InFlightTask,
+            tenant: Optional[TaskTenant],
+    ) -> T:
+
+        def on_queued(waiter: _Waiter) -> None:
+            in_flight.queued = (self.pools[in_flight.task.resource_class], waiter)
+
+        try:
+            result = await self._await_task(in_flight.task, in_flight.priority, tenant, on_queued)
+            # Outputs are copied before any caller resumes, and the run's own files are removed after
+            for caller in in_flight.callers:
+                try:
+                    in_flight.task.copy_outputs(caller)
+                except Exception as e:
+                    in_flight.copy_errors[id(caller)] = e
+            return result
+        finally:
+            del self.in_flight[key]
+            in_flight.task.remove_outputs()
+
+    def set_task_timeouts(self, task_timeouts: Dict[str, Optional[float]]) -> None:
+        self.task_timeouts = dict(task_timeouts)
 
-    async def await_task(self, task: Task[T]) -> T:
+    async def _await_task(
+            self,
+            task: Task[T],
+            priority: Optional[TaskPriority] = None,
+            tenant: Optional[TaskTenant] = None,
+            on_queued: Optional[Callable[[_Waiter], None]] = None,
+    ) -> T:
+        if priority is None:
+            priority = current_task_priority.get()
+        remote = self.remote
+        if (
+                remote is not None
+                and remote.can_run(task)
+                and remote.free_slots(task.resource_class) > self.pools[task.resource_class].free_slots
+        ):
+            queued_at = startup_tracer.now()
+            job = await remote.assign(task)
+            # If no node acknowledged the task, it is run locally
+            if job is not None:
+                with worker_queue_length.track_inprogress():
+                    return await self._run_task(task, queued_at, priority, lambda: remote.await_result(job))
         with worker_queue_length.track_inprogress():
-            return await self.await_run(self._run_task(task))
+            return await self.await_run(
+                self._run_task(task, startup_tracer.now(), priority),
+                priority,
+                tenant,
+                task.resource_class,
+                on_queued,
+            )
 
-    async def await_tasks(self, tasks: List[Task]):
-        return await asyncio.gather(*[self.await_task(task) for task in tasks])
+    async def await_tasks(
+            self,
+            tasks: List[Task],
+            priority: Optional[TaskPriority] = None,
+            tenant: Optional[TaskTenant] = None,
+    ):
+        return await asyncio.gather(*[self.await_task(task, priority, tenant) for task in tasks])
@@ -1,11 +1,14 @@
 import re
+from typing import Optional, Hashable
 
-from gif_pipeline.tasks.task import Task, run_subprocess, TaskException
+from gif_pipeline.tasks.task import Task, run_subprocess, TaskException, ResourceClass
 from gif_pipeline.tasks.youtube_dl_task import yt_dl_pkg
 
 yt_dl_github_repo = "https://github.com/yt-dlp/yt-dlp/"
 
 class UpdateYoutubeDLTask(Task[str]):
+    resource_class = ResourceClass.DOWNLOAD
+    task_type = "yt-dlp_update"
 
     async def run(self) -> str:
         git_url = f"git+{yt_dl_github_repo.rstrip('/')}.git"
@@ -28,5 +31,9 @@ class UpdateYoutubeDLTask(Task[str]):
             return f"Already up to date. Version: {yt_up_to_date.group(1)}"
         raise TaskException("Unknown response from pip")
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        # Concurrent pip installs of the same package would conflict, so they are always shared
+        return "yt-dlp_update",
+
     def _formatted_args(self) -> list[str]:
         return []
@@ -1,12 +1,14 @@
 import glob
-from typing import Optional
+from typing import Optional, Hashable
 
-from gif_pipeline.tasks.task import Task, run_subprocess
+from gif_pipeline.tasks.task import Task, run_subprocess, ResourceClass
 
 yt_dl_pkg = "yt-dlp"
 
 
 class YoutubeDLTask(Task[str]):
+    resource_class = ResourceClass.DOWNLOAD
+    task_type = "yt-dlp"
 
     def __init__(self, link: str, output_path: str, description: str = None) -> None:
         super().__init__(description=description)
@@ -27,6 +29,8 @@ class YoutubeDLTask(Task[str]):
 
 
 class YoutubeDLDumpJsonTask(Task[str]):
+    resource_class = ResourceClass.DOWNLOAD
+    task_type = "yt-dlp_json"
 
     def __init__(
             self,
@@ -50,6 +54,9 @@ class YoutubeDLDumpJsonTask(Task[str]):
         resp = await run_subprocess(args)
         return resp
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        return "yt-dlp_json", self.link, self.start, self.end
+
     def _formatted_args(self) -> list[str]:
         return self._format_args({"link": self.link}) + self._format_non_null_args({
             "start": self.start,
@@ -1,6 +1,6 @@
 import logging
 from asyncio import Future
-from typing import Callable, Coroutine, Union, Generator, Optional, TypeVar, Any, List
+from typing import Callable, Coroutine, Union, Generator, Optional, TypeVar, Any, List, Set
 
 import telethon
 from telethon import events, Button
@@ -46,7 +46,8 @@ def message_data_from_telegram(msg: telethon.tl.custom.message.Message, schedule
         msg.reply_to_msg_id,
         sender_id,
         scheduled,
-        forward_link
+        forward_link,
+        msg.edit_date,
     )
 
 
@@ -164,10 +165,24 @@ class TelegramClient:
             self._save_message(msg)
             yield message_data_from_telegram(msg, scheduled=True)
 
+    async def list_existing_message_ids(self, chat_id: int, message_ids: List[int]) -> Set[int]:
+        messages = await self.client.get_messages(chat_id, ids=message_ids)
+        existing_ids = set()
+        for msg in messages:
+            if msg is None:
+                continue
+            self._save_message(msg)
+            existing_ids.add(msg.id)
+        return existing_ids
+
     async def download_media(self, chat_id: int, message_id: int, path: str) -> Optional[str]:
         msg = self._get_message(chat_id, message_id)
         if msg is None:
-            raise ValueError("Could not find message")
+            # Messages loaded from a warm start snapshot have not been listed from telegram, so fetch them now
+            msg = await self.client.get_messages(chat_id, ids=message_id)
+            if msg is None:
+                raise ValueError("Could not find message")
+            self._save_message(msg)
         return await self.client.download_media(message=msg, file=path)
 
     def add_message_handler(self, function: Callable, chat_ids: List[int]) -> None:
@@ -1,21 +1,132 @@
 import asyncio
-from typing import TypeVar, List, Awaitable
+from typing import TypeVar, List, Awaitable, AsyncIterable, AsyncIterator, Iterable, Tuple, Generic, Set, Optional
 
+from prometheus_client import Gauge, Counter
 from tqdm import tqdm
 
 T = TypeVar("T")
+K = TypeVar("K")
 
+stream_gather_in_flight = Gauge(
+    "gif_pipeline_stream_gather_in_flight",
+    "Number of awaitables currently running in a streaming gather",
+    labelnames=["name"]
+)
+stream_gather_queued = Counter(
+    "gif_pipeline_stream_gather_queued_total",
+    "Number of awaitables which have been started by a streaming gather",
+    labelnames=["name"]
+)
+stream_gather_completed = Counter(
+    "gif_pipeline_stream_gather_completed_total",
+    "Number of awaitables which have completed in a streaming gather",
+    labelnames=["name"]
+)
+stream_gather_groups_completed = Counter(
+    "gif_pipeline_stream_gather_groups_completed_total",
+    "Number of groups whose awaitables have all completed in a streaming gather",
+    labelnames=["name"]
+)
 
-async def tqdm_gather(awaitables: List[Awaitable[T]], **kwargs) -> List[T]:
-    async def wrap_awaitable(number: int, awaitable: Awaitable[T]):
-        return number, await awaitable
 
-    numbered_awaitables = [wrap_awaitable(idx, awaitables[idx]) for idx in range(len(awaitables))]
+class StreamGroup(Generic[K, T]):
+    def __init__(self, key: K, size: int, awaitables: Iterable[Awaitable[T]]) -> None:
+        self.key = key
+        self.size = size
+        self.awaitables = awaitables
 
-    numbered_results = [
-        await f for f in tqdm(asyncio.as_completed(numbered_awaitables), total=len(awaitables), **kwargs)
-    ]
 
-    results = [result_tuple[1] for result_tuple in sorted(numbered_results)]
+class _GroupState:
+    def __init__(self, key: K) -> None:
+        self.key = key
+        self.results: List[Optional[T]] = []
+        self.remaining = 0
+        self.listed = False
 
-    return results
+
+async def stream_gather(
+        groups: AsyncIterable[StreamGroup[K, T]],
+        limit: int,
+        desc: str,
+) -> AsyncIterator[Tuple[K, List[T]]]:
+    """
+    Runs groups of awaitables with at most `limit` in flight, yielding each group's results, in their original order,
+    as soon as every awaitable in that group has finished.
+    Groups and awaitables are only pulled from their iterators when there is space for them to run, so a lazy iterator
+    means coroutine objects are only created once they are about to be awaited.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(limit)
+    finished: asyncio.Queue = asyncio.Queue()
+    tasks: Set[asyncio.Task] = set()
+    producer_done = object()
+    in_flight = stream_gather_in_flight.labels(name=desc)
+    progress = tqdm(desc=desc, total=0)
+    open_groups = 0
+
+    async def run_item(group: _GroupState, index: int, awaitable: Awaitable[T]) -> None:
+        try:
+            with in_flight.track_inprogress():
+                result = await awaitable
+        finally:
+            semaphore.release()
+        group.results[index] = result
+        group.remaining -= 1
+        progress.update(1)
+        stream_gather_completed.labels(name=desc).inc()
+        if group.listed and group.remaining == 0:
+            finished.put_nowait(group)
+
+    def on_item_done(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            finished.put_nowait(task.exception())
+
+    async def produce() -> None:
+        nonlocal open_groups
+        try:
+            async for stream_group in groups:
+                group = _GroupState(stream_group.key)
+                open_groups += 1
+                progress.total += stream_group.size
+                progress.refresh()
+                iterator = iter(stream_group.awaitables)
+                while True:
+                    await semaphore.acquire()
+                    try:
+                        awaitable = next(iterator)
+                    except StopIteration:
+                        semaphore.release()
+                        break
+                    group.results.append(None)
+                    group.remaining += 1
+                    stream_gather_queued.labels(name=desc).inc()
+                    task = loop.create_task(run_item(group, len(group.results) - 1, awaitable))
+                    tasks.add(task)
+                    task.add_done_callback(on_item_done)
+                group.listed = True
+                if group.remaining == 0:
+                    finished.put_nowait(group)
+        except Exception as e:
+            finished.put_nowait(e)
+            return
+        finished.put_nowait(producer_done)
+
+    producer = loop.create_task(produce())
+    producing = True
+    try:
+        while producing or open_groups > 0:
+            item = await finished.get()
+            if item is producer_done:
+                producing = False
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            open_groups -= 1
+            stream_gather_groups_completed.labels(name=desc).inc()
+            yield item.key, item.results
+    finally:
+        progress.close()
+        producer.cancel()
+        for task in list(tasks):
+            task.cancel()
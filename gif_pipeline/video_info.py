@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+from prometheus_client import Counter
+
+from gif_pipeline.media_backend import media_backend
+
+if TYPE_CHECKING:
+    from gif_pipeline.database import Database
+    from gif_pipeline.tasks.task_worker import TaskWorker
+
+
+logger = logging.getLogger(__name__)
+
+video_info_lookups = Counter(
+    "gif_pipeline_video_info_lookups_total",
+    "Number of video metadata lookups, by where the metadata was found. Lookups which needed a probe are misses",
+    labelnames=["source"]
+)
+for _source in ["memory", "in_flight", "database", "probe"]:
+    video_info_lookups.labels(source=_source)
+
+# Files here are temporary, so their metadata is only cached in memory
+SANDBOX_DIR = "sandbox"
+CacheKey = Tuple[str, int, int]
+
+
+def _parse_fps(rate: Optional[str]) -> Optional[float]:
+    # ffprobe gives frame rates as fractions, such as "30000/1001"
+    if not rate:
+        return None
+    num, _, den = rate.partition("/")
+    try:
+        if den and float(den) == 0:
+            return None
+        return float(num) / float(den or 1)
+    except ValueError:
+        return None
+
+
+def _parse_optional(value: Optional[str], cast: type) -> Optional:
+    if value is None:
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        return None
+
+
+class VideoInfo:
+    """
+    Metadata about a video file, as given by ffprobe.
+    """
+
+    def __init__(
+            self,
+            duration: Optional[float],
+            width: int,
+            height: int,
+            video_codec: Optional[str],
+            audio_codec: Optional[str],
+            bit_rate: Optional[int],
+            fps: Optional[float],
+            has_audio: bool,
+    ) -> None:
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.bit_rate = bit_rate
+        self.fps = fps
+        self.has_audio = has_audio
+
+    @property
+    def resolution(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    @classmethod
+    def from_ffprobe_json(cls, probe: Dict) -> "VideoInfo":
+        probe_format = probe.get("format", {})
+        streams = probe.get("streams", [])
+        video_stream = next((s for s in streams if s.get("codec_type") == "video"), {})
+        audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        return cls(
+            _parse_optional(probe_format.get("duration"), float),
+            video_stream.get("width", 0),
+            video_stream.get("height", 0),
+            video_stream.get("codec_name"),
+            audio_stream.get("codec_name") if audio_stream else None,
+            _parse_optional(probe_format.get("bit_rate"), int),
+            _parse_fps(video_stream.get("avg_frame_rate")) or _parse_fps(video_stream.get("r_frame_rate")),
+            audio_stream is not None,
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"VideoInfo(duration={self.duration}, resolution={self.width}x{self.height}, "
+            f"video_codec={self.video_codec}, audio_codec={self.audio_codec}, bit_rate={self.bit_rate}, "
+            f"fps={self.fps}, has_audio={self.has_audio})"
+        )
+
+
+class VideoInfoStore:
+    """
+    Single place to get video metadata from, so that each file is only probed once. Results are cached in memory, keyed
+    by path, size, and modification time, and persisted to the database for files outside the sandbox.
+    Concurrent lookups of the same file share one probe.
+    """
+    MAX_CACHE_SIZE = 5000
+
+    def __init__(self, database: Optional[Database], worker: TaskWorker) -> None:
+        # Without a database, such as in scripts, metadata is only cached in memory
+        self.database = database
+        self.worker = worker
+        self._cache: OrderedDict[CacheKey, VideoInfo] = OrderedDict()
+        self._in_flight: Dict[CacheKey, asyncio.Future] = {}
+
+    @staticmethod
+    def _is_persistent(path: str) -> bool:
+        return os.path.normpath(path).split(os.sep)[0] != SANDBOX_DIR
+
+    async def get(self, path: str) -> VideoInfo:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        info = self._cache.get(key)
+        if info is not None:
+            video_info_lookups.labels(source="memory").inc()
+            self._cache.move_to_end(key)
+            return info
+        future = self._in_flight.get(key)
+        if future is not None:
+            video_info_lookups.labels(source="in_flight").inc()
+            # Waiting does not cancel the shared future, and only raises CancelledError if this lookup is cancelled
+            await asyncio.wait({future})
+            if future.cancelled():
+                # The lookup being shared was cancelled, rather than this one, so look it up again
+                return await self.get(path)
+            return future.result()
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            info = await self._load(key)
+        except BaseException as e:
+            # Includes this lookup being cancelled, which must also wake the lookups waiting on it, or they would hang
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Mark the exception as retrieved, in case nothing else was waiting for this probe
+                future.exception()
+            raise
+        else:
+            future.set_result(info)
+        finally:
+            self._in_flight.pop(key, None)
+        self._cache[key] = info
+        while len(self._cache) > self.MAX_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return info
+
+    async def _load(self, key: CacheKey) -> VideoInfo:
+        path, file_size, mtime_ns = key
+        persistent = self.database is not None and self._is_persistent(path)
+        if persistent:
+            info = self.database.get_video_info(path, file_size, mtime_ns)
+            if info is not None:
+                video_info_lookups.labels(source="database").inc()
+                return info
+        video_info_lookups.labels(source="probe").inc()
+        info = VideoInfo.from_ffprobe_json(await media_backend.probe(self.worker, path))
+        logger.debug("Probed video info for %s: %s", path, info)
+        if persistent:
+            self.database.save_video_info(path, file_size, mtime_ns, info)
+        return info
+
+    async def prefetch(self, path: str) -> None:
+        try:
+            await self.get(path)
+        except Exception as e:
+            logger.warning("Failed to get video info for %s", path, exc_info=e)
+
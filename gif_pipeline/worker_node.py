@@ -0,0 +1,240 @@
+"""
+A remote worker node, which pulls encode and hash tasks from a pipeline's remote worker server, runs them here, and
+sends back the outputs. Run it with:
+python -m gif_pipeline.worker_node --url http://pipeline-host:7190 --token <token>
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+
+from gif_pipeline.tasks.cpu_budget import cpu_budget
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.hash_dir_task import HashDirectoryTask
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import task_priority, TaskPriority
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerNode:
+    HEARTBEAT_SECONDS = 15
+    PROGRESS_SECONDS = 2
+    RETRY_SECONDS = 5
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(
+            self,
+            url: str,
+            token: str,
+            name: str,
+            slots: Dict[ResourceClass, int],
+            work_dir: str,
+            thread_budget: Optional[int] = None,
+    ) -> None:
+        self.url = url.rstrip("/")
+        self.token = token
+        self.name = name
+        self.slots = slots
+        self.free_slots = dict(slots)
+        self.work_dir = work_dir
+        cpu_budget.configure(thread_budget, self.running_count)
+        self.hash_executor = ProcessPoolExecutor()
+        self._slot_freed = asyncio.Event()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def running_count(self) -> int:
+        return sum(self.slots[resource_class] - free for resource_class, free in self.free_slots.items())
+
+    async def run(self) -> None:
+        os.makedirs(self.work_dir, exist_ok=True)
+        headers = {"Authorization": f"Bearer {self.token}"}
+        async with aiohttp.ClientSession(headers=headers) as session:
+            self.session = session
+            heartbeat = asyncio.get_event_loop().create_task(self._heartbeat())
+            try:
+                await self._poll_loop()
+            finally:
+                heartbeat.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_SECONDS)
+            try:
+                async with self.session.post(f"{self.url}/nodes/{self.name}/heartbeat") as resp:
+                    resp.raise_for_status()
+            except aiohttp.ClientError as e:
+                logger.warning("Heartbeat to pipeline failed: %s", e)
+
+    async def _poll_loop(self) -> None:
+        logger.info("Worker node %s polling %s with slots: %s", self.name, self.url, self.slots)
+        while True:
+            if not any(slots > 0 for slots in self.free_slots.values()):
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            try:
+                job = await self._poll()
+            except aiohttp.ClientError as e:
+                logger.warning("Polling pipeline failed, retrying in %s seconds: %s", self.RETRY_SECONDS, e)
+                await asyncio.sleep(self.RETRY_SECONDS)
+                continue
+            if job is None:
+                continue
+            resource_class = ResourceClass.HASH if job["spec"]["kind"] == "hash" else ResourceClass.ENCODE
+            self.free_slots[resource_class] -= 1
+            asyncio.get_event_loop().create_task(self._run_job(job, resource_class))
+
+    async def _poll(self) -> Optional[Dict[str, Any]]:
+        free_slots = {resource_class.value: slots for resource_class, slots in self.free_slots.items()}
+        # The server holds polls open for a while, waiting for a task
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with self.session.post(
+                f"{self.url}/nodes/{self.name}/poll", json={"free_slots": free_slots}, timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            if resp.status == 204:
+                return None
+            return await resp.json()
+
+    async def _run_job(self, job: Dict[str, Any], resource_class: ResourceClass) -> None:
+        job_id = job["job_id"]
+        job_dir = os.path.join(self.work_dir, str(job_id))
+        os.makedirs(job_dir, exist_ok=True)
+        try:
+            logger.info("Running job %s: %s", job_id, job["spec"])
+            await self._acknowledge(job_id)
+            input_paths = await self._download_inputs(job, job_dir)
+            if job["spec"]["kind"] == "hash":
+                hash_task = HashDirectoryTask(job_dir, self.hash_executor)
+                result = list(await hash_task.run())
+            else:
+                result = await self._run_ffmpeg(job, job_dir, input_paths)
+            await self._complete(job_id, {"result": result})
+            logger.info("Completed job %s", job_id)
+        except JobGone:
+            logger.info("Job %s is no longer wanted by the pipeline, stopped it", job_id)
+        except Exception as e:
+            logger.error("Job %s failed", job_id, exc_info=e)
+            try:
+                await self._complete(job_id, {"error": str(e) or repr(e)})
+            except (aiohttp.ClientError, JobGone) as complete_e:
+                logger.warning("Could not report failure of job %s: %s", job_id, complete_e)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            self.free_slots[resource_class] += 1
+            self._slot_freed.set()
+
+    async def _download_inputs(self, job: Dict[str, Any], job_dir: str) -> List[str]:
+        paths = []
+        for index, ext in enumerate(job["input_exts"]):
+            path = os.path.join(job_dir, f"input_{index}{ext}")
+            async with self.session.get(f"{self.url}/jobs/{job['job_id']}/inputs/{index}") as resp:
+                check_response(resp)
+                with open(path, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                        f.write(chunk)
+            paths.append(path)
+        return paths
+
+    async def _run_ffmpeg(self, job: Dict[str, Any], job_dir: str, input_paths: List[str]) -> List[str]:
+        spec = job["spec"]
+        output_paths = [
+            os.path.join(job_dir, f"output_{index}{ext}") for index, ext in enumerate(job["output_exts"])
+        ]
+        inputs = {
+            (input_paths[i["file"]] if "file" in i else i["arg"]): i["options"] for i in spec["inputs"]
+        }
+        outputs = {
+            (output_paths[o["file"]] if "file" in o else o["arg"]): o["options"] for o in spec["outputs"]
+        }
+        task = FfmpegTask(
+            purpose=spec["purpose"],
+            global_options=spec["global_options"],
+            inputs=inputs,
+            outputs=outputs,
+            duration=spec["duration"],
+            stall_timeout=spec["stall_timeout"],
+        )
+        with task_priority(TaskPriority(spec.get("priority", TaskPriority.INTERACTIVE.value))):
+            run = asyncio.get_event_loop().create_task(task.run())
+        reporter = asyncio.get_event_loop().create_task(self._report_progress(job["job_id"], task, run))
+        try:
+            output, error = await run
+        except asyncio.CancelledError:
+            # Cancelled by the progress reporter, because the pipeline no longer wants the job
+            raise JobGone()
+        finally:
+            reporter.cancel()
+        for index, path in enumerate(output_paths):
+            with open(path, "rb") as f:
+                async with self.session.put(f"{self.url}/jobs/{job['job_id']}/outputs/{index}", data=f) as resp:
+                    check_response(resp)
+        return [output, error]
+
+    async def _report_progress(self, job_id: int, task: FfmpegTask, run: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.PROGRESS_SECONDS)
+            progress = task.progress
+            values = {
+                "frame": str(progress.frame),
+                "out_time_us": str(int(progress.out_time * 1_000_000)),
+                "speed": f"{progress.speed}x" if progress.speed is not None else "N/A",
+            }
+            try:
+                async with self.session.post(f"{self.url}/jobs/{job_id}/progress", json=values) as resp:
+                    check_response(resp)
+            except JobGone:
+                run.cancel()
+                return
+            except aiohttp.ClientError as e:
+                logger.warning("Progress report for job %s failed: %s", job_id, e)
+
+    async def _acknowledge(self, job_id: int) -> None:
+        # The pipeline gives the job to another node, or runs it itself, if this is not received soon enough
+        async with self.session.post(f"{self.url}/jobs/{job_id}/ack") as resp:
+            check_response(resp)
+
+    async def _complete(self, job_id: int, body: Dict[str, Any]) -> None:
+        async with self.session.post(f"{self.url}/jobs/{job_id}/complete", json=body) as resp:
+            check_response(resp)
+
+
+class JobGone(Exception):
+    pass
+
+
+def check_response(resp: aiohttp.ClientResponse) -> None:
+    if resp.status == 410:
+        raise JobGone()
+    resp.raise_for_status()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run encode and hash tasks for a gif pipeline")
+    parser.add_argument("--url", required=True, help="URL of the pipeline's remote worker server")
+    parser.add_argument("--token", default=os.environ.get("GIF_PIPELINE_WORKER_TOKEN"), help="Shared token")
+    parser.add_argument("--name", default=socket.gethostname(), help="Name of this node, unique per pipeline")
+    parser.add_argument("--encode-slots", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--hash-slots", type=int, default=1)
+    parser.add_argument("--work-dir", default="worker_node_files")
+    parser.add_argument(
+        "--thread-budget", type=int, default=None, help="Threads to share between running tasks, default: unlimited"
+    )
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("A token must be given with --token, or GIF_PIPELINE_WORKER_TOKEN")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)-5.5s] %(name)s: %(message)s")
+    slots = {ResourceClass.ENCODE: args.encode_slots, ResourceClass.HASH: args.hash_slots}
+    node = WorkerNode(args.url, args.token, args.name, slots, args.work_dir, args.thread_budget)
+    asyncio.run(node.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import asyncio
-import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os
@@ -61,10 +60,8 @@ def setup_loop() -> None:
 if __name__ == "__main__":
     setup_loop()
     setup_logging()
-    with open("config.json", "r") as c:
-        CONF = json.load(c)
     start_http_server(PROM_PORT)
-    pipeline_conf = PipelineConfig(CONF)
+    pipeline_conf = PipelineConfig.from_file("config.json")
     pipeline = pipeline_conf.initialise_pipeline()
     pipeline.initialise_helpers()
     pipeline.watch_workshop()
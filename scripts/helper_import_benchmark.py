@@ -0,0 +1,69 @@
+"""
+Compares import time and memory use of the pipeline module, with helpers loaded lazily (as the pipeline now does at
+startup) against importing every lazily loaded helper module up front (as the pipeline used to).
+Each measurement is taken in a fresh python process, so that earlier imports do not skew later ones.
+"""
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+LAZY_HELPER_MODULES = [
+    "gif_pipeline.helpers.scene_split_helper",
+    "gif_pipeline.helpers.chart_helper",
+    "gif_pipeline.helpers.find_helper",
+    "gif_pipeline.helpers.qr_helper",
+    "gif_pipeline.helpers.frigate_helper",
+    "tweepy",
+]
+REPEATS = 3
+
+MEASURE_SCRIPT = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+for module_name in sys.argv[1:]:
+    importlib.import_module(module_name)
+duration = time.perf_counter() - start
+max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"seconds": duration, "max_rss_kb": max_rss_kb}))
+"""
+
+
+def measure(modules: List[str]) -> Dict[str, float]:
+    results = []
+    for _ in range(REPEATS):
+        output = subprocess.check_output([sys.executable, "-c", MEASURE_SCRIPT, *modules])
+        results.append(json.loads(output))
+    return {
+        "seconds": min(r["seconds"] for r in results),
+        "max_rss_mb": min(r["max_rss_kb"] for r in results) / 1024,
+    }
+
+
+def is_installed(module_name: str) -> bool:
+    try:
+        subprocess.check_output([sys.executable, "-c", f"import {module_name}"], stderr=subprocess.DEVNULL)
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+if __name__ == "__main__":
+    missing = [module_name for module_name in LAZY_HELPER_MODULES if not is_installed(module_name)]
+    for module_name in missing:
+        print(f"Skipping {module_name}, it cannot be imported in this environment")
+        LAZY_HELPER_MODULES.remove(module_name)
+    lazy = measure(["gif_pipeline.pipeline"])
+    print(f"Lazy helpers:  {lazy['seconds']:.2f}s, {lazy['max_rss_mb']:.1f}MB max RSS")
+    eager = measure(["gif_pipeline.pipeline", *LAZY_HELPER_MODULES])
+    print(f"Eager helpers: {eager['seconds']:.2f}s, {eager['max_rss_mb']:.1f}MB max RSS")
+    print(
+        f"Deferred: {eager['seconds'] - lazy['seconds']:.2f}s, "
+        f"{eager['max_rss_mb'] - lazy['max_rss_mb']:.1f}MB until the lazy helpers are first used"
+    )
+    for module_name in LAZY_HELPER_MODULES:
+        result = measure(["gif_pipeline.pipeline", module_name])
+        print(
+            f"  {module_name}: +{result['seconds'] - lazy['seconds']:.2f}s, "
+            f"+{result['max_rss_mb'] - lazy['max_rss_mb']:.1f}MB"
+        )
@@ -0,0 +1,99 @@
+"""
+Compares the subprocess media backend (an ffprobe or ffmpeg process per call) against the in-process libav backend
+(PyAV, in a thread pool), for probing videos and grabbing single frames as thumbnails.
+A synthetic corpus of short test videos is generated with ffmpeg, then each backend probes every video and grabs a
+thumbnail from every video, through the same task worker the pipeline uses.
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Awaitable, List
+
+from gif_pipeline.media_backend import MediaBackend, MediaBackendType
+from gif_pipeline.tasks.libav_task import libav_available
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import TaskWorker
+
+CORPUS_SIZE = 50
+# Resolution and duration of each video in the corpus, cycled through
+CORPUS_SHAPES = [
+    ("320x240", 2),
+    ("640x480", 5),
+    ("1280x720", 10),
+    ("1920x1080", 3),
+]
+PROBE_POOL_SIZE = 4
+REPEATS = 3
+
+
+def generate_corpus(directory: str) -> List[str]:
+    paths = []
+    for i in range(CORPUS_SIZE):
+        size, duration = CORPUS_SHAPES[i % len(CORPUS_SHAPES)]
+        path = os.path.join(directory, f"video_{i}.mp4")
+        subprocess.check_call([
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate=30:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest",
+            path
+        ])
+        paths.append(path)
+    return paths
+
+
+async def time_calls(paths: List[str], call: Callable[[str], Awaitable]) -> float:
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        await asyncio.gather(*[call(path) for path in paths])
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+async def benchmark_backend(backend_type: MediaBackendType, paths: List[str], output_dir: str) -> None:
+    backend = MediaBackend()
+    backend.configure(backend_type)
+    worker = TaskWorker({ResourceClass.PROBE: PROBE_POOL_SIZE})
+
+    async def probe(path: str) -> None:
+        await backend.probe(worker, path)
+
+    async def thumbnail(path: str) -> None:
+        thumb_path = os.path.join(output_dir, f"{backend_type.value}_{os.path.basename(path)}.jpg")
+        await backend.grab_frame(worker, path, thumb_path, 1, 500, 500)
+
+    probe_seconds = await time_calls(paths, probe)
+    thumb_seconds = await time_calls(paths, thumbnail)
+    print(
+        f"{backend_type.value:>10}: "
+        f"probe {probe_seconds:.2f}s ({1000 * probe_seconds / len(paths):.1f}ms per video), "
+        f"thumbnail {thumb_seconds:.2f}s ({1000 * thumb_seconds / len(paths):.1f}ms per video)"
+    )
+
+
+async def main() -> None:
+    corpus_dir = tempfile.mkdtemp(prefix="media_backend_benchmark_")
+    try:
+        print(f"Generating corpus of {CORPUS_SIZE} videos")
+        paths = generate_corpus(corpus_dir)
+        print(f"Running each benchmark {REPEATS} times, with {PROBE_POOL_SIZE} probe slots, best times:")
+        await benchmark_backend(MediaBackendType.SUBPROCESS, paths, corpus_dir)
+        await benchmark_backend(MediaBackendType.LIBAV, paths, corpus_dir)
+    finally:
+        shutil.rmtree(corpus_dir)
+
+
+if __name__ == "__main__":
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        print("ffmpeg and ffprobe must be installed to run this benchmark")
+        sys.exit(1)
+    if not libav_available():
+        print("PyAV must be installed to run this benchmark, install it with: poetry install -E libav")
+        sys.exit(1)
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""
+Checks remote worker nodes end to end on one machine. Starts a remote worker server with a task worker in this
+process, with no local encode slots, launches a worker node as a second process, then runs an encode and a hash task,
+which can only complete by being sent to the node.
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from gif_pipeline.remote_workers import RemoteWorkerServer, RemoteWorkerConfig
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.hash_dir_task import HashDirectoryTask
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import TaskWorker
+
+PORT = 7191
+TOKEN = "remote-worker-check"
+NODE_TIMEOUT = 30
+
+
+async def wait_for_node(server: RemoteWorkerServer, resource_class: ResourceClass) -> None:
+    start = time.monotonic()
+    while server.free_slots(resource_class) == 0:
+        if time.monotonic() - start > NODE_TIMEOUT:
+            raise TimeoutError("Worker node did not connect")
+        await asyncio.sleep(0.1)
+
+
+async def main(work_dir: str) -> None:
+    server = RemoteWorkerServer(RemoteWorkerConfig("127.0.0.1", PORT, TOKEN))
+    await server.start()
+    worker = TaskWorker({ResourceClass.ENCODE: 0, ResourceClass.HASH: 0})
+    worker.remote = server
+    node = subprocess.Popen(
+        [
+            sys.executable, "-m", "gif_pipeline.worker_node",
+            "--url", f"http://127.0.0.1:{PORT}", "--token", TOKEN, "--name", "check-node",
+            "--encode-slots", "2", "--hash-slots", "1", "--work-dir", os.path.join(work_dir, "node"),
+        ],
+    )
+    try:
+        await wait_for_node(server, ResourceClass.ENCODE)
+        source_path = os.path.join(work_dir, "source.mp4")
+        output_path = os.path.join(work_dir, "output.mp4")
+        subprocess.check_call([
+            "ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=30:duration=5",
+            "-c:v", "libx264", "-preset", "ultrafast", source_path
+        ])
+        start = time.monotonic()
+        await worker.await_task(FfmpegTask(
+            purpose="check",
+            inputs={source_path: None},
+            outputs={output_path: "-vf scale=160:-2 -c:v libx264 -preset ultrafast"},
+        ))
+        print(f"Remote encode finished in {time.monotonic() - start:.2f}s, output {os.path.getsize(output_path)} bytes")
+        hash_dir = os.path.join(work_dir, "frames")
+        os.makedirs(hash_dir)
+        for i in range(5):
+            Image.new("RGB", (64, 64), (i * 50, 0, 0)).save(os.path.join(hash_dir, f"{i}.png"))
+        with ProcessPoolExecutor() as executor:
+            local_hashes = await HashDirectoryTask(hash_dir, executor).run()
+            await wait_for_node(server, ResourceClass.HASH)
+            remote_hashes = await worker.await_task(HashDirectoryTask(hash_dir, executor))
+        print(f"Remote hash matches local hash: {remote_hashes == local_hashes}")
+        print(worker.stats.table())
+    finally:
+        node.terminate()
+        node.wait()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg must be installed to run this check")
+        sys.exit(1)
+    check_dir = tempfile.mkdtemp(prefix="remote_worker_check_")
+    try:
+        asyncio.run(main(check_dir))
+    finally:
+        shutil.rmtree(check_dir)
@@ -0,0 +1,89 @@
+"""
+Compares cutting long videos the previous way, with output seeking and a full encode, against a full encode with input
+seeking, and against a smart cut, which stream copies whole GOPs and only encodes the partial GOPs at the boundaries.
+Long test videos are generated with ffmpeg from lavfi sources, then each cut is run through a task worker.
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional, List, Tuple
+
+from gif_pipeline.helpers.smart_cut import smart_cut, seek_options
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.task_worker import TaskWorker
+from gif_pipeline.video_info import VideoInfoStore
+
+VIDEO_MINUTES = [5, 20]
+VIDEO_SIZE = "640x360"
+GOP_FRAMES = 250
+# Trimming 5 seconds off the start, and taking a section from the middle
+CUTS: List[Tuple[str, Optional[float], Optional[float]]] = [
+    ("trim start", 5.0, None),
+    ("middle", 123.4, 234.5),
+]
+
+
+def generate_video(directory: str, minutes: int) -> str:
+    path = os.path.join(directory, f"video_{minutes}m.mp4")
+    subprocess.check_call([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={VIDEO_SIZE}:rate=25:duration={minutes * 60}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={minutes * 60}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(GOP_FRAMES), "-c:a", "aac", "-shortest", path
+    ])
+    return path
+
+
+async def timed(
+        worker: TaskWorker,
+        video_info_store: VideoInfoStore,
+        mode: str,
+        video_path: str,
+        output_path: str,
+        start,
+        end,
+) -> float:
+    begin = time.perf_counter()
+    if mode == "smart cut":
+        if not await smart_cut(worker, video_info_store, video_path, output_path, start, end):
+            raise Exception("Smart cut was not possible for this video")
+    else:
+        if mode == "output seek":
+            inputs, outputs = {video_path: None}, {output_path: seek_options(start, end)}
+        else:
+            inputs, outputs = {video_path: seek_options(start, end)}, {output_path: None}
+        await worker.await_task(FfmpegTask(purpose="cut", inputs=inputs, outputs=outputs))
+    duration = time.perf_counter() - begin
+    os.remove(output_path)
+    return duration
+
+
+async def main() -> None:
+    os.makedirs("sandbox", exist_ok=True)
+    directory = tempfile.mkdtemp(prefix="smart_cut_benchmark_", dir="sandbox")
+    worker = TaskWorker()
+    video_info_store = VideoInfoStore(None, worker)
+    try:
+        for minutes in VIDEO_MINUTES:
+            print(f"Generating {minutes} minute test video")
+            video_path = generate_video(directory, minutes)
+            for cut_name, start, end in CUTS:
+                results = []
+                for mode in ["output seek", "input seek", "smart cut"]:
+                    output_path = os.path.join(directory, "output.mp4")
+                    duration = await timed(worker, video_info_store, mode, video_path, output_path, start, end)
+                    results.append(f"{mode}: {duration:.1f}s")
+                print(f"{minutes:>3} minute video, {cut_name:>10}: " + ", ".join(results))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        print("ffmpeg and ffprobe must be installed to run this benchmark")
+        sys.exit(1)
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+Compares aggregate encode and hash throughput with the CPU thread budget against the default behaviour, where every
+ffmpeg picks its own thread count and each hash task submits every frame to the hashing executor at once.
+A synthetic corpus of test videos and frames is generated with ffmpeg, then each mode runs encodes of every video
+through a task worker with the default encode and hash pool sizes, while hashing the frames at the same time.
+"""
+import asyncio
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from gif_pipeline.tasks.cpu_budget import cpu_budget
+from gif_pipeline.tasks.ffmpeg_task import FfmpegTask
+from gif_pipeline.tasks.hash_dir_task import HashDirectoryTask
+from gif_pipeline.tasks.task import ResourceClass
+from gif_pipeline.tasks.task_worker import TaskWorker, DEFAULT_POOL_SIZES
+
+CORPUS_SIZE = 9
+VIDEO_SECONDS = 10
+VIDEO_SIZE = "1280x720"
+FRAME_DIRS = 4
+FRAMES_PER_DIR = 200
+
+
+def generate_corpus(directory: str) -> Tuple[List[str], List[str]]:
+    videos = []
+    for i in range(CORPUS_SIZE):
+        path = os.path.join(directory, f"video_{i}.mp4")
+        subprocess.check_call([
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "lavfi", "-i", f"testsrc2=size={VIDEO_SIZE}:rate=30:duration={VIDEO_SECONDS}",
+            "-c:v", "libx264", "-preset", "ultrafast", path
+        ])
+        videos.append(path)
+    frame_dirs = []
+    for i in range(FRAME_DIRS):
+        frame_dir = os.path.join(directory, f"frames_{i}")
+        os.makedirs(frame_dir)
+        subprocess.check_call([
+            "ffmpeg", "-v", "error", "-y", "-i", videos[i % len(videos)],
+            "-vframes", str(FRAMES_PER_DIR), "-vf", "scale=640:-2", os.path.join(frame_dir, "%05d.png")
+        ])
+        frame_dirs.append(frame_dir)
+    return videos, frame_dirs
+
+
+def running_count(worker: TaskWorker) -> int:
+    pools = [worker.pools[ResourceClass.ENCODE], worker.pools[ResourceClass.HASH]]
+    return sum(pool.size - pool.free_slots for pool in pools)
+
+
+async def benchmark(
+        name: str,
+        thread_budget: Optional[int],
+        videos: List[str],
+        frame_dirs: List[str],
+        output_dir: str,
+) -> None:
+    worker = TaskWorker()
+    cpu_budget.configure(thread_budget, lambda: running_count(worker))
+    start = time.perf_counter()
+    with ProcessPoolExecutor() as executor:
+        encodes = [
+            worker.await_task(FfmpegTask(
+                purpose="benchmark",
+                inputs={video: None},
+                outputs={os.path.join(output_dir, f"{name}_{i}.mp4"): "-c:v libx264 -preset medium -crf 23"},
+            ))
+            for i, video in enumerate(videos)
+        ]
+        hashes = [worker.await_task(HashDirectoryTask(frame_dir, executor)) for frame_dir in frame_dirs]
+        await asyncio.gather(*encodes, *hashes)
+    duration = time.perf_counter() - start
+    for path in glob.glob(os.path.join(output_dir, f"{name}_*.mp4")):
+        os.remove(path)
+    video_seconds = len(videos) * VIDEO_SECONDS
+    frames = len(frame_dirs) * FRAMES_PER_DIR
+    threads = thread_budget or "default"
+    print(
+        f"{name:>10}: {duration:.1f}s total, {threads} threads shared, "
+        f"{video_seconds / duration:.2f} video seconds encoded per second, "
+        f"{frames / duration:.1f} frames hashed per second"
+    )
+
+
+async def main() -> None:
+    corpus_dir = tempfile.mkdtemp(prefix="thread_budget_benchmark_")
+    cpu_slots = DEFAULT_POOL_SIZES[ResourceClass.ENCODE] + DEFAULT_POOL_SIZES[ResourceClass.HASH]
+    try:
+        print(f"Generating corpus of {CORPUS_SIZE} videos and {FRAME_DIRS * FRAMES_PER_DIR} frames")
+        print(f"Running on {os.cpu_count()} cores, with {cpu_slots} encode and hash slots")
+        videos, frame_dirs = generate_corpus(corpus_dir)
+        await benchmark("unbudgeted", None, videos, frame_dirs, corpus_dir)
+        await benchmark("budgeted", os.cpu_count() or 1, videos, frame_dirs, corpus_dir)
+    finally:
+        shutil.rmtree(corpus_dir)
+
+
+if __name__ == "__main__":
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg must be installed to run this benchmark")
+        sys.exit(1)
+    asyncio.run(main())